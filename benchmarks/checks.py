@@ -0,0 +1,337 @@
+"""
+Checks of how gaugeview copes with what the upstream services answer, run against the fakes of this package:
+
+    python -m benchmarks.checks                  # every check
+    python -m benchmarks.checks -k archive       # the checks whose name contains archive
+
+Each check prints ok or what went wrong, and the run exits with status 1 if any failed. The upload check needs the
+openssl command, the fake HydroShare is served over HTTPS with a certificate made for the run.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+
+from .fake_hydroshare import FakeHydroShare, serve as serve_hydroshare
+from .fake_upstream import FakeUpstream, UPSTREAM_NAMES, fit_to_window, serve
+from .fixtures import fixtures, usgs_dv_rdb
+from .run import setup_django
+
+
+def make_certificate(directory):
+    """
+    :return: The paths of a self-signed certificate of localhost and of its key, made in directory
+    """
+    certfile, keyfile = os.path.join(directory, 'cert.pem'), os.path.join(directory, 'key.pem')
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                               '-subj', '/CN=localhost', '-addext', 'subjectAltName=DNS:localhost',
+                               '-keyout', keyfile, '-out', certfile], stderr=devnull)
+    return certfile, keyfile
+
+
+@contextmanager
+def fake_services(upstream=None, hydroshare=None, **settings):
+    """
+    Point the app at fake upstream services for the duration of a check, with the daily values archive in a temporary
+    directory
+    :param upstream: FakeUpstream answering for every upstream service but HydroShare
+    :param hydroshare: FakeHydroShare, served over HTTPS with a certificate the app is told to trust
+    :param settings: Settings set in the environment meanwhile, those that are not strings as JSON
+    :return: The temporary directory, removed afterwards
+    """
+    directory = tempfile.mkdtemp()
+    environ = dict(os.environ)
+    servers = []
+    try:
+        urls = {}
+        if upstream is not None:
+            servers.append(serve(upstream, port=0))
+            base_url = 'http://{0}:{1}'.format(*servers[-1].server_address)
+            urls.update((name, base_url) for name in UPSTREAM_NAMES)
+        if hydroshare is not None:
+            # The HydroShare client only sends its token over HTTPS
+            certfile, keyfile = make_certificate(directory)
+            servers.append(serve_hydroshare(hydroshare, certfile, keyfile, port=0))
+            urls['hydroshare'] = 'https://localhost:{0}'.format(servers[-1].server_address[1])
+            os.environ['REQUESTS_CA_BUNDLE'] = certfile
+        os.environ['GAUGEVIEW_UPSTREAM_URLS'] = json.dumps(urls)
+        os.environ['GAUGEVIEW_DV_ARCHIVE_DIR'] = directory
+        os.environ.update((name, value if isinstance(value, basestring) else json.dumps(value))
+                          for name, value in settings.items())
+        yield directory
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+        for server in servers:
+            server.shutdown()
+        shutil.rmtree(directory)
+
+
+def check_archive_ignores_days_outside_the_window():
+    """
+    NWIS may answer with more days than asked for, the archive keeps only the days of the window
+    """
+    from tethysapp.gaugeview.archive import DailyArchive
+
+    directory = tempfile.mkdtemp()
+    try:
+        # The fixture's days, 2014-12-02 to 2014-12-31, all around the window
+        dv_archive = DailyArchive('10109000', directory)
+        dv_archive.ingest(usgs_dv_rdb(30), date(2014, 12, 10), date(2014, 12, 19))
+        metadata, series = dv_archive.read(date(2014, 12, 1), date(2014, 12, 31))
+        days = [time.date() for time in series.datetimes()]
+        assert days and min(days) >= date(2014, 12, 10) and max(days) <= date(2014, 12, 19), days
+        state = dv_archive.state()
+        assert (state.covered_from, state.covered_to) == (date(2014, 12, 10).toordinal(),
+                                                          date(2014, 12, 19).toordinal())
+    finally:
+        shutil.rmtree(directory)
+
+
+def check_fake_upstream_answers_the_days_asked_for():
+    """
+    The fake NWIS moves its observations into the days of the query, like NWIS answers
+    """
+    from tethysapp.gaugeview.controllers import convert_usgs_dv_to_python, convert_usgs_iv_to_python
+
+    payloads = fixtures('small')
+    query = {'begin_date': ['2016-06-01'], 'end_date': ['2016-06-10']}
+    days = [time.date() for time in convert_usgs_dv_to_python(fit_to_window('dv', payloads['dv'], query))[1]
+            .datetimes()]
+    assert days and min(days) >= date(2016, 6, 1) and max(days) == date(2016, 6, 10), days
+    times = convert_usgs_iv_to_python(fit_to_window('iv', payloads['iv'], query))[1].datetimes()
+    assert times and min(times).date() >= date(2016, 5, 31) and max(times).date() <= date(2016, 6, 11), times[:2]
+
+
+def check_daily_values_from_the_fake_upstream():
+    """
+    The daily values of a window are archived and read back from the fake NWIS, as on the usgs page
+    """
+    from tethysapp.gaugeview import controllers
+
+    with fake_services(FakeUpstream(fixtures('small'))):
+        end = date.today()
+        start = end - timedelta(days=13)
+        metadata, series, stale = controllers.get_archived_dv_series('10109000', start, end)
+        days = [time.date() for time in series.datetimes()]
+        assert not stale and days and min(days) >= start and max(days) <= end, days
+
+
+def check_flow_stats_wait_for_the_full_record():
+    """
+    The usgs page shows no statistics while the record is backfilled in the background, then those of the full record
+    """
+    from tethysapp.gaugeview import flowstats
+    from tethysapp.gaugeview.archive import DailyArchive
+
+    with fake_services(FakeUpstream(fixtures('small'))):
+        # Only the last two weeks archived, as after a first view of the page
+        end = date.today()
+        DailyArchive('10109000').ingest(fit_to_window('dv', fixtures('small')['dv'], {
+            'begin_date': [(end - timedelta(days=13)).isoformat()], 'end_date': [end.isoformat()]}),
+            end - timedelta(days=13), end)
+        assert flowstats.get_flow_stats('10109000') is None
+        deadline = time.time() + 60
+        while DailyArchive('10109000').state().covered_from > flowstats.stats_start().toordinal():
+            assert time.time() < deadline, 'the record was not backfilled'
+            time.sleep(0.1)
+        stats = flowstats.get_flow_stats('10109000')
+        assert stats['count'] > 14 and stats['last_day'] == end.toordinal(), stats['count']
+
+
+def check_upload_jobs_create_one_resource_each():
+    """
+    Upload jobs retried after HydroShare answered 503 create exactly one resource each, also when the 503 came after
+    the resource was created
+    """
+    from django.contrib.auth import get_user_model
+    from django.core.management import call_command
+    from sqlalchemy import create_engine
+    from tethysapp.gaugeview import hsclients, model, uploads
+
+    random.seed(48)
+    fake = FakeHydroShare(error_rate=0.2, create_error_rate=0.3)
+    with fake_services(hydroshare=fake, GAUGEVIEW_UPLOAD_WORKERS=0, GAUGEVIEW_UPLOAD_ATTEMPTS=20,
+                       GAUGEVIEW_UPLOAD_RETRY_DELAY=0,
+                       GAUGEVIEW_RATE_LIMITS={'hydroshare': {'rate': 100, 'burst': 100}}) as directory:
+        # The jobs are kept in a database of their own rather than the persistent store of the app
+        engine = create_engine('sqlite:///' + os.path.join(directory, 'jobs.sqlite'))
+        model.Base.metadata.create_all(engine, tables=[model.UploadJob.__table__])
+        model.SessionMaker.configure(bind=engine)
+        call_command('migrate', verbosity=0)
+        user = get_user_model().objects.create(username='gaugeview-checks')
+        token = fake.issue_token()
+        try:
+            job_ids = [uploads.enqueue(user, 'Gauge {0}'.format(index), 'Abstract', ['Flow'],
+                                       'http://localhost/apps/gaugeview/waterml/?gaugeid={0}'.format(index), True)
+                       for index in range(10)]
+            for attempt in range(200):
+                claimed = uploads.claim_job()
+                if claimed is None:
+                    break
+                uploads.run_job(claimed, client=lambda job_user: hsclients.create_client(token))
+            jobs = [uploads.get_job(job_id) for job_id in job_ids]
+            assert all(job['status'] == uploads.SUCCEEDED for job in jobs), [job['status'] for job in jobs]
+            assert sum(job['attempts'] for job in jobs) > len(jobs), 'no 503 was retried'
+            assert fake.lost_creations, 'no 503 came after a resource was created'
+            resource_ids = sorted(job['resource_id'] for job in jobs)
+            assert resource_ids == sorted(fake.resources), (len(resource_ids), len(fake.resources))
+            assert all(resource['public'] for resource in fake.resources.values())
+        finally:
+            user.delete()
+            model.SessionMaker.configure(bind=model.engine)
+
+
+def check_prefetch_warms_the_top_gauges():
+    """
+    A round of the prefetcher caches the IV, AHPS and NWM data of the most requested gauges, the data their initial
+    pages show, with no more than `concurrency` refreshes at a time
+    """
+    from tethysapp.gaugeview import controllers, prefetch
+
+    running = [0, 0]
+    lock = threading.Lock()
+
+    def refresh(*job):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        try:
+            prefetch.refresh_source(*job)
+        finally:
+            with lock:
+                running[0] -= 1
+
+    upstream = FakeUpstream(fixtures('small'), latency=0.05)
+    with fake_services(upstream):
+        # Coordinates as the pages get them in their query
+        requests = [('usgs', '10109000', '41.74', '-111.78')] * 3 + [('ahps', 'LOGU1', '41.73', '-111.83')] * 2 + \
+                   [('usgs', '10105900', '41.65', '-111.90')]
+        for kind, gauge_id, latitude, longitude in requests:
+            prefetch.record_request(kind, gauge_id, latitude, longitude)
+        prefetch.flush_popularity()
+        scheduler = prefetch.PrefetchScheduler(top_n=2, concurrency=2, jitter=0, refresh=refresh)
+        assert scheduler.run_once() == (4, 4)
+        assert running[1] <= 2, running[1]
+
+        # The initial pages of the top gauges are served from the cache
+        requested = dict(upstream.requests)
+        now = datetime.now()
+        controllers.get_usgs_iv_data('10109000', (now - timedelta(days=14)).strftime('%Y-%m-%d'),
+                                     now.strftime('%Y-%m-%d'))
+        controllers.get_ahps_data('LOGU1')
+        for latitude, longitude in (('41.74', '-111.78'), ('41.73', '-111.83')):
+            controllers.get_nwm_data('short_range', controllers.get_comid(latitude, longitude),
+                                     now.strftime('%Y-%m-%d'), now.strftime('%Y-%m-%d'),
+                                     controllers.latest_short_range_cycle(now))
+        assert upstream.requests == requested, (requested, upstream.requests)
+        assert 'dv' not in requested and requested.get('iv') == 1, requested
+
+
+class TokenStore(object):
+    """
+    Stand-in of the social auth records of a user signed in with HydroShare, saved as JSON as the database does
+    """
+    def __init__(self, token):
+        self.extra_data = {'token_dict': token, 'access_token': token['access_token']}
+
+    def get(self, provider):
+        store = self
+
+        class Social(object):
+            extra_data = json.loads(json.dumps(store.extra_data))
+
+            def save(self):
+                store.extra_data = json.loads(json.dumps(self.extra_data))
+
+        return Social()
+
+
+def check_hs_token_refreshed_once():
+    """
+    Client pools of two processes finding the same HydroShare token about to expire refresh it once, the refresh
+    token being single use, and both end up with a token that works
+    """
+    from tethysapp.gaugeview import hsclients
+
+    fake = FakeHydroShare(latency=0.3, token_lifetime=3)
+    with fake_services(hydroshare=fake):
+        token = fake.issue_token()
+        token['expires_at'] = time.time() + token['expires_in']
+
+        class User(object):
+            pk = 1
+            social_auth = TokenStore(token)
+
+        user = User()
+        pools = [hsclients.ClientPool(10, 600, 2) for _ in range(2)]
+        for pool in pools:
+            pool.get(user)
+        # Within the refresh margin of the token, both pools refresh it at the same time
+        time.sleep(1.5)
+        clients, errors = [], []
+
+        def get(pool):
+            try:
+                clients.append(pool.get(user))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=get, args=(pool,)) for pool in pools]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not errors, errors
+        assert fake.refreshes == 1, fake.refreshes
+        assert all(list(client.getResourceTypes()) for client in clients)
+
+
+CHECKS = [check_archive_ignores_days_outside_the_window, check_fake_upstream_answers_the_days_asked_for,
+          check_daily_values_from_the_fake_upstream, check_flow_stats_wait_for_the_full_record,
+          check_upload_jobs_create_one_resource_each, check_prefetch_warms_the_top_gauges,
+          check_hs_token_refreshed_once]
+
+
+def main():
+    # The retries of the checks are expected, their warnings are not shown
+    logging.basicConfig(level=logging.ERROR)
+    parser = argparse.ArgumentParser(description='Check gaugeview against the fake upstream services.')
+    parser.add_argument('-k', dest='keyword', help='only run the checks whose name contains this')
+    args = parser.parse_args()
+
+    setup_django()
+    # The cache of the process is created on first use, one directory serves all the checks
+    cache_dir = tempfile.mkdtemp()
+    os.environ['GAUGEVIEW_CACHE_DIR'] = cache_dir
+    failed = 0
+    try:
+        for check in CHECKS:
+            if args.keyword and args.keyword not in check.__name__:
+                continue
+            try:
+                check()
+            except Exception:
+                failed += 1
+                print('{0}: FAILED'.format(check.__name__))
+                traceback.print_exc()
+            else:
+                print('{0}: ok'.format(check.__name__))
+    finally:
+        shutil.rmtree(cache_dir)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
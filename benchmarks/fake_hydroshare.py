@@ -0,0 +1,224 @@
+"""
+Stand-in for the HydroShare REST API the gaugeview uploads call: the resource types, resource creation, listing and
+access rules, answered with configurable latency and error rate, and optionally the OAuth token endpoint issuing tokens
+that expire, to exercise the token refresh of the client pool. The HydroShare client only sends OAuth tokens over HTTPS,
+so it is served with a certificate the app is told to trust through REQUESTS_CA_BUNDLE:
+
+    openssl req -x509 -newkey rsa:2048 -nodes -days 30 -subj /CN=localhost -keyout key.pem -out cert.pem
+    python -m benchmarks.fake_hydroshare --port 8443 --certfile cert.pem --keyfile key.pem --error-rate 0.2
+    python -m benchmarks.fake_hydroshare --port 8443 --certfile cert.pem --keyfile key.pem --token-lifetime 60
+
+then start the app with REQUESTS_CA_BUNDLE=cert.pem and the GAUGEVIEW_UPSTREAM_URLS setting printed on startup.
+"""
+import BaseHTTPServer
+import argparse
+import cgi
+import json
+import random
+import re
+import ssl
+import threading
+import time
+import uuid
+from urlparse import parse_qs, urlparse
+
+from .fake_upstream import Server
+
+RESOURCE_TYPES = ('CompositeResource', 'GenericResource', 'RefTimeSeriesResource')
+
+
+class FakeHydroShare(object):
+    """
+    What the server answers with
+    :param latency: Mean seconds before answering
+    :param error_rate: Fraction of requests answered with error_status
+    :param error_status: Status of the failed requests (i.e. 503, or 429 to exercise throttling)
+    :param create_error_rate: Fraction of the created resources answered with error_status anyway, as when the answer
+    is lost to a timeout or a proxy after HydroShare created the resource
+    :param token_lifetime: Seconds the tokens of issue_token and of /o/token/ are valid, any bearer token is accepted
+    without it
+    """
+    def __init__(self, latency=0.0, error_rate=0.0, error_status=503, token_lifetime=None, create_error_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.create_error_rate = create_error_rate
+        self.token_lifetime = token_lifetime
+        self.resources = {}
+        self.requests = {}
+        self.refreshes = 0
+        self.lost_creations = 0
+        # Access token to the time it expires, and refresh token to its access token
+        self._access_tokens = {}
+        self._refresh_tokens = {}
+        self._lock = threading.Lock()
+
+    def issue_token(self):
+        """
+        :return: A new OAuth token dict, as HydroShare answers the token endpoint with
+        """
+        token = {'access_token': uuid.uuid4().hex, 'refresh_token': uuid.uuid4().hex, 'token_type': 'Bearer',
+                 'expires_in': self.token_lifetime or 36000, 'scope': 'read write'}
+        with self._lock:
+            self._access_tokens[token['access_token']] = time.time() + token['expires_in']
+            self._refresh_tokens[token['refresh_token']] = token['access_token']
+        return token
+
+    def _refresh(self, form):
+        # Refresh tokens are single use, and revoke the access token they were issued with
+        with self._lock:
+            access_token = self._refresh_tokens.pop(form.get('refresh_token'), None)
+            if form.get('grant_type') != 'refresh_token' or access_token is None:
+                return 400, {'error': 'invalid_grant'}
+            self._access_tokens.pop(access_token, None)
+            self.refreshes += 1
+        return 200, self.issue_token()
+
+    def _authorized(self, headers):
+        authorization = headers.get('Authorization') or ''
+        if not authorization.startswith('Bearer '):
+            return False
+        if self.token_lifetime is None:
+            return True
+        with self._lock:
+            return self._access_tokens.get(authorization[len('Bearer '):], 0) > time.time()
+
+    def respond(self, method, path, headers, form, query=None):
+        """
+        :param method: 'GET', 'POST' or 'PUT'
+        :param path: Path of the request, without the query
+        :param headers: Headers of the request
+        :param form: Dict of the fields of the request body
+        :param query: Dict of the fields of the query
+        :return: The status and the JSON body to answer with, after waiting the configured latency
+        """
+        with self._lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+        time.sleep(max(0, random.uniform(0.5, 1.5) * self.latency))
+        if method == 'POST' and path == '/o/token/':
+            return self._refresh(form)
+        if not self._authorized(headers):
+            return 401, {'detail': 'Authentication credentials were not provided or expired.'}
+        if random.random() < self.error_rate:
+            return self.error_status, {'detail': 'fake hydroshare error'}
+
+        if method == 'GET' and path == '/hsapi/resource/types':
+            return 200, [{'resource_type': resource_type} for resource_type in RESOURCE_TYPES]
+        if method == 'POST' and path == '/hsapi/resource/':
+            if form.get('resource_type') not in RESOURCE_TYPES or not form.get('title'):
+                return 400, {'detail': 'resource_type and title are required'}
+            resource_id = uuid.uuid4().hex
+            keywords = [value for name, value in sorted(form.items()) if name.startswith('keywords[')]
+            with self._lock:
+                self.resources[resource_id] = {'resource_id': resource_id, 'resource_type': form['resource_type'],
+                                               'title': form['title'], 'abstract': form.get('abstract'),
+                                               'keywords': keywords, 'metadata': form.get('metadata'),
+                                               'public': False}
+            if random.random() < self.create_error_rate:
+                with self._lock:
+                    self.lost_creations += 1
+                return self.error_status, {'detail': 'fake hydroshare error after creating the resource'}
+            return 201, {'resource_id': resource_id, 'resource_type': form['resource_type']}
+        if method == 'GET' and path == '/hsapi/resource/':
+            # The resources with all the keywords of the subject filter, on a single page
+            subjects = [subject for subject in (query or {}).get('subject', '').split(',') if subject]
+            with self._lock:
+                results = [{'resource_id': resource['resource_id'], 'resource_title': resource['title'],
+                            'resource_type': resource['resource_type'], 'public': resource['public']}
+                           for resource in self.resources.values()
+                           if all(subject in resource['keywords'] for subject in subjects)]
+            return 200, {'count': len(results), 'next': None, 'previous': None, 'results': results}
+        match = re.match(r'^/hsapi/resource/accessRules/([0-9a-f]+)/$', path)
+        if method == 'PUT' and match:
+            with self._lock:
+                resource = self.resources.get(match.group(1))
+                if resource is None:
+                    return 404, {'detail': 'Not found.'}
+                resource['public'] = form.get('public', 'False').lower() == 'true'
+            return 200, {'resource_id': match.group(1)}
+        match = re.match(r'^/hsapi/resource/([0-9a-f]+)/$', path)
+        if method == 'GET' and match and match.group(1) in self.resources:
+            return 200, self.resources[match.group(1)]
+        return 404, {'detail': 'Not found.'}
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.0'
+
+    def _form(self):
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('multipart/form-data'):
+            fields = cgi.FieldStorage(fp=self.rfile, headers=self.headers,
+                                      environ={'REQUEST_METHOD': self.command, 'CONTENT_TYPE': content_type})
+            return dict((name, fields.getfirst(name)) for name in fields.keys())
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        return dict((name, values[0]) for name, values in parse_qs(body).items())
+
+    def _respond(self):
+        url = urlparse(self.path)
+        query = dict((name, values[0]) for name, values in parse_qs(url.query).items())
+        status, body = self.server.hydroshare.respond(self.command, url.path, self.headers, self._form(), query)
+        body = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = _respond
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+def serve(hydroshare, certfile, keyfile, host='localhost', port=8443, verbose=False):
+    """
+    :return: A started HTTPS server answering with hydroshare, running in a daemon thread; call shutdown() to stop it
+    """
+    server = Server((host, port), Handler)
+    server.socket = ssl.wrap_socket(server.socket, keyfile=keyfile, certfile=certfile, server_side=True)
+    server.hydroshare = hydroshare
+    server.verbose = verbose
+    thread = threading.Thread(target=server.serve_forever, name='fake-hydroshare')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a stand-in of the HydroShare REST API.')
+    parser.add_argument('--host', default='localhost', help='must match the name of the certificate')
+    parser.add_argument('--port', type=int, default=8443)
+    parser.add_argument('--certfile', required=True)
+    parser.add_argument('--keyfile', required=True)
+    parser.add_argument('--latency', type=float, default=0.0, help='mean seconds before answering')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests that fail')
+    parser.add_argument('--error-status', type=int, default=503, help='status of the failed requests')
+    parser.add_argument('--create-error-rate', type=float, default=0.0,
+                        help='fraction of the created resources answered with the error status anyway')
+    parser.add_argument('--token-lifetime', type=int, help='seconds the issued tokens are valid, any token is '
+                                                           'accepted without it')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    args = parser.parse_args()
+
+    hydroshare = FakeHydroShare(args.latency, args.error_rate, args.error_status, args.token_lifetime,
+                                args.create_error_rate)
+    server = serve(hydroshare, args.certfile, args.keyfile, args.host, args.port, args.verbose)
+    base_url = 'https://{0}:{1}'.format(args.host, args.port)
+    print('serving the HydroShare API on {0}, configure the app with'.format(base_url))
+    print('GAUGEVIEW_UPSTREAM_URLS=\'{0}\''.format(json.dumps({'hydroshare': base_url})))
+    if args.token_lifetime:
+        print('and store this token in the extra_data token_dict of the HydroShare login of a user')
+        print(json.dumps(hydroshare.issue_token()))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+        print('requests served: {0}, resources created: {1}, tokens refreshed: {2}'.format(
+            json.dumps(hydroshare.requests, sort_keys=True), len(hydroshare.resources), hydroshare.refreshes))
+
+
+if __name__ == '__main__':
+    main()
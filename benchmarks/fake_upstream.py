@@ -0,0 +1,219 @@
+"""
+Stand-in for the upstream services of gaugeview: NWIS uv and dv, NWIS water services iv, AHPS
+hydrograph_to_xml.php, the EPA PointIndexing service and the NWM forecasts GetWaterML API. Responses are the
+benchmark fixtures (or recorded files) served with configurable latency, error rate and payload size. The NWIS
+observations are moved into the days a request asks for, the latest of them on its last day, so the app gets data
+of the window it asked for like from NWIS.
+
+    python -m benchmarks.fake_upstream --port 8001 --latency 0.3 --error-rate 0.02 --slow epa=2
+
+then point the app at it with the GAUGEVIEW_UPSTREAM_URLS setting printed on startup.
+"""
+import BaseHTTPServer
+import SocketServer
+import argparse
+import json
+import os
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from urlparse import parse_qs, urlparse
+
+from .fixtures import SIZES, fixtures
+
+# Path prefix of each endpoint: (fixture, content type)
+ROUTES = (
+    ('/usa/nwis/uv/', 'iv', 'text/plain'),
+    ('/usa/nwis/dv/', 'dv', 'text/plain'),
+    ('/nwis/iv/', 'waterml', 'text/xml'),
+    ('/ahps2/hydrograph_to_xml.php', 'ahps', 'text/xml'),
+    ('/waters10/PointIndexing.Service', 'epa', 'application/json'),
+    ('/apps/nwm-forecasts/api/GetWaterML/', 'nwm', 'text/xml'),
+)
+
+# Files of --recordings replacing the fixtures
+RECORDING_FILES = {'iv': 'iv.rdb', 'dv': 'dv.rdb', 'waterml': 'iv.xml', 'ahps': 'ahps.xml', 'epa': 'epa.json',
+                   'nwm': 'nwm.xml'}
+
+UPSTREAM_NAMES = ('nwis', 'nwis_services', 'ahps', 'epa', 'nwm')
+
+# Of the fixtures answering NWIS queries: the query parameters of the first and last day, the step between two
+# observations, the format of their times, and a pattern finding the time of an observation
+WINDOWED = {
+    'iv': ('begin_date', 'end_date', timedelta(minutes=15), '%Y-%m-%d %H:%M',
+           re.compile(r'^(USGS\t[^\t]*\t)(\d{4}-\d\d-\d\d \d\d:\d\d)', re.M)),
+    'dv': ('begin_date', 'end_date', timedelta(days=1), '%Y-%m-%d',
+           re.compile(r'^(USGS\t[^\t]*\t)(\d{4}-\d\d-\d\d)', re.M)),
+    'waterml': ('startDT', 'endDT', timedelta(minutes=15), '%Y-%m-%dT%H:%M:%S',
+                re.compile(r'^(<ns1:value [^>]*dateTime=")(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)', re.M)),
+}
+
+
+def fit_to_window(fixture, body, query):
+    """
+    :param fixture: Name of the fixture
+    :param body: Its payload
+    :param query: Dict of the query parameters of the request
+    :return: The payload with the latest observations moved into the days the request asks for, as many as fit and
+    the latest on its last day, the others left out. Payloads of other fixtures, or of requests without the days,
+    are returned as they are.
+    """
+    if fixture not in WINDOWED:
+        return body
+    start_param, end_param, step, time_format, pattern = WINDOWED[fixture]
+    try:
+        start = datetime.strptime(query[start_param][0], '%Y-%m-%d')
+        end = datetime.strptime(query[end_param][0], '%Y-%m-%d') + timedelta(days=1) - step
+    except (KeyError, ValueError):
+        return body
+    matches = list(pattern.finditer(body))
+    fits = max(0, min(len(matches), int((end - start).total_seconds() // step.total_seconds()) + 1))
+    parts = []
+    position = matches[0].start() if matches else len(body)
+    parts.append(body[:position])
+    for index, match in enumerate(matches[len(matches) - fits:]):
+        line_end = body.find('\n', match.end())
+        line_end = len(body) if line_end < 0 else line_end + 1
+        time = end - step * (fits - 1 - index)
+        parts.append(match.group(1) + time.strftime(time_format) + body[match.end():line_end])
+    if matches:
+        last = matches[-1]
+        line_end = body.find('\n', last.end())
+        parts.append(body[line_end + 1:] if line_end >= 0 else '')
+    return ''.join(parts)
+
+
+class FakeUpstream(object):
+    """
+    What the server answers with
+    :param payloads: Dict of the body of each fixture
+    :param latency: Mean seconds before answering
+    :param jitter: Each answer waits latency plus or minus up to this many seconds
+    :param error_rate: Fraction of requests answered with error_status
+    :param error_status: Status of the failed requests (i.e. 503, or 429 to exercise throttling)
+    :param retry_after: Retry-After header sent with 429 and 503 answers, None for none
+    :param slow: Dict of extra seconds for some fixtures, i.e. {'epa': 2}
+    """
+    def __init__(self, payloads, latency=0.0, jitter=0.0, error_rate=0.0, error_status=503, retry_after=None,
+                 slow=None):
+        self.payloads = payloads
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.slow = slow or {}
+        self.requests = {}
+        self._lock = threading.Lock()
+
+    def respond(self, path, query=None):
+        """
+        :param path: Path of the request, without the query
+        :param query: Dict of the lists of values of the query parameters (see urlparse.parse_qs)
+        :return: The status, headers and body to answer with, after waiting the configured latency
+        """
+        for prefix, fixture, content_type in ROUTES:
+            if path.startswith(prefix):
+                break
+        else:
+            return 404, {'Content-Type': 'text/plain'}, 'not found'
+
+        with self._lock:
+            self.requests[fixture] = self.requests.get(fixture, 0) + 1
+        delay = self.latency + self.slow.get(fixture, 0) + random.uniform(-self.jitter, self.jitter)
+        time.sleep(max(0, delay))
+        if random.random() < self.error_rate:
+            headers = {'Content-Type': 'text/plain'}
+            if self.retry_after is not None and self.error_status in (429, 503):
+                headers['Retry-After'] = str(self.retry_after)
+            return self.error_status, headers, 'fake upstream error'
+        return 200, {'Content-Type': content_type}, fit_to_window(fixture, self.payloads[fixture], query or {})
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.0'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        status, headers, body = self.server.upstream.respond(url.path, parse_qs(url.query))
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def load_payloads(size, recordings=None):
+    """
+    :param size: One of the fixture SIZES
+    :param recordings: Directory of recorded responses (see RECORDING_FILES) used instead of the fixtures they name
+    :return: Dict of the body of each fixture
+    """
+    payloads = fixtures(size)
+    if recordings:
+        for fixture, filename in RECORDING_FILES.items():
+            path = os.path.join(recordings, filename)
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    payloads[fixture] = f.read()
+    return payloads
+
+
+def serve(upstream, host='127.0.0.1', port=8001, verbose=False):
+    """
+    :return: A started server answering with upstream, running in a daemon thread; call shutdown() to stop it
+    """
+    server = Server((host, port), Handler)
+    server.upstream = upstream
+    server.verbose = verbose
+    thread = threading.Thread(target=server.serve_forever, name='fake-upstream')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve stand-ins of the gaugeview upstream services.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--size', choices=sorted(SIZES), default='medium', help='size of the fixtures served')
+    parser.add_argument('--recordings', help='directory of recorded responses served instead of the fixtures')
+    parser.add_argument('--latency', type=float, default=0.0, help='mean seconds before answering')
+    parser.add_argument('--jitter', type=float, default=0.0, help='latency varies by up to this many seconds')
+    parser.add_argument('--slow', action='append', default=[], metavar='FIXTURE=SECONDS',
+                        help='extra latency of one fixture ({0})'.format(', '.join(sorted(RECORDING_FILES))))
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests that fail')
+    parser.add_argument('--error-status', type=int, default=503, help='status of the failed requests')
+    parser.add_argument('--retry-after', type=int, help='Retry-After sent with 429 and 503 answers')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    args = parser.parse_args()
+
+    slow = dict((item.split('=')[0], float(item.split('=')[1])) for item in args.slow)
+    upstream = FakeUpstream(load_payloads(args.size, args.recordings), args.latency, args.jitter, args.error_rate,
+                            args.error_status, args.retry_after, slow)
+    server = serve(upstream, args.host, args.port, args.verbose)
+    base_url = 'http://{0}:{1}'.format(args.host, args.port)
+    print('serving {0} fixtures on {1}, configure the app with'.format(args.size, base_url))
+    print('GAUGEVIEW_UPSTREAM_URLS=\'{0}\''.format(json.dumps(dict((name, base_url) for name in UPSTREAM_NAMES))))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+        print('requests served: {0}'.format(json.dumps(upstream.requests, sort_keys=True)))
+
+
+if __name__ == '__main__':
+    main()
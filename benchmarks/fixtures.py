@@ -0,0 +1,149 @@
+"""
+Payloads in the formats of the upstream services, generated from a fixed seed so every run parses the same bytes.
+The layouts follow responses recorded from NWIS, AHPS, the EPA PointIndexing service and the NWM forecasts API.
+"""
+import json
+import random
+from datetime import datetime, timedelta
+
+# Number of observations in each fixture size: two days, two months and two years of 15 minute IV data; a year, a
+# decade and a century of daily values
+SIZES = {
+    'small': {'iv': 192, 'dv': 365, 'ahps': 200, 'nwm': 18},
+    'medium': {'iv': 5760, 'dv': 3650, 'ahps': 1000, 'nwm': 240},
+    'large': {'iv': 70080, 'dv': 36500, 'ahps': 5000, 'nwm': 2400},
+}
+
+SITE_CODE = '10109000'
+SITE_NAME = 'LOGAN RIVER ABOVE STATE DAM, NEAR LOGAN, UT'
+START = datetime(2015, 1, 1)
+
+RDB_HEADER = """# ---------------------------------- WARNING ----------------------------------------
+# Some of the data that you have obtained from this U.S. Geological Survey database
+# may not have received Director's approval.
+#
+# File-format description:  http://help.waterdata.usgs.gov/faq/about-tab-delimited-output
+# Automated-retrieval info: http://help.waterdata.usgs.gov/faq/automated-retrievals
+#
+# Contact:   gs-w_support_nwisweb@usgs.gov
+# retrieved: 2016-06-14 17:11:23 EDT       (nadww01)
+#
+# Data for the following 1 site(s) are contained in this file
+#    USGS {0} {1}
+# -----------------------------------------------------------------------------------
+#
+"""
+
+
+def _flows(count, seed):
+    rng = random.Random(seed)
+    flow = 150.0
+    for i in range(count):
+        flow = max(1.0, flow * rng.uniform(0.97, 1.03))
+        yield round(flow, 1)
+
+
+def usgs_iv_rdb(count):
+    """
+    :param count: Number of 15 minute observations
+    :return: An NWIS uv RDB document
+    """
+    lines = [RDB_HEADER.format(SITE_CODE, SITE_NAME).rstrip('\n'),
+             'agency_cd\tsite_no\tdatetime\ttz_cd\t01_00060\t01_00060_cd', '5s\t15s\t20d\t6s\t14n\t10s']
+    for i, flow in enumerate(_flows(count, 1)):
+        time = START + timedelta(minutes=15 * i)
+        value = 'Ice' if i % 997 == 0 else ('' if i % 1009 == 0 else repr(flow))
+        lines.append('USGS\t{0}\t{1}\t{2}\t{3}\tP'.format(SITE_CODE, time.strftime('%Y-%m-%d %H:%M'),
+                                                          'MDT' if 3 <= time.month <= 10 else 'MST', value))
+    return '\n'.join(lines) + '\n'
+
+
+def usgs_dv_rdb(count):
+    """
+    :param count: Number of daily values
+    :return: An NWIS dv RDB document
+    """
+    lines = [RDB_HEADER.format(SITE_CODE, SITE_NAME).rstrip('\n'),
+             'agency_cd\tsite_no\tdatetime\t01_00060_00003\t01_00060_00003_cd', '5s\t15s\t20d\t14n\t10s']
+    start = START - timedelta(days=count)
+    for i, flow in enumerate(_flows(count, 2)):
+        value = 'Ice' if i % 389 == 0 else ('' if i % 401 == 0 else repr(flow))
+        lines.append('USGS\t{0}\t{1}\t{2}\t{3}'.format(SITE_CODE, (start + timedelta(days=i)).strftime('%Y-%m-%d'),
+                                                       value, 'A' if i < count - 120 else 'P'))
+    return '\n'.join(lines) + '\n'
+
+
+def usgs_iv_waterml(count):
+    """
+    :param count: Number of 15 minute observations
+    :return: An NWIS water services iv WaterML 1.1 document, as exported by get_water_ml
+    """
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<ns1:timeSeriesResponse xmlns:ns1="http://www.cuahsi.org/waterML/1.1/"><ns1:timeSeries '
+             'name="USGS:{0}:00060:00000"><ns1:sourceInfo><ns1:siteName>{1}</ns1:siteName><ns1:siteCode '
+             'network="NWIS" agencyCode="USGS">{0}</ns1:siteCode></ns1:sourceInfo><ns1:values>'.format(SITE_CODE,
+                                                                                                   SITE_NAME)]
+    for i, flow in enumerate(_flows(count, 1)):
+        time = START + timedelta(minutes=15 * i)
+        parts.append('<ns1:value qualifiers="P" dateTime="{0}.000-07:00">{1}</ns1:value>'.format(
+            time.strftime('%Y-%m-%dT%H:%M:%S'), flow))
+    parts.append('</ns1:values></ns1:timeSeries></ns1:timeSeriesResponse>')
+    return '\n'.join(parts)
+
+
+def ahps_xml(count):
+    """
+    :param count: Number of observed plus forecast values, a quarter of them forecasts
+    :return: An AHPS hydrograph_to_xml.php document
+    """
+    observed = count - count // 4
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<site timezone="UTC-6" originator="National Weather Service" name="Logan River near Logan" '
+             'id="LGNU1" generationtime="2016-06-14T20:30:06-00:00">', '<observed>']
+    flows = list(_flows(count, 3))
+    for i in range(count):
+        if i == observed:
+            parts.append('</observed><forecast issued="2016-06-14T16:33:00-00:00">')
+        time = START + timedelta(hours=i)
+        parts.append('<datum><valid timezone="UTC">{0}-00:00</valid><primary name="Stage" units="ft">{1:.2f}'
+                     '</primary><secondary name="Flow" units="kcfs">{2:.3f}</secondary><pedts>HGIRG</pedts>'
+                     '</datum>'.format(time.strftime('%Y-%m-%dT%H:%M:%S'), 2 + flows[i] / 100, flows[i] / 1000))
+    parts.append('</forecast></site>')
+    return '\n'.join(parts)
+
+
+def nwm_waterml(count):
+    """
+    :param count: Number of hourly forecast values
+    :return: A WaterML document of the NWM forecasts API GetWaterML endpoint
+    """
+    parts = ['<?xml version="1.0" encoding="utf-8"?>', '<timeSeriesResponse><timeSeries><values>']
+    for i, flow in enumerate(_flows(count, 4)):
+        time = START + timedelta(hours=i)
+        parts.append('<value dateTimeUTC="{0}" methodCode="1" sourceCode="1" qualityControlLevelCode="1" '
+                     'censorCode="nc" timeOffset="00:00" unitCode="cfs" >{1}</value>'.format(
+                         time.strftime('%Y-%m-%dT%H:%M:%S'), flow))
+    parts.append('</values></timeSeries></timeSeriesResponse>')
+    return '\n'.join(parts)
+
+
+def epa_point_indexing(comid=10360552):
+    """
+    :param comid: COMID of the flowline nearest the point
+    :return: An EPA PointIndexing service response
+    """
+    return json.dumps({'status': {'status_code': 0, 'status_message': None},
+                       'output': {'ary_flowlines': [{'comid': comid, 'reachcode': '16010203000123',
+                                                     'fmeasure': 47.1, 'fcode': 46006, 'snapping_distance': 0.08}],
+                                  'start_point': {'type': 'Point', 'coordinates': [-111.78, 41.74]}}})
+
+
+def fixtures(size):
+    """
+    :param size: One of the keys of SIZES
+    :return: A dict of the payload of each source for that size
+    """
+    counts = SIZES[size]
+    return {'iv': usgs_iv_rdb(counts['iv']), 'dv': usgs_dv_rdb(counts['dv']), 'ahps': ahps_xml(counts['ahps']),
+            'nwm': nwm_waterml(counts['nwm']), 'epa': epa_point_indexing(),
+            'waterml': usgs_iv_waterml(counts['iv'])}
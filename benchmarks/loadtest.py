@@ -0,0 +1,166 @@
+"""
+Load test of a running gaugeview app: keeps a target number of usgs, ahps and waterml requests in flight and reports
+the throughput and latency percentiles of each. Run the app against benchmarks.fake_upstream to measure it without
+the real services.
+
+    python -m benchmarks.loadtest http://localhost:8000/apps/gaugeview --concurrency 20 --duration 60 \\
+        --cookie sessionid=... --gauges 50
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import urllib
+import urllib2
+from datetime import datetime, timedelta
+
+# Relative weight of each kind of request in the mix
+DEFAULT_MIX = {'usgs': 4, 'ahps': 4, 'waterml': 1}
+
+
+def make_url(base_url, kind, gauge):
+    """
+    :param base_url: URL of the app, i.e. http://localhost:8000/apps/gaugeview
+    :param kind: 'usgs', 'ahps' or 'waterml'
+    :param gauge: Index of the gauge, gauges get distinct ids so the share of cache hits follows --gauges
+    :return: The URL of a request like the ones the map sends
+    """
+    end = datetime.utcnow()
+    start = end - timedelta(days=14)
+    if kind == 'usgs':
+        query = {'gaugeid': '{0:08d}'.format(10109000 + gauge), 'waterbody': 'Logan River', 'lat': '41.74',
+                 'long': '-111.78', 'start': start.strftime('%Y-%m-%d'), 'end': end.strftime('%Y-%m-%d'),
+                 'initial': 'True'}
+    elif kind == 'ahps':
+        query = {'gaugeno': 'lgn{0:02d}'.format(gauge), 'waterbody': 'Logan River', 'lat': '41.74', 'long': '-111.78',
+                 'initial': 'True'}
+    else:
+        query = {'type': 'usgsdv', 'gaugeid': '{0:08d}'.format(10109000 + gauge), 'lat': '41.74', 'long': '-111.78',
+                 'span': '10-y'}
+    return '{0}/{1}/?{2}'.format(base_url.rstrip('/'), kind, urllib.urlencode(sorted(query.items())))
+
+
+def percentile(values, fraction):
+    """
+    :param values: Sorted list
+    :param fraction: i.e. 0.95
+    :return: The value under which that fraction of the values fall (nearest rank)
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(fraction * len(values) + 0.5)) - 1)]
+
+
+class LoadTest(object):
+    """
+    :param base_url: URL of the app
+    :param concurrency: Requests kept in flight
+    :param mix: Dict of the relative weight of each kind of request
+    :param gauges: Number of distinct gauges requested
+    :param cookie: Cookie header sent with every request (the session of a logged in user)
+    :param timeout: Seconds before a request is counted as failed
+    """
+    def __init__(self, base_url, concurrency, mix, gauges, cookie=None, timeout=120):
+        self.base_url = base_url
+        self.concurrency = concurrency
+        self.kinds = [kind for kind, weight in sorted(mix.items()) for i in range(weight)]
+        self.gauges = gauges
+        self.cookie = cookie
+        self.timeout = timeout
+        self.latencies = dict((kind, []) for kind in mix)
+        self.statuses = dict((kind, {}) for kind in mix)
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def request(self, kind):
+        request = urllib2.Request(make_url(self.base_url, kind, random.randrange(self.gauges)))
+        if self.cookie:
+            request.add_header('Cookie', self.cookie)
+        started = time.time()
+        size = 0
+        try:
+            response = urllib2.urlopen(request, timeout=self.timeout)
+            size = len(response.read())
+            status = response.getcode()
+        except urllib2.HTTPError as e:
+            status = e.code
+        except Exception as e:
+            status = type(e).__name__
+        elapsed = time.time() - started
+        with self._lock:
+            self.statuses[kind][status] = self.statuses[kind].get(status, 0) + 1
+            if status == 200:
+                self.latencies[kind].append(elapsed)
+            self.bytes += size
+
+    def worker(self, stop_at, remaining):
+        while time.time() < stop_at:
+            with self._lock:
+                if remaining[0] is not None:
+                    if remaining[0] <= 0:
+                        return
+                    remaining[0] -= 1
+            self.request(random.choice(self.kinds))
+
+    def run(self, duration, requests=None):
+        """
+        :param duration: Seconds to run for
+        :param requests: Stop after this many requests, if given
+        :return: The report of the run
+        """
+        started = time.time()
+        remaining = [requests]
+        threads = [threading.Thread(target=self.worker, args=(started + duration, remaining))
+                   for i in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.report(time.time() - started)
+
+    def report(self, elapsed):
+        report = {'seconds': round(elapsed, 2), 'concurrency': self.concurrency, 'bytes': self.bytes, 'kinds': {}}
+        for kind in sorted(self.latencies):
+            latencies = sorted(self.latencies[kind])
+            total = sum(self.statuses[kind].values())
+            report['kinds'][kind] = {
+                'requests': total,
+                'statuses': dict((str(status), count) for status, count in self.statuses[kind].items()),
+                'throughput': round(total / elapsed, 2),
+                'latency_ms': dict((name, round(percentile(latencies, fraction) * 1000, 1) if latencies else None)
+                                   for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p95', 0.95), ('p99', 0.99),
+                                                          ('max', 1.0)))}
+        return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the usgs, ahps and waterml views of a gaugeview app.')
+    parser.add_argument('base_url', help='URL of the app, i.e. http://localhost:8000/apps/gaugeview')
+    parser.add_argument('--concurrency', type=int, default=10, help='requests kept in flight')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to run for')
+    parser.add_argument('--requests', type=int, help='stop after this many requests')
+    parser.add_argument('--gauges', type=int, default=20, help='distinct gauges requested, fewer means more cache hits')
+    parser.add_argument('--mix', type=json.loads, default=DEFAULT_MIX,
+                        help='JSON weights of each kind, i.e. \'{"usgs": 1, "waterml": 1}\'')
+    parser.add_argument('--cookie', help='Cookie header of a logged in session, the pages require a login')
+    parser.add_argument('--timeout', type=float, default=120, help='seconds before a request fails')
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args()
+
+    report = LoadTest(args.base_url, args.concurrency, args.mix, args.gauges, args.cookie,
+                      args.timeout).run(args.duration, args.requests)
+    print('{0:<8} {1:>8} {2:>8} {3:>9} {4:>9} {5:>9} {6:>9} {7:>9}  {8}'.format(
+        'view', 'requests', 'req/s', 'p50 ms', 'p90 ms', 'p95 ms', 'p99 ms', 'max ms', 'statuses'))
+    for kind, result in sorted(report['kinds'].items()):
+        latency = result['latency_ms']
+        print('{0:<8} {1:>8} {2:>8} {3:>9} {4:>9} {5:>9} {6:>9} {7:>9}  {8}'.format(
+            kind, result['requests'], result['throughput'], latency['p50'], latency['p90'], latency['p95'],
+            latency['p99'], latency['max'], json.dumps(result['statuses'], sort_keys=True)))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+"""
+Benchmarks of the parsers, converters and WaterML rendering of the gaugeview controllers, on the fixtures of each
+size. Every benchmark runs in a forked process so its peak memory is measured on its own.
+
+    python -m benchmarks.run --save-baseline         # record the baseline of this machine
+    python -m benchmarks.run                         # everything, compared with benchmarks/baseline.json
+    python -m benchmarks.run --size large -k ahps    # the AHPS benchmarks on the large fixtures
+
+Timings only compare on the machine they were recorded on, so no baseline is committed: record one before changing
+the code. Without a baseline the results are printed and the run exits with status 2, nothing was compared.
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import resource
+import sys
+import time
+
+from django.conf import settings
+
+from .fixtures import SIZES, fixtures
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tethysapp', 'gaugeview',
+                            'templates')
+
+
+def setup_django():
+    """
+    Configure just enough of Django to render the WaterML templates and to keep the users of the upload jobs in an
+    in-memory database, unless a settings module is given
+    """
+    if not settings.configured and 'DJANGO_SETTINGS_MODULE' not in os.environ:
+        settings.configure(TEMPLATES=[{'BACKEND': 'django.template.backends.django.DjangoTemplates',
+                                       'DIRS': [TEMPLATE_DIR]}],
+                           INSTALLED_APPS=['django.contrib.auth', 'django.contrib.contenttypes'],
+                           DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}})
+    import django
+    django.setup()
+
+
+def get_benchmarks(payloads):
+    """
+    :param payloads: The fixtures of one size
+    :return: A list of (name, setup, run). setup() returns the arguments of run, which returns the number of rows it
+    processed. setup is called before every repetition, outside of the timing, so run may modify its arguments.
+    """
+    from django.template.loader import render_to_string
+    from tethysapp.gaugeview import controllers as c
+
+    iv_series = c.convert_usgs_iv_to_python(payloads['iv'])[1]
+    dv_metadata, dv_series = c.convert_usgs_dv_to_python(payloads['dv'])
+    stage_series, flow_series = c.convert_ahps_to_python(payloads['ahps'])
+    utc_strings = [time.strftime('%Y-%m-%d %H:%M:%S') for time in iv_series.datetimes()]
+    metadata = {'GaugeID': '10109000', 'SiteName': 'LOGAN RIVER', 'ReqTime': '2016', 'Lat': '41.74', 'Long': '-111.78',
+                'VarCode': 0, 'VarName': 'Flow', 'UnitName': 'Cubic Feet per Second', 'UnitAbbv': 'cfs'}
+    metadata.update(dv_metadata)
+
+    def utc2custom(strings):
+        for value in strings:
+            c.utc2custom(value, 'US/Mountain')
+        return len(strings)
+
+    def convert_epa_to_comid(responses):
+        # A response is a single point, time a batch of them
+        for data in responses:
+            c.convert_epa_to_comid(data)
+        return len(responses)
+
+    def render(template, time_series):
+        render_to_string(template, {'metadata': metadata, 'time_series': time_series})
+        return len(time_series)
+
+    return [
+        ('convert_usgs_iv_to_python', lambda: (payloads['iv'],),
+         lambda data: len(c.convert_usgs_iv_to_python(data)[1])),
+        ('convert_usgs_dv_to_python', lambda: (payloads['dv'],),
+         lambda data: len(c.convert_usgs_dv_to_python(data)[1])),
+        ('convert_ahps_to_python', lambda: (payloads['ahps'],),
+         lambda data: len(c.convert_ahps_to_python(data)[0])),
+        ('convert_nwm_to_python', lambda: (payloads['nwm'],), lambda data: len(c.convert_nwm_to_python(data))),
+        ('convert_epa_to_comid', lambda: ([payloads['epa']] * 1000,), convert_epa_to_comid),
+        ('format_ahps_ts', lambda: (flow_series,), lambda series: len(c.format_ahps_ts(series, -6)[0])),
+        ('format_ts_usgs_dv', lambda: (dv_series,), lambda series: len(c.format_ts_usgs_dv(series))),
+        ('convert_time_series_timezone', lambda: (iv_series,),
+         lambda series: len(c.convert_time_series_timezone(series, 'Pacific')[0])),
+        ('utc2custom', lambda: (utc_strings,), utc2custom),
+        ('render_usgsdvwaterml', lambda: ('gaugeview/usgsdvwaterml.xml', c.format_ts_usgs_dv(dv_series)), render),
+        ('render_ahpswaterml', lambda: ('gaugeview/ahpswaterml.xml', c.format_ahps_ts(flow_series, -6)[0]),
+         render),
+    ]
+
+
+def peak_memory():
+    """
+    :return: Peak resident memory of this process in bytes
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def measure(setup, run, repeat):
+    """
+    :return: A dict of the rows processed, the best and median seconds, the throughput and the peak memory above the
+    memory in use before the first repetition
+    """
+    gc.collect()
+    args = setup()
+    before = peak_memory()
+    times = []
+    rows = 0
+    for i in range(repeat):
+        if i:
+            args = setup()
+        started = time.time()
+        rows = run(*args)
+        times.append(time.time() - started)
+    times.sort()
+    best = times[0]
+    return {'rows': rows, 'best': best, 'median': times[len(times) // 2],
+            'rows_per_second': rows / best if best else None, 'peak_bytes': peak_memory() - before}
+
+
+def measure_in_child(setup, run, repeat):
+    """
+    Measure in a forked process, so the peak memory of earlier benchmarks doesn't hide the peak of this one
+    """
+    if not hasattr(os, 'fork'):
+        return measure(setup, run, repeat)
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            result = measure(setup, run, repeat)
+        except Exception as e:
+            result = {'error': repr(e)}
+        with os.fdopen(write_fd, 'w') as f:
+            json.dump(result, f)
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        result = json.load(f)
+    os.waitpid(pid, 0)
+    return result
+
+
+def compare(results, baseline, max_regression):
+    """
+    :return: A dict of the ratio of each result's best time to the baseline's, and the names of the results slower
+    than the baseline by more than max_regression
+    """
+    ratios = {}
+    regressions = []
+    for key, result in results.items():
+        reference = baseline.get('results', {}).get(key)
+        if reference is None or 'best' not in result or not reference.get('best'):
+            continue
+        ratios[key] = result['best'] / reference['best']
+        if ratios[key] > 1 + max_regression:
+            regressions.append(key)
+    return ratios, sorted(regressions)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the gaugeview parsers, converters and WaterML rendering.')
+    parser.add_argument('--size', action='append', choices=sorted(SIZES), help='fixture size, may be repeated')
+    parser.add_argument('-k', dest='keyword', help='only run the benchmarks whose name contains this')
+    parser.add_argument('--repeat', type=int, default=5, help='repetitions of each benchmark, the best is kept')
+    parser.add_argument('--baseline', default=BASELINE, help='baseline file to compare with or save to')
+    parser.add_argument('--save-baseline', action='store_true', help='save the results as the new baseline')
+    parser.add_argument('--max-regression', type=float, default=0.15,
+                        help='fraction slower than the baseline that fails the run')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    setup_django()
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    print('{0:<32} {1:<7} {2:>8} {3:>10} {4:>10} {5:>12} {6:>10} {7:>9}'.format(
+        'benchmark', 'size', 'rows', 'best ms', 'median ms', 'rows/s', 'peak KB', 'vs base'))
+    for size in args.size or ['small', 'medium', 'large']:
+        for name, setup, run in get_benchmarks(fixtures(size)):
+            if args.keyword and args.keyword not in name:
+                continue
+            key = '{0}/{1}'.format(size, name)
+            result = measure_in_child(setup, run, args.repeat)
+            results[key] = result
+            if 'error' in result:
+                print('{0:<32} {1:<7} failed: {2}'.format(name, size, result['error']))
+                continue
+            reference = baseline.get('results', {}).get(key, {}).get('best')
+            print('{0:<32} {1:<7} {2:>8} {3:>10.2f} {4:>10.2f} {5:>12.0f} {6:>10.0f} {7:>9}'.format(
+                name, size, result['rows'], result['best'] * 1000, result['median'] * 1000,
+                result['rows_per_second'] or 0, result['peak_bytes'] / 1024.0,
+                '{0:+.0%}'.format(result['best'] / reference - 1) if reference else '-'))
+
+    output = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+              'machine': platform.platform(), 'repeat': args.repeat, 'results': results}
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+        print('saved the baseline to {0}'.format(args.baseline))
+        return 0
+
+    if not baseline:
+        print('no baseline at {0}, nothing was compared: record one with --save-baseline'.format(args.baseline))
+        return 2
+    ratios, regressions = compare(results, baseline, args.max_regression)
+    if regressions:
+        print('slower than the baseline by more than {0:.0%}: {1}'.format(args.max_regression,
+                                                                         ', '.join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -10,7 +10,7 @@ app_class = 'gaugeview.app:UsgsAndAhpsGaugeViewer'
 app_package_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tethysapp', app_package)
 
 ### Python Dependencies ###
-dependencies = []
+dependencies = ['numpy']
 
 setup(
     name=release_package,
@@ -22,7 +22,7 @@ setup(
     author_email='',
     url='',
     license='',
-    packages=find_packages(exclude=['ez_setup', 'examples', 'tests']),
+    packages=find_packages(exclude=['ez_setup', 'examples', 'tests', 'benchmarks']),
     namespace_packages=['tethysapp', 'tethysapp.' + app_package],
     include_package_data=True,
     zip_safe=False,
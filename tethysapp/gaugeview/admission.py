@@ -0,0 +1,132 @@
+import logging
+import threading
+import time
+from functools import wraps
+
+from django.http import HttpResponse
+
+from .config import get_setting
+
+logger = logging.getLogger(__name__)
+
+# Requests of each class built at once per worker process, how many more may wait for a slot and for how long, and
+# the Retry-After sent when they are turned away. Overridable per class with GAUGEVIEW_ADMISSION. Long exports get
+# their own small class so they can't take the slots of the interactive pages.
+VIEW_CLASSES = {
+    'page': {'concurrency': 8, 'queue': 8, 'queue_timeout': 2.0, 'retry_after': 5},
+    'export': {'concurrency': 4, 'queue': 4, 'queue_timeout': 2.0, 'retry_after': 10},
+    'bulk': {'concurrency': 1, 'queue': 2, 'queue_timeout': 0.5, 'retry_after': 60},
+}
+
+
+class Overloaded(Exception):
+    """
+    Too many requests of a class are in progress, the request was not admitted
+    """
+    def __init__(self, view_class, retry_after):
+        super(Overloaded, self).__init__('too many {0} requests in progress'.format(view_class))
+        self.view_class = view_class
+        self.retry_after = retry_after
+
+
+class Gate(object):
+    """
+    Bounded concurrency with a short bounded queue for one class of requests
+    """
+    def __init__(self, name, concurrency, queue, queue_timeout, retry_after):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue = queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._condition = threading.Condition()
+
+    def enter(self):
+        """
+        :raise Overloaded: If the queue is full, or no slot was free within queue_timeout
+        """
+        with self._condition:
+            if self.active < self.concurrency:
+                self.active += 1
+                return
+            if self.waiting >= self.queue:
+                self.rejected += 1
+                raise Overloaded(self.name, self.retry_after)
+            self.waiting += 1
+            give_up_at = time.time() + self.queue_timeout
+            try:
+                while self.active >= self.concurrency:
+                    left = give_up_at - time.time()
+                    if left <= 0:
+                        self.rejected += 1
+                        raise Overloaded(self.name, self.retry_after)
+                    self._condition.wait(left)
+                self.active += 1
+            finally:
+                self.waiting -= 1
+
+    def exit(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+    def __enter__(self):
+        self.enter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.exit()
+
+
+_gates = {}
+_gates_lock = threading.Lock()
+
+
+def get_gate(view_class):
+    """
+    :param view_class: One of the keys of VIEW_CLASSES
+    :return: The gate of that class of requests in this process
+    """
+    with _gates_lock:
+        if view_class not in _gates:
+            options = dict(VIEW_CLASSES[view_class])
+            options.update(get_setting('GAUGEVIEW_ADMISSION', {}).get(view_class, {}))
+            _gates[view_class] = Gate(view_class, **options)
+        return _gates[view_class]
+
+
+def admitted(view_class):
+    """
+    Decorator running a function of a request only once its class has a free slot. Put it under cached_page_context,
+    so pages served from the cache never wait.
+    :param view_class: One of the keys of VIEW_CLASSES, or a function returning one from the request
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(request, *args, **kwargs):
+            name = view_class(request) if callable(view_class) else view_class
+            with get_gate(name):
+                return func(request, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def sheds_load(view):
+    """
+    Decorator answering 503 with a Retry-After header right away when a view's request is not admitted, instead of
+    keeping the user waiting on a busy worker
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        try:
+            return view(request, *args, **kwargs)
+        except Overloaded as e:
+            logger.warning("shedding %s request %s: %s", e.view_class, request.get_full_path(), e)
+            response = HttpResponse('The server is busy, please try again in {0} seconds.'.format(e.retry_after),
+                                    content_type='text/plain', status=503)
+            response['Retry-After'] = str(e.retry_after)
+            return response
+    return wrapper
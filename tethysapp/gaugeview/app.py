@@ -1,4 +1,7 @@
 from tethys_sdk.base import TethysAppBase, url_map_maker
+from tethys_sdk.stores import PersistentStore
+
+from .snapshot import warm_start
 
 
 class GaugeviewerWml(TethysAppBase):
@@ -17,6 +20,11 @@ class GaugeviewerWml(TethysAppBase):
     enable_feedback = False
     feedback_emails = []
 
+    def __init__(self, *args, **kwargs):
+        super(GaugeviewerWml, self).__init__(*args, **kwargs)
+        # Fill the memory cache from the last snapshot so the first requests after a restart are warm
+        warm_start()
+
     def url_maps(self):
         """
         Add controllers
@@ -38,6 +46,38 @@ class GaugeviewerWml(TethysAppBase):
                     UrlMap(name='upload_to_hydroshare',
                            url='gaugeview/upload-to-hydroshare',
                            controller='gaugeview.controllers.upload_to_hydroshare'),
+                    UrlMap(name='upload_status',
+                           url='gaugeview/upload-to-hydroshare/{job_id}',
+                           controller='gaugeview.controllers.upload_status'),
+                    UrlMap(name='publish_batch',
+                           url='gaugeview/publish-batch',
+                           controller='gaugeview.controllers.publish_batch'),
+                    UrlMap(name='publish_batch_status',
+                           url='gaugeview/publish-batch/{batch_id}',
+                           controller='gaugeview.controllers.publish_batch_status'),
+                    UrlMap(name='nearest_gauges',
+                           url='gaugeview/gauges/nearest',
+                           controller='gaugeview.controllers.nearest_gauges'),
+                    UrlMap(name='gauges_geojson',
+                           url='gaugeview/gauges/geojson',
+                           controller='gaugeview.controllers.gauges_geojson'),
+                    UrlMap(name='metrics',
+                           url='gaugeview/metrics',
+                           controller='gaugeview.controllers.metrics_view'),
+                    UrlMap(name='profile',
+                           url='gaugeview/profiles/{name}',
+                           controller='gaugeview.controllers.download_profile'),
                     )
 
         return url_maps
+
+    def persistent_stores(self):
+        """
+        Add one or more persistent stores
+        """
+        stores = (PersistentStore(name='gaugeview_db',
+                                  initializer='gaugeview.init_stores.init_gaugeview_db',
+                                  spatial=False),
+                  )
+
+        return stores
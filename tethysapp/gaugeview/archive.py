@@ -0,0 +1,498 @@
+"""
+Local archive of the NWIS daily values of each gauge, so pages and exports read decades of history from disk instead
+of downloading it again. Each gauge is one memory-mapped file with a value and a qualifier column indexed by day;
+only the days that are not archived yet and the recent provisional values are fetched from NWIS. Backfill gauges, or
+append the latest days of every archived gauge (i.e. from cron), with
+
+    python -m tethysapp.gaugeview.archive ingest 10109000 10105900 --start 1900-01-01
+    python -m tethysapp.gaugeview.archive ingest 10109000 --rdb 10109000.rdb
+    python -m tethysapp.gaugeview.archive update
+"""
+import argparse
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import time
+from array import array
+from datetime import date, datetime, timedelta
+
+from .config import get_setting
+from .series import EPOCH, Series
+
+logger = logging.getLogger(__name__)
+
+# File layout: HEADER, the JSON info (metadata and qualifier codes) padded to info_capacity, then capacity float64
+# values and capacity qualifier bytes in native byte order. Day i of the columns is first_day + i (proleptic
+# Gregorian ordinals); covered_from and covered_to are the days NWIS was asked for, days in between without a value
+# have none upstream either.
+MAGIC = 'GVDVAR01'
+HEADER = struct.Struct('<8sIIIIIIId')  # magic, first_day, count, capacity, covered_from, covered_to, info length,
+                                       # info capacity, refreshed_at
+INFO_CAPACITY = 4096
+# Qualifier of the days without a value
+ABSENT = 255
+# Days of room left at the end of a file when it is rewritten, so a year of appends happens in place
+HEADROOM = 366
+
+EPOCH_DAY = EPOCH.toordinal()
+
+
+def archive_dir():
+    """
+    :return: Directory of the archive, GAUGEVIEW_DV_ARCHIVE_DIR or next to the disk cache directory
+    """
+    path = get_setting('GAUGEVIEW_DV_ARCHIVE_DIR', None)
+    if path is None:
+        from .cache import get_cache
+        path = get_cache().disk.directory.rstrip(os.sep) + '.dv-archive'
+    return path
+
+
+def is_provisional(code):
+    """
+    :param code: NWIS value qualifier, i.e. 'A', 'P' or 'P:e'
+    :return: Whether the value may still be revised
+    """
+    return 'P' in code.split(':')
+
+
+class ArchiveState(object):
+    """
+    Header and info of an archive file
+    """
+    def __init__(self, first_day, count, capacity, covered_from, covered_to, refreshed_at, info, info_capacity):
+        self.first_day = first_day
+        self.count = count
+        self.capacity = capacity
+        self.covered_from = covered_from
+        self.covered_to = covered_to
+        self.refreshed_at = refreshed_at
+        self.info = info
+        self.info_capacity = info_capacity
+
+    @property
+    def values_offset(self):
+        return HEADER.size + self.info_capacity
+
+    @property
+    def codes_offset(self):
+        return self.values_offset + self.capacity * 8
+
+
+class DailyArchive(object):
+    """
+    The archived daily values of one gauge
+    :param gauge_id: USGS gauge id
+    :param directory: Directory of the archive, defaults to archive_dir()
+    """
+    def __init__(self, gauge_id, directory=None):
+        self.gauge_id = gauge_id
+        directory = directory or archive_dir()
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another worker created it
+                pass
+        self.path = os.path.join(directory, '{0}.dv'.format(''.join(c for c in gauge_id if c.isalnum())))
+
+    def _map(self):
+        """
+        :return: A read only map of the file, or None if there is none
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _state(data):
+        magic, first_day, count, capacity, covered_from, covered_to, info_length, info_capacity, refreshed_at = \
+            HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ValueError('not a daily values archive')
+        info = json.loads(data[HEADER.size:HEADER.size + info_length])
+        return ArchiveState(first_day, count, capacity, covered_from, covered_to, refreshed_at, info, info_capacity)
+
+    def state(self):
+        """
+        :return: The ArchiveState of the file, or None if the gauge is not archived
+        """
+        data = self._map()
+        if data is None:
+            return None
+        try:
+            return self._state(data)
+        except (ValueError, struct.error):
+            logger.warning("ignoring the corrupt archive %s", self.path)
+            return None
+        finally:
+            data.close()
+
+    def read(self, start, end):
+        """
+        :param start: First day (date)
+        :param end: Last day (date)
+        :return: The metadata of the gauge and a Series of its archived values from start to end, or None if the gauge
+        is not archived
+        """
+        data = self._map()
+        if data is None:
+            return None
+        try:
+            state = self._state(data)
+            first = max(start.toordinal(), state.first_day) - state.first_day
+            last = min(end.toordinal(), state.first_day + state.count - 1) - state.first_day
+            values = array('d')
+            codes = array('B')
+            if first <= last:
+                values.fromstring(data[state.values_offset + first * 8:state.values_offset + (last + 1) * 8])
+                codes.fromstring(data[state.codes_offset + first:state.codes_offset + last + 1])
+        except (ValueError, struct.error):
+            logger.warning("ignoring the corrupt archive %s", self.path)
+            return None
+        finally:
+            data.close()
+
+        series = Series(dict(state.info['series']), codes=list(state.info['codes']))
+        day = state.first_day + first
+        for index, code in enumerate(codes):
+            if code != ABSENT:
+                series.times.append((day + index - EPOCH_DAY) * 86400.0)
+                series.values.append(values[index])
+                series.qualifiers.append(code)
+        series.offsets = array('h', [0]) * len(series)
+        return dict(state.info['metadata']), series
+
+    def columns(self):
+        """
+        :return: The first day (ordinal), the value column and the qualifier column of all the archived days, days
+        without a value having the ABSENT qualifier, or None if the gauge is not archived
+        """
+        data = self._map()
+        if data is None:
+            return None
+        try:
+            state = self._state(data)
+            values = array('d', data[state.values_offset:state.values_offset + state.count * 8])
+            codes = array('B', data[state.codes_offset:state.codes_offset + state.count])
+        except (ValueError, struct.error):
+            logger.warning("ignoring the corrupt archive %s", self.path)
+            return None
+        finally:
+            data.close()
+        return state.first_day, values, codes
+
+    def provisional_from(self, state=None, max_days=None):
+        """
+        :param state: The ArchiveState, read from the file if not given
+        :param max_days: Provisional values older than this many days before the last covered day are left alone,
+        defaults to GAUGEVIEW_DV_PROVISIONAL_DAYS
+        :return: The ordinal of the earliest recent provisional value, or the day after the covered days if there is
+        none
+        """
+        state = state or self.state()
+        if max_days is None:
+            max_days = get_setting('GAUGEVIEW_DV_PROVISIONAL_DAYS', 400)
+        provisional = set(index for index, code in enumerate(state.info['codes']) if is_provisional(code))
+        if not provisional or not state.count:
+            return state.covered_to + 1
+        data = self._map()
+        try:
+            first = max(0, state.covered_to - max_days - state.first_day)
+            codes = array('B', data[state.codes_offset + first:state.codes_offset + state.count])
+        finally:
+            data.close()
+        for index, code in enumerate(codes):
+            if code in provisional:
+                return state.first_day + first + index
+        return state.covered_to + 1
+
+    def missing(self, start, end, refresh_interval=None, now=None):
+        """
+        :param start: First day (date) of a range query
+        :param end: Last day (date) of the query, no later than today
+        :param refresh_interval: Seconds after which the provisional values are refreshed, defaults to the TTL of the
+        'dv' source
+        :param now: Unix time, defaults to time.time()
+        :return: A list of the (first day, last day) windows to fetch from NWIS before answering the query
+        """
+        state = self.state()
+        if state is None:
+            return [(start, end)]
+        if refresh_interval is None:
+            from .cache import source_ttl
+            refresh_interval = source_ttl('dv')
+        now = now if now is not None else time.time()
+
+        windows = []
+        start_day = start.toordinal()
+        end_day = end.toordinal()
+        if start_day < state.covered_from:
+            # Up to the covered days, so the covered days stay contiguous
+            windows.append((start_day, state.covered_from - 1))
+        tail_from = state.covered_to + 1
+        if now - state.refreshed_at >= refresh_interval:
+            tail_from = min(tail_from, self.provisional_from(state))
+        tail_from = max(tail_from, min(start_day, state.covered_to + 1))
+        if tail_from <= end_day:
+            windows.append((tail_from, end_day))
+        return [(date.fromordinal(first), date.fromordinal(last)) for first, last in windows]
+
+    def write(self, metadata, series, start, end, refreshed=True):
+        """
+        Store what NWIS returned for a window, replacing the archived values of those days
+        :param metadata: The metadata returned by convert_usgs_dv_to_python
+        :param series: The Series returned by convert_usgs_dv_to_python
+        :param start: First day (date) NWIS was asked for
+        :param end: Last day (date) NWIS was asked for
+        :param refreshed: Whether this is a fresh answer of NWIS, as opposed to a stale copy
+        """
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self._write(metadata, series, start.toordinal(), end.toordinal(), refreshed)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _write(self, metadata, series, start_day, end_day, refreshed):
+        state = self.state()
+        if state is None:
+            state = ArchiveState(start_day, 0, 0, start_day, end_day, 0.0,
+                                 {'metadata': {}, 'series': {}, 'codes': []}, INFO_CAPACITY)
+        info = state.info
+        info['metadata'].update(metadata)
+        info['series'].update(series.metadata)
+        codes = info['codes']
+        remap = []
+        for code in series.codes:
+            if code not in codes:
+                codes.append(code)
+            remap.append(codes.index(code))
+        # NWIS may answer with days outside the window asked for, those are not known to be complete and are left out
+        rows = [(day, value, qualifier) for day, value, qualifier in
+                zip([int(seconds // 86400) + EPOCH_DAY for seconds in series.times], series.values, series.qualifiers)
+                if start_day <= day <= end_day]
+        days = [row[0] for row in rows]
+
+        # The columns span the days with values
+        first_day = state.first_day if state.count else None
+        last_day = state.first_day + state.count - 1 if state.count else None
+        if days:
+            first_day = min(days) if first_day is None else min(first_day, min(days))
+            last_day = max(days) if last_day is None else max(last_day, max(days))
+        if first_day is None:
+            first_day = last_day = start_day
+            count = 0
+        else:
+            count = last_day - first_day + 1
+
+        covered_from = min(state.covered_from, start_day)
+        covered_to = max(state.covered_to, end_day)
+        refreshed_at = time.time() if refreshed else state.refreshed_at
+        info_bytes = json.dumps(info)
+        if len(codes) >= ABSENT:
+            raise ValueError('too many qualifier codes in the archive of {0}'.format(self.gauge_id))
+
+        # Columns of the days the window touches
+        window_first = max(start_day, first_day)
+        window_last = min(end_day, last_day)
+        values = array('d', [float('nan')]) * max(0, window_last - window_first + 1)
+        qualifiers = array('B', [ABSENT]) * len(values)
+        for day, value, qualifier in rows:
+            values[day - window_first] = value
+            qualifiers[day - window_first] = remap[qualifier]
+
+        fits = (state.count and first_day == state.first_day and count <= state.capacity and
+                len(info_bytes) <= state.info_capacity)
+        if fits:
+            self._update(state, count, covered_from, covered_to, refreshed_at, info_bytes, window_first, values,
+                         qualifiers)
+        else:
+            self._rewrite(state, first_day, count, covered_from, covered_to, refreshed_at, info_bytes, window_first,
+                          values, qualifiers)
+
+    def _update(self, state, count, covered_from, covered_to, refreshed_at, info_bytes, window_first, values,
+                qualifiers):
+        """
+        Write the window into the mapped file, then the header, so readers see the new count once the values are
+        there
+        """
+        offset = window_first - state.first_day
+        with open(self.path, 'r+b') as f:
+            data = mmap.mmap(f.fileno(), 0)
+            try:
+                if len(values):
+                    start = state.values_offset + offset * 8
+                    data[start:start + len(values) * 8] = values.tostring()
+                    start = state.codes_offset + offset
+                    data[start:start + len(qualifiers)] = qualifiers.tostring()
+                # Days appended after a gap have no value
+                for day in range(state.count, offset):
+                    struct.pack_into('d', data, state.values_offset + day * 8, float('nan'))
+                    data[state.codes_offset + day] = chr(ABSENT)
+                data[HEADER.size:HEADER.size + len(info_bytes)] = info_bytes
+                HEADER.pack_into(data, 0, MAGIC, state.first_day, count, state.capacity, covered_from, covered_to,
+                                 len(info_bytes), state.info_capacity, refreshed_at)
+                data.flush()
+            finally:
+                data.close()
+
+    def _rewrite(self, state, first_day, count, covered_from, covered_to, refreshed_at, info_bytes, window_first,
+                 values, qualifiers):
+        """
+        Write a new file with room to grow and rename it over the old one. Readers that mapped the old file keep
+        reading it.
+        """
+        all_values = array('d', [float('nan')]) * count
+        all_qualifiers = array('B', [ABSENT]) * count
+        if state.count:
+            old = self.read(date.fromordinal(state.first_day), date.fromordinal(state.first_day + state.count - 1))
+            if old is not None:
+                codes = json.loads(info_bytes)['codes']
+                remap = [codes.index(code) for code in old[1].codes]
+                for seconds, value, qualifier in zip(old[1].times, old[1].values, old[1].qualifiers):
+                    index = int(seconds // 86400) + EPOCH_DAY - first_day
+                    all_values[index] = value
+                    all_qualifiers[index] = remap[qualifier]
+        offset = window_first - first_day
+        all_values[offset:offset + len(values)] = values
+        all_qualifiers[offset:offset + len(qualifiers)] = qualifiers
+
+        capacity = count + HEADROOM
+        info_capacity = max(INFO_CAPACITY, 2 * len(info_bytes))
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, first_day, count, capacity, covered_from, covered_to, len(info_bytes),
+                                    info_capacity, refreshed_at))
+                f.write(info_bytes.ljust(info_capacity, ' '))
+                f.write(all_values.tostring())
+                f.write(array('d', [float('nan')]).tostring() * (capacity - count))
+                f.write(all_qualifiers.tostring())
+                f.write(chr(ABSENT) * (capacity - count))
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def ingest(self, rdb, start, end, refreshed=True):
+        """
+        :param rdb: NWIS dv RDB document of the days from start to end
+        :return: The number of values stored
+        """
+        # The controllers use this module to read the archive
+        from .controllers import convert_usgs_dv_to_python
+
+        metadata, series = convert_usgs_dv_to_python(rdb)
+        self.write(metadata, series, start, end, refreshed)
+        return len(series)
+
+
+def archived_gauges(directory=None):
+    """
+    :return: The ids of the archived gauges
+    """
+    directory = directory or archive_dir()
+    if not os.path.isdir(directory):
+        return []
+    return sorted(name[:-3] for name in os.listdir(directory) if name.endswith('.dv'))
+
+
+def backfill(gauge_id, start, end, chunk_days=None):
+    """
+    Fetch the daily values of a gauge from NWIS into the archive, a chunk of years at a time
+    :param gauge_id: USGS gauge id
+    :param start: First day (date)
+    :param end: Last day (date)
+    :param chunk_days: Days fetched per request, defaults to GAUGEVIEW_DV_INGEST_CHUNK_DAYS
+    :return: The number of values stored
+    """
+    from .controllers import get_usgs_dv_data
+
+    chunk_days = chunk_days or get_setting('GAUGEVIEW_DV_INGEST_CHUNK_DAYS', 20 * 365)
+    archive = DailyArchive(gauge_id)
+    stored = 0
+    # Newest first, so an interrupted backfill still leaves the covered days contiguous
+    chunk_end = end
+    while chunk_end >= start:
+        chunk_start = max(start, chunk_end - timedelta(days=chunk_days - 1))
+        stored += archive.ingest(get_usgs_dv_data.refresh(gauge_id, chunk_start.isoformat(), chunk_end.isoformat()),
+                                 chunk_start, chunk_end)
+        chunk_end = chunk_start - timedelta(days=1)
+    return stored
+
+
+def update(gauge_id, today=None):
+    """
+    Append the days since the last update of an archived gauge and refresh its provisional values
+    :return: The number of values stored
+    """
+    from .controllers import get_usgs_dv_data
+
+    today = today or date.today()
+    archive = DailyArchive(gauge_id)
+    state = archive.state()
+    if state is None:
+        return 0
+    start = date.fromordinal(min(archive.provisional_from(state), state.covered_to + 1))
+    if start > today:
+        return 0
+    return archive.ingest(get_usgs_dv_data.refresh(gauge_id, start.isoformat(), today.isoformat()), start, today)
+
+
+def _parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the local archive of NWIS daily values.')
+    commands = parser.add_subparsers(dest='command')
+    ingest = commands.add_parser('ingest', help='backfill gauges from NWIS, or from a downloaded RDB file')
+    ingest.add_argument('gauges', nargs='+', help='USGS gauge ids')
+    ingest.add_argument('--start', type=_parse_date, default=date(1900, 1, 1), help='first day, YYYY-MM-DD')
+    ingest.add_argument('--end', type=_parse_date, default=date.today(), help='last day, YYYY-MM-DD')
+    ingest.add_argument('--rdb', help='NWIS dv RDB file of the days from --start to --end, for a single gauge')
+    commands.add_parser('update', help='append the latest days of every archived gauge')
+    show = commands.add_parser('show', help='print what is archived of gauges')
+    show.add_argument('gauges', nargs='*', help='USGS gauge ids, all archived gauges if none')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'ingest':
+        if args.rdb:
+            if len(args.gauges) != 1:
+                parser.error('--rdb holds the values of a single gauge')
+            with open(args.rdb) as f:
+                stored = DailyArchive(args.gauges[0]).ingest(f.read(), args.start, args.end, refreshed=False)
+            print('{0}: {1} values'.format(args.gauges[0], stored))
+            return
+        for gauge_id in args.gauges:
+            print('{0}: {1} values'.format(gauge_id, backfill(gauge_id, args.start, args.end)))
+    elif args.command == 'update':
+        for gauge_id in archived_gauges():
+            try:
+                print('{0}: {1} values'.format(gauge_id, update(gauge_id)))
+            except Exception:
+                logger.exception("could not update the archive of %s", gauge_id)
+    else:
+        for gauge_id in args.gauges or archived_gauges():
+            state = DailyArchive(gauge_id).state()
+            if state is None:
+                print('{0}: not archived'.format(gauge_id))
+                continue
+            print('{0}: {1} days from {2}, covers {3} to {4}, refreshed {5}'.format(
+                gauge_id, state.count, date.fromordinal(state.first_day), date.fromordinal(state.covered_from),
+                date.fromordinal(state.covered_to),
+                datetime.fromtimestamp(state.refreshed_at).strftime('%Y-%m-%d %H:%M') if state.refreshed_at else
+                'never'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,468 @@
+import cPickle as pickle
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from functools import wraps
+
+from . import profiling, timing
+from .config import get_setting
+from .upstream import is_upstream_failure
+
+logger = logging.getLogger(__name__)
+
+# How long (seconds) data from each upstream source stays fresh. These can be overridden with the
+# GAUGEVIEW_CACHE_TTLS setting, i.e. {'iv': 300}.
+SOURCE_TTLS = {
+    'iv': 15 * 60,         # NWIS instantaneous values are published every 15 minutes
+    'dv': 6 * 60 * 60,     # NWIS daily values only change once a day
+    'ahps': 15 * 60,       # AHPS observations and forecasts
+    'nwm': 60 * 60,        # NWM short range cycles are issued hourly
+    'comid': 30 * 24 * 60 * 60,  # The NHD flowline nearest a gauge practically never changes
+}
+
+
+class StaleData(str):
+    """
+    Data served from the cache after its TTL because its upstream service is failing
+    :param data: The cached data
+    :param fetched_at: Unix time the data was fetched
+    """
+    def __new__(cls, data, fetched_at):
+        stale = str.__new__(cls, data)
+        stale.fetched_at = fetched_at
+        return stale
+
+
+class CacheStats(object):
+    """
+    Hit, miss and eviction counters of a cache, per region (the source or kind of the cached value)
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def incr(self, region, name, value=1):
+        with self._lock:
+            counts = self._counts.setdefault(region, {'hits': 0, 'misses': 0, 'evictions': 0})
+            counts[name] = counts.get(name, 0) + value
+
+    def as_dict(self):
+        with self._lock:
+            return dict((region, dict(counts)) for region, counts in self._counts.items())
+
+
+class MemoryCache(object):
+    """
+    In-process LRU cache bounded by the size of the serialized values it holds
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        self._items = OrderedDict()  # key: (expires, region, payload, hits)
+
+    def get(self, key):
+        """
+        :param key: Cache key
+        :return: The serialized value, or None if it is missing or expired
+        """
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None:
+                return None
+            if item[0] < time.time():
+                self.size -= len(item[2])
+                return None
+            # Re-inserting moves the key to the most recently used end
+            self._items[key] = (item[0], item[1], item[2], item[3] + 1)
+            return item[2]
+
+    def set(self, key, payload, expires, region):
+        """
+        :param key: Cache key
+        :param payload: The serialized value
+        :param expires: Unix time after which the value is stale
+        :param region: Region the value is counted in for the eviction statistics
+        """
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= len(old[2])
+            # Too big to keep, but the older value must not shadow it either
+            if len(payload) > self.max_bytes:
+                return
+            self._items[key] = (expires, region, payload, 0)
+            self.size += len(payload)
+            while self.size > self.max_bytes:
+                evicted_key, evicted = self._items.popitem(last=False)
+                self.size -= len(evicted[2])
+                self.stats.incr(evicted[1], 'evictions')
+
+    def delete(self, key):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is not None:
+                self.size -= len(item[2])
+
+    def hottest(self):
+        """
+        :return: A list of (key, expires, region, payload) of the unexpired values, most hit first, ties broken by the
+        most recently used
+        """
+        now = time.time()
+        with self._lock:
+            items = [(hits, position, key, expires, region, payload)
+                     for position, (key, (expires, region, payload, hits)) in enumerate(self._items.items())
+                     if expires >= now]
+        items.sort(reverse=True)
+        return [item[2:] for item in items]
+
+
+class DiskCache(object):
+    """
+    Cache of files in a directory, shared by all the worker processes of a host. Files are written to a temporary
+    name and renamed so readers never see a partial file. The least recently read files are removed once the
+    directory grows beyond max_bytes.
+    """
+    # The directory is only scanned for eviction every this many writes
+    EVICTION_INTERVAL = 200
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.stats = CacheStats()
+        self._writes = 0
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another worker created it first
+                pass
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.md5(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        """
+        :param key: Cache key
+        :return: A tuple of the expiry time, region and serialized value, or None if the key is not cached
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                expires, region = pickle.load(f)
+                payload = f.read()
+            # The access time drives eviction, and atime is often disabled on servers
+            os.utime(path, None)
+        except (IOError, OSError, EOFError, ValueError, pickle.UnpicklingError):
+            return None
+        return expires, region, payload
+
+    def set(self, key, payload, expires, region):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((expires, region), f, pickle.HIGHEST_PROTOCOL)
+                f.write(payload)
+            os.rename(tmp_path, self._path(key))
+        except (IOError, OSError):
+            logger.exception("could not write cache file for %s", key)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        self._writes += 1
+        if self._writes % self.EVICTION_INTERVAL == 0:
+            self.evict()
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def evict(self):
+        """
+        Remove the least recently read files until the directory is under 90% of max_bytes
+        """
+        files = []
+        total = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        files.sort()
+        for mtime, size, path in files:
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self.stats.incr('disk', 'evictions')
+        logger.debug("disk cache holds %d bytes after eviction", total)
+
+
+class TieredCache(object):
+    """
+    Values are looked up in the memory tier of this process first, then in the disk tier shared by all workers.
+    Values are pickled once, the same bytes are kept in both tiers and every get returns a fresh copy, so callers
+    may modify what they get.
+    """
+    def __init__(self, memory, disk):
+        self.memory = memory
+        self.disk = disk
+        self.stats = CacheStats()
+        self.started_at = time.time()
+        self.first_hit_at = None
+
+    def get(self, key, region='default', shared=False):
+        """
+        :param key: Cache key
+        :param region: Region the lookup is counted in
+        :param shared: Skip the memory tier, for values other workers may change (i.e. counters)
+        :return: The cached value, or None
+        """
+        payload = None if shared else self.memory.get(key)
+        if payload is None:
+            item = self.disk.get(key)
+            if item is not None and item[0] >= time.time():
+                payload = item[2]
+                if not shared:
+                    self.memory.set(key, payload, item[0], region)
+
+        if payload is None:
+            self.stats.incr(region, 'misses')
+            return None
+        self.stats.incr(region, 'hits')
+        if self.first_hit_at is None:
+            self.first_hit_at = time.time()
+            logger.info("first cache hit %.3f s after the cache was created", self.first_hit_at - self.started_at)
+        return pickle.loads(payload)
+
+    def set(self, key, value, ttl, region='default', shared=False):
+        """
+        :param key: Cache key
+        :param value: Any picklable value, None can't be cached
+        :param ttl: Time to live in seconds
+        :param region: Region the value is counted in
+        :param shared: Only keep the value in the disk tier
+        """
+        payload = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        expires = time.time() + ttl
+        if not shared:
+            self.memory.set(key, payload, expires, region)
+        self.disk.set(key, payload, expires, region)
+
+    def delete(self, key):
+        self.memory.delete(key)
+        self.disk.delete(key)
+
+    def get_stats(self):
+        """
+        :return: Hits and misses per region, evictions per tier, the bytes held in memory and how long after startup
+        the first hit happened
+        """
+        if self.first_hit_at is None:
+            seconds_to_first_hit = None
+        else:
+            seconds_to_first_hit = self.first_hit_at - self.started_at
+        return {'regions': self.stats.as_dict(),
+                'memory_evictions': self.memory.stats.as_dict(),
+                'disk_evictions': self.disk.stats.as_dict(),
+                'memory_bytes': self.memory.size,
+                'seconds_to_first_hit': seconds_to_first_hit}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    :return: The cache of this process, created from the GAUGEVIEW_CACHE_* settings on first use
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                directory = get_setting('GAUGEVIEW_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'gaugeview-cache'))
+                memory = MemoryCache(get_setting('GAUGEVIEW_CACHE_MEMORY_BYTES', 64 * 1024 * 1024))
+                disk = DiskCache(directory, get_setting('GAUGEVIEW_CACHE_DISK_BYTES', 1024 * 1024 * 1024))
+                _cache = TieredCache(memory, disk)
+    return _cache
+
+
+def source_ttl(source):
+    """
+    :param source: One of the keys of SOURCE_TTLS
+    :return: The time to live in seconds for data from that source
+    """
+    ttls = dict(SOURCE_TTLS)
+    ttls.update(get_setting('GAUGEVIEW_CACHE_TTLS', {}))
+    return ttls[source]
+
+
+def page_ttl(sources):
+    """
+    A page is only as fresh as the shortest lived source shown on it
+    :param sources: The sources a page is built from
+    :return: The time to live in seconds for the page
+    """
+    return min(source_ttl(source) for source in sources)
+
+
+def cached_source(source):
+    """
+    Decorator for the functions fetching data from an upstream service. Results are cached by the function's
+    arguments for the TTL of the source. They are kept GAUGEVIEW_STALE_TTL seconds longer, and returned as StaleData
+    when fetching fails because the upstream service is unhealthy. The decorated function gets a refresh(*args)
+    attribute that fetches and caches the data even if it is still fresh.
+    :param source: One of the keys of SOURCE_TTLS
+    """
+    def decorator(func):
+        def make_key(args):
+            return u'gaugeview:{0}:{1}:{2}'.format(source, func.__name__, u':'.join(unicode(arg) for arg in args))
+
+        def refresh(*args):
+            data = func(*args)
+            ttl = source_ttl(source) + get_setting('GAUGEVIEW_STALE_TTL', 24 * 60 * 60)
+            get_cache().set(make_key(args), (time.time(), data), ttl, source)
+            return data
+
+        @wraps(func)
+        def wrapper(*args):
+            with timing.stage(source):
+                item = get_cache().get(make_key(args), source)
+                if item is not None and time.time() - item[0] < source_ttl(source):
+                    return item[1]
+                try:
+                    return refresh(*args)
+                except Exception as e:
+                    if item is None or not is_upstream_failure(e):
+                        raise
+                    logger.warning("serving stale %s data for %s: %s", source, args, e)
+                    return StaleData(item[1], item[0])
+        wrapper.refresh = refresh
+        return wrapper
+    return decorator
+
+
+def _generation_key(gauge_id):
+    return 'gaugeview:generation:{0}'.format(gauge_id.strip().upper())
+
+
+def get_generation(gauge_id):
+    """
+    :param gauge_id: USGS or AHPS gauge id
+    :return: The current data generation of the gauge. It is part of every page and series key, so bumping it
+    invalidates them.
+    """
+    return get_cache().get(_generation_key(gauge_id), 'generation', shared=True) or 0
+
+
+def invalidate_gauge(gauge_id):
+    """
+    Called when the data of a gauge is refreshed ahead of its expiry (i.e. by the prefetcher), so that neither stale
+    series nor stale pages of that gauge are served again
+    :param gauge_id: USGS or AHPS gauge id
+    """
+    # Any value other than the current one will do, the time keeps it unique across workers
+    get_cache().set(_generation_key(gauge_id), time.time(), source_ttl('comid'), 'generation', shared=True)
+
+
+def page_cache_key(view_name, query, params, gauge_param, now=None):
+    """
+    Build a key from the canonicalized query parameters of a page request
+    :param view_name: Name of the view (i.e. 'ahps')
+    :param query: The request's GET QueryDict
+    :param params: Names of the query parameters the view reads
+    :param gauge_param: Name of the parameter holding the gauge id
+    :param now: Datetime used for pages whose defaults depend on the current hour (defaults to datetime.now())
+    :return: A key that is identical for identical requests
+    """
+    if now is None:
+        now = datetime.now()
+    gauge_id = query.get(gauge_param, '').strip().upper()
+    parts = [view_name, gauge_id, repr(get_generation(gauge_id))]
+    for name in sorted(params):
+        value = query.get(name)
+        if value is not None:
+            value = value.strip()
+            if name == gauge_param:
+                value = value.upper()
+            parts.append(u'{0}={1}'.format(name, value))
+    # Initial requests and forecast defaults are derived from the current time
+    parts.append(now.strftime('%Y%m%d%H'))
+    digest = hashlib.md5(u'&'.join(parts).encode('utf-8')).hexdigest()
+    return 'gaugeview:page:{0}:{1}'.format(view_name, digest)
+
+
+def cached_page_context(view_name, gauge_param, params, sources):
+    """
+    Decorator for functions that build the template context of a page from a request. The context (plots and gizmos)
+    is cached instead of the rendered html, because the html carries the user's session and csrf token. Profiled
+    requests (see profiling.may_profile) skip the lookup, so the profile covers building the page.
+    :param view_name: Name of the view, used to namespace keys
+    :param gauge_param: Name of the query parameter holding the gauge id
+    :param params: Names of the query parameters the page depends on
+    :param sources: Data sources the page is built from, used to derive its time to live
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(request):
+            key = page_cache_key(view_name, request.GET, params, gauge_param)
+            cache = get_cache()
+            context = cache.get(key, 'page') if not profiling.may_profile(request) else None
+            if context is not None:
+                logger.debug("page cache hit: %s", key)
+                return context
+
+            context = func(request)
+            # Don't keep pages where the forecast could not be retrieved, or stale or missing data is shown, the next
+            # request should try again
+            if not (context.get('forecast_failed') or context.get('stale_data') or context.get('incomplete_data')):
+                cache.set(key, context, page_ttl(sources), 'page')
+            return context
+        return wrapper
+    return decorator
+
+
+def cached_series(view_name, gauge_id, params, sources, fetch):
+    """
+    Short lived cache of the UTC series shown on a page. Its key leaves out how the series are displayed (i.e. the
+    timezone), so changing only those options re-renders the page without going back to the upstream services.
+    :param view_name: Name of the view, used to namespace keys
+    :param gauge_id: USGS or AHPS gauge id
+    :param params: Dict of everything that determines which data is fetched
+    :param sources: Data sources that are fetched, used to derive the time to live
+    :param fetch: Function without arguments returning a dict of the series
+    :return: The dict returned by fetch, possibly from an earlier call
+    """
+    parts = [gauge_id.strip().upper(), repr(get_generation(gauge_id))]
+    parts.extend(u'{0}={1}'.format(name, params[name]) for name in sorted(params))
+    digest = hashlib.md5(u'&'.join(parts).encode('utf-8')).hexdigest()
+    key = 'gaugeview:series:{0}:{1}'.format(view_name, digest)
+    cache = get_cache()
+    series = cache.get(key, 'series')
+    if series is not None:
+        logger.debug("series cache hit: %s", key)
+        return series
+
+    series = fetch()
+    if not (series.get('forecast_failed') or series.get('stale') or series.get('incomplete')):
+        ttl = min(page_ttl(sources), get_setting('GAUGEVIEW_SERIES_TTL', 10 * 60))
+        cache.set(key, series, ttl, 'series')
+    return series
@@ -0,0 +1,373 @@
+"""
+Catalog of the AHPS and USGS gauges in the gaugeview persistent store, so map clicks are answered locally instead of
+with WMS GetFeatureInfo requests to the gauge layers. The gauges are loaded from the ArcGIS layers behind those WMS
+services, and indexed by grid cell for the nearest gauge queries. Reload it (i.e. weekly from cron) with
+
+    python -m tethysapp.gaugeview.catalog refresh
+    python -m tethysapp.gaugeview.catalog refresh --kind usgs --resolve-comids
+"""
+import argparse
+import json
+import logging
+import math
+import threading
+import time
+import urllib
+from multiprocessing.pool import ThreadPool
+
+from . import upstream
+from .cache import get_cache, source_ttl
+from .config import get_setting, upstream_url
+
+logger = logging.getLogger(__name__)
+
+# ArcGIS layers of each kind of gauge, and the name of their fields (the attributes of the WMS GetFeatureInfo answers)
+CATALOG_LAYERS = {
+    'ahps': {'layer': '/arcgis/rest/services/gaugeviewer/AHPS_gauges/MapServer/0',
+             'fields': {'gauge_id': 'GaugeLID', 'waterbody': 'Waterbody', 'url': 'URL', 'latitude': 'Latitude',
+                        'longitude': 'Longitude'}},
+    'usgs': {'layer': '/arcgis/rest/services/gaugeviewer/USGS_gauges/MapServer/0',
+             'fields': {'gauge_id': 'STAID', 'waterbody': 'STANAME', 'url': 'NWISWEB', 'latitude': 'LAT_GAGE',
+                        'longitude': 'LNG_GAGE'}},
+}
+
+# Size of the cells of the grid index, in degrees
+CELL_DEGREES = 0.5
+# Records asked for per page of a layer query
+PAGE_SIZE = 1000
+EARTH_RADIUS_KM = 6371.0
+
+# Zoom levels (of the 256 pixel Web Mercator tile pyramid) up to which the map gets clusters instead of gauges, and
+# the size in pixels of the grid cells whose gauges are merged into one cluster
+CLUSTER_MAX_ZOOM = 9
+CLUSTER_PIXELS = 40
+WEB_MERCATOR_RADIUS = 6378137.0
+
+# Changed whenever the catalog is, so every worker rebuilds its clusters
+VERSION_KEY = 'gaugeview:catalog:version'
+
+_clusters = {'version': None, 'levels': None}
+_clusters_lock = threading.Lock()
+
+
+def grid_cell(latitude, longitude):
+    """
+    :return: The (cell_x, cell_y) of the grid cell holding the point
+    """
+    return int(math.floor(longitude / CELL_DEGREES)), int(math.floor(latitude / CELL_DEGREES))
+
+
+def distance_km(latitude1, longitude1, latitude2, longitude2):
+    """
+    :return: The great circle distance between two points, in kilometers
+    """
+    phi1 = math.radians(latitude1)
+    phi2 = math.radians(latitude2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2 +
+         math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(longitude2 - longitude1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def fetch_layer(kind):
+    """
+    Query every gauge of a layer, a page at a time
+    :param kind: One of the keys of CATALOG_LAYERS
+    :return: A list of dicts of the gauge_id, waterbody, url, latitude and longitude of the gauges
+    """
+    layer = CATALOG_LAYERS[kind]
+    fields = layer['fields']
+    gauges = []
+    offset = 0
+    while True:
+        query = urllib.urlencode([('where', '1=1'), ('outFields', ','.join(sorted(fields.values()))),
+                                  ('returnGeometry', 'false'), ('resultOffset', offset),
+                                  ('resultRecordCount', PAGE_SIZE), ('f', 'json')])
+        response = json.loads(upstream.get('gaugeviewer', '{0}{1}/query?{2}'.format(
+            upstream_url('gaugeviewer'), layer['layer'], query)))
+        if 'error' in response:
+            raise upstream.UpstreamError('gaugeviewer query failed: {0}'.format(response['error'].get('message')))
+        for feature in response.get('features', []):
+            attributes = feature['attributes']
+            try:
+                gauge = dict((name, attributes[field]) for name, field in fields.items())
+                gauge['latitude'] = float(gauge['latitude'])
+                gauge['longitude'] = float(gauge['longitude'])
+            except (KeyError, TypeError, ValueError):
+                logger.warning("skipping the %s gauge without a location: %s", kind, attributes)
+                continue
+            gauge['gauge_id'] = unicode(gauge['gauge_id']).strip()
+            gauges.append(gauge)
+        if not response.get('exceededTransferLimit'):
+            return gauges
+        offset += len(response.get('features', []))
+
+
+def refresh_catalog(kinds=None):
+    """
+    Replace the gauges of the catalog with the ones of the layers, keeping the COMIDs already resolved
+    :param kinds: Keys of CATALOG_LAYERS to refresh, all of them by default
+    :return: A dict of the number of gauges loaded of each kind
+    """
+    from .model import Gauge, SessionMaker
+
+    counts = {}
+    for kind in kinds or sorted(CATALOG_LAYERS):
+        gauges = fetch_layer(kind)
+        session = SessionMaker()
+        try:
+            comids = dict(session.query(Gauge.gauge_id, Gauge.comid).filter(Gauge.kind == kind,
+                                                                              Gauge.comid.isnot(None)))
+            session.query(Gauge).filter(Gauge.kind == kind).delete(synchronize_session=False)
+            seen = set()
+            for gauge in gauges:
+                # The layers list a few gauges twice
+                if gauge['gauge_id'] in seen:
+                    continue
+                seen.add(gauge['gauge_id'])
+                cell_x, cell_y = grid_cell(gauge['latitude'], gauge['longitude'])
+                session.add(Gauge(kind=kind, comid=comids.get(gauge['gauge_id']), cell_x=cell_x, cell_y=cell_y,
+                                  **gauge))
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        counts[kind] = len(seen)
+        logger.info("loaded %d %s gauges into the catalog", len(seen), kind)
+    bump_version()
+    return counts
+
+
+def catalog_version():
+    """
+    :return: The version of the catalog, shared by the workers
+    """
+    return get_cache().get(VERSION_KEY, 'generation', shared=True) or 0
+
+
+def bump_version():
+    # Any value other than the current one will do, the time keeps it unique across workers
+    get_cache().set(VERSION_KEY, time.time(), source_ttl('comid'), 'generation', shared=True)
+
+
+def resolve_comids(concurrency=4):
+    """
+    Look up the COMID of the NHD flowline nearest each gauge of the catalog that has none
+    :param concurrency: Most EPA requests in flight at once
+    :return: The number of COMIDs resolved
+    """
+    # The controllers use this module for the nearest gauge queries
+    from .controllers import get_comid
+    from .model import Gauge, SessionMaker
+
+    session = SessionMaker()
+    try:
+        gauges = session.query(Gauge).filter(Gauge.comid.is_(None)).all()
+
+        def resolve(gauge):
+            try:
+                return get_comid(str(gauge.latitude), str(gauge.longitude))
+            except Exception:
+                logger.warning("could not resolve the COMID of %s gauge %s", gauge.kind, gauge.gauge_id)
+                return None
+
+        pool = ThreadPool(concurrency)
+        try:
+            comids = pool.map(resolve, gauges)
+        finally:
+            pool.close()
+            pool.join()
+        for gauge, comid in zip(gauges, comids):
+            gauge.comid = comid
+        session.commit()
+    finally:
+        session.close()
+    bump_version()
+    return sum(1 for comid in comids if comid)
+
+
+def nearest_gauges(latitude, longitude, radius_km, kinds=None, limit=50):
+    """
+    :param latitude: Latitude of the point
+    :param longitude: Longitude of the point
+    :param radius_km: Most kilometers from the point
+    :param kinds: Keys of CATALOG_LAYERS to search, all of them by default
+    :param limit: Most gauges returned
+    :return: A list of the dicts of the gauges within the radius, with their distance_km, nearest first
+    """
+    from .model import Gauge, SessionMaker
+
+    delta_latitude = radius_km / 111.0
+    delta_longitude = radius_km / (111.32 * max(0.01, math.cos(math.radians(latitude))))
+    min_x, min_y = grid_cell(latitude - delta_latitude, longitude - delta_longitude)
+    max_x, max_y = grid_cell(latitude + delta_latitude, longitude + delta_longitude)
+
+    session = SessionMaker()
+    try:
+        candidates = session.query(Gauge).filter(Gauge.kind.in_(kinds or sorted(CATALOG_LAYERS)),
+                                                 Gauge.cell_y.between(min_y, max_y),
+                                                 Gauge.cell_x.between(min_x, max_x)).all()
+    finally:
+        session.close()
+
+    nearby = []
+    for gauge in candidates:
+        distance = distance_km(latitude, longitude, gauge.latitude, gauge.longitude)
+        if distance <= radius_km:
+            nearby.append((distance, gauge))
+    nearby.sort(key=lambda item: item[0])
+
+    gauges = []
+    for distance, gauge in nearby[:limit]:
+        result = gauge.as_dict()
+        result['distance_km'] = round(distance, 3)
+        gauges.append(result)
+    return gauges
+
+
+def get_gauges(kind, gauge_ids):
+    """
+    :param kind: Key of CATALOG_LAYERS
+    :param gauge_ids: AHPS GaugeLIDs or USGS STAIDs
+    :return: A dict of the dict of each of the gauges found in the catalog, by gauge id
+    """
+    from .model import Gauge, SessionMaker
+
+    if not gauge_ids:
+        return {}
+    session = SessionMaker()
+    try:
+        gauges = session.query(Gauge).filter(Gauge.kind == kind, Gauge.gauge_id.in_(sorted(set(gauge_ids)))).all()
+    finally:
+        session.close()
+    return dict((gauge.gauge_id, gauge.as_dict()) for gauge in gauges)
+
+
+def mercator(latitude, longitude):
+    """
+    :return: The Web Mercator (EPSG:3857) x and y of the point, in meters
+    """
+    latitude = max(-85.0511, min(85.0511, latitude))
+    return (WEB_MERCATOR_RADIUS * math.radians(longitude),
+            WEB_MERCATOR_RADIUS * math.log(math.tan(math.pi / 4 + math.radians(latitude) / 2)))
+
+
+def build_cluster_levels(gauges, max_zoom=CLUSTER_MAX_ZOOM, cluster_pixels=CLUSTER_PIXELS):
+    """
+    Merge the gauges of each kind that fall in the same grid cell of each zoom level
+    :param gauges: List of the dicts returned by Gauge.as_dict()
+    :return: A dict of a list per zoom level (0 to max_zoom) for each kind, of (longitude, latitude, count, gauge)
+    clusters, gauge being the dict of the gauge when it is alone in its cell
+    """
+    points = [(gauge, mercator(gauge['latitude'], gauge['longitude'])) for gauge in gauges]
+    levels = {}
+    for zoom in range(max_zoom + 1):
+        cell_size = 2 * math.pi * WEB_MERCATOR_RADIUS / 256 / 2 ** zoom * cluster_pixels
+        cells = {}
+        for gauge, (x, y) in points:
+            cell = cells.setdefault((gauge['type'], int(math.floor(x / cell_size)), int(math.floor(y / cell_size))),
+                                    [0.0, 0.0, 0, gauge])
+            cell[0] += gauge['longitude']
+            cell[1] += gauge['latitude']
+            cell[2] += 1
+        for (kind, cell_x, cell_y), (longitude, latitude, count, gauge) in cells.items():
+            levels.setdefault(kind, [[] for i in range(max_zoom + 1)])[zoom].append(
+                (longitude / count, latitude / count, count, gauge if count == 1 else None))
+    return levels
+
+
+def get_cluster_levels():
+    """
+    :return: The cluster levels of the catalog, built again when the catalog changed
+    """
+    from .model import Gauge, SessionMaker
+
+    version = catalog_version()
+    with _clusters_lock:
+        if _clusters['levels'] is None or _clusters['version'] != version:
+            session = SessionMaker()
+            try:
+                gauges = [gauge.as_dict() for gauge in session.query(Gauge)]
+            finally:
+                session.close()
+            started = time.time()
+            _clusters['levels'] = build_cluster_levels(gauges)
+            _clusters['version'] = version
+            logger.info("clustered %d gauges in %.3f s", len(gauges), time.time() - started)
+        return _clusters['levels']
+
+
+def _feature(longitude, latitude, properties):
+    return {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [longitude, latitude]},
+            'properties': properties}
+
+
+def gauge_features(bbox, zoom, kinds=None):
+    """
+    :param bbox: (min longitude, min latitude, max longitude, max latitude) of the map extent
+    :param zoom: Zoom level of the map, 0 or more
+    :param kinds: Keys of CATALOG_LAYERS to include, all of them by default
+    :return: A list of GeoJSON point features: clusters with their count up to CLUSTER_MAX_ZOOM, gauges with their
+    gauge_id, waterbody, url and COMID otherwise
+    :raise ValueError: If zoom is negative
+    """
+    from .model import Gauge, SessionMaker
+
+    if zoom < 0:
+        # A negative zoom would index the cluster levels from the end
+        raise ValueError('zoom must be 0 or more: {0}'.format(zoom))
+    min_longitude, min_latitude, max_longitude, max_latitude = bbox
+    kinds = kinds or sorted(CATALOG_LAYERS)
+    features = []
+    if zoom <= CLUSTER_MAX_ZOOM:
+        levels = get_cluster_levels()
+        for kind in kinds:
+            for longitude, latitude, count, gauge in levels.get(kind, [[]] * (zoom + 1))[zoom]:
+                if min_longitude <= longitude <= max_longitude and min_latitude <= latitude <= max_latitude:
+                    features.append(_feature(longitude, latitude, dict(gauge, count=1) if gauge else {'type': kind,
+                                                                                              'count': count}))
+        return features
+
+    # Zoomed in, the extent covers few cells of the grid index
+    min_x, min_y = grid_cell(min_latitude, min_longitude)
+    max_x, max_y = grid_cell(max_latitude, max_longitude)
+    session = SessionMaker()
+    try:
+        gauges = session.query(Gauge).filter(Gauge.kind.in_(kinds), Gauge.cell_y.between(min_y, max_y),
+                                             Gauge.cell_x.between(min_x, max_x),
+                                             Gauge.latitude.between(min_latitude, max_latitude),
+                                             Gauge.longitude.between(min_longitude, max_longitude)).all()
+    finally:
+        session.close()
+    return [_feature(gauge.longitude, gauge.latitude, dict(gauge.as_dict(), count=1)) for gauge in gauges]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the gaugeview gauge catalog.')
+    commands = parser.add_subparsers(dest='command')
+    refresh = commands.add_parser('refresh', help='reload the gauges from the AHPS and USGS gauge layers')
+    refresh.add_argument('--kind', action='append', choices=sorted(CATALOG_LAYERS), help='only reload these gauges')
+    refresh.add_argument('--resolve-comids', action='store_true', help='look up the COMIDs of the new gauges')
+    refresh.add_argument('--concurrency', type=int, default=get_setting('GAUGEVIEW_CATALOG_CONCURRENCY', 4),
+                         help='most EPA requests in flight at once when resolving COMIDs')
+    nearest = commands.add_parser('nearest', help='print the gauges near a point')
+    nearest.add_argument('latitude', type=float)
+    nearest.add_argument('longitude', type=float)
+    nearest.add_argument('--radius', type=float, default=10, help='kilometers')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'refresh':
+        counts = refresh_catalog(args.kind)
+        print('loaded {0}'.format(json.dumps(counts, sort_keys=True)))
+        if args.resolve_comids:
+            print('resolved {0} COMIDs'.format(resolve_comids(args.concurrency)))
+    else:
+        for gauge in nearest_gauges(args.latitude, args.longitude, args.radius):
+            print('{0:>7.2f} km  {1} {2:<16} {3}'.format(gauge['distance_km'], gauge['type'], gauge['gauge_id'],
+                                                          gauge['waterbody']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+import json
+import os
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+def get_setting(name, default=None):
+    """
+    Look up an app setting, first in the Django settings module and then in the environment
+    :param name: Name of the setting (i.e. GAUGEVIEW_CACHE_DIR)
+    :param default: Value returned when the setting is not defined. Environment values are cast to its type (JSON for
+    dicts and lists).
+    :return: The configured value or the default
+    """
+    try:
+        if hasattr(settings, name):
+            return getattr(settings, name)
+    except ImproperlyConfigured:
+        # Command line tools (benchmarks, ingest scripts) can run without a settings module
+        pass
+
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    if isinstance(default, bool):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    if isinstance(default, (int, float)):
+        return type(default)(value)
+    if isinstance(default, (dict, list)):
+        return json.loads(value)
+    return value
+
+
+# Base URLs of the upstream services. Each can be pointed somewhere else (i.e. a local stand-in server) with the
+# GAUGEVIEW_UPSTREAM_URLS setting, i.e. {'ahps': 'http://localhost:8001'}.
+UPSTREAM_URLS = {
+    'nwis': 'http://nwis.waterdata.usgs.gov',
+    'nwis_services': 'http://nwis.waterservices.usgs.gov',
+    'ahps': 'http://water.weather.gov',
+    'epa': 'https://ofmpub.epa.gov',
+    'nwm': 'https://apps.hydroshare.org',
+    'gaugeviewer': 'https://geoserver.byu.edu',  # ArcGIS layers the gauge catalog is loaded from
+    'hydroshare': 'https://www.hydroshare.org',  # Where the WaterML exports are published
+}
+
+
+def upstream_url(name):
+    """
+    :param name: One of the keys of UPSTREAM_URLS
+    :return: The base URL of that upstream service, without a trailing slash
+    """
+    urls = dict(UPSTREAM_URLS)
+    urls.update(get_setting('GAUGEVIEW_UPSTREAM_URLS', {}))
+    return urls[name].rstrip('/')
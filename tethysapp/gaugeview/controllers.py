@@ -1,8 +1,6 @@
 import os
-import shutil
 import json
-import traceback
-import urllib2
+import hashlib
 from urllib2 import HTTPError
 import logging
 import xml.etree.ElementTree as ElTree
@@ -10,29 +8,40 @@ from dateutil import tz
 
 from django.shortcuts import render, render_to_response
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponse
+from django.http import Http404, HttpResponse
+from django.utils.cache import patch_cache_control
+from django.utils.crypto import constant_time_compare
 from datetime import datetime, timedelta
 from django.http import JsonResponse
 from django.core.exceptions import ObjectDoesNotExist
-from django.conf import settings
-
-from oauthlib.oauth2 import TokenExpiredError
-from hs_restclient import HydroShare, HydroShareAuthOAuth2
 
 from tethys_sdk.gizmos import TimeSeries
+from tethys_sdk.gizmos import LinePlot
 from tethys_sdk.gizmos import DatePicker
 from tethys_sdk.gizmos import Button
 from tethys_sdk.gizmos import TextInput
 from tethys_sdk.gizmos import SelectInput
 
-logger = logging.getLogger(__name__)
-try:
-    from tethys_services.backends.hs_restclient_helper import get_oauth_hs
-except ImportError:
-    logger.error("could not load: tethys_services.backends.hs_restclient_helper import get_oauth_hs")
+from . import catalog, flowstats, metrics, profiling, skill, timing, uploads, upstream
+from .admission import admitted, sheds_load
+from .archive import DailyArchive
+from .cache import StaleData, cached_page_context, cached_series, cached_source
+from .config import get_setting, upstream_url
+from .prefetch import record_request
+from .series import Series
+from .upstream import fetch_concurrently
 
+logger = logging.getLogger(__name__)
 
-hs_hostname = "www.hydroshare.org"
+# Timezones offered on the ahps and usgs pages: (select value, tz database name, display name)
+TIMEZONES = (('UTC', 'UTC', 'Coordinated Time'),
+             ('Hawaii', 'US/Hawaii', 'Hawaii Time'),
+             ('Alaska', 'US/Alaska', 'Alaska Time'),
+             ('Pacific', 'US/Pacific', 'Pacific Time'),
+             ('Arizona', 'US/Arizona', 'Arizona Time'),
+             ('Mountain', 'US/Mountain', 'Mountain Time'),
+             ('Central', 'US/Central', 'Central Time'),
+             ('Eastern', 'US/Eastern', 'Eastern Time'))
 
 @login_required()
 def home(request):
@@ -46,6 +55,7 @@ def home(request):
     return render(request, 'gaugeview/home.html', context)
 
 
+@cached_source('iv')
 def get_usgs_iv_data(gauge_id, start, end):
     """
     :param gauge_id: This is the USGS Id of the gauge
@@ -53,13 +63,13 @@ def get_usgs_iv_data(gauge_id, start, end):
     :param end: This is the properly formatted end date YYYY-MM-DD
     :return: This returns a USGS rdb file of streamflow in cfs for the selected gauge and time
     """
-    url = ('http://nwis.waterdata.usgs.gov/usa/nwis/uv/?cb_00060=on&format=rdb&site_no={0}'
-           '&period=&begin_date={1}&end_date={2}'.format(gauge_id, start, end))
-    response = urllib2.urlopen(url)
-    data = response.read()
+    url = ('{0}/usa/nwis/uv/?cb_00060=on&format=rdb&site_no={1}'
+           '&period=&begin_date={2}&end_date={3}'.format(upstream_url('nwis'), gauge_id, start, end))
+    data = upstream.get('nwis', url)
     return data
 
 
+@cached_source('dv')
 def get_usgs_dv_data(gauge_id, start, end):
     """
     :param gauge_id: This is the USGS Id of the gauge
@@ -67,13 +77,77 @@ def get_usgs_dv_data(gauge_id, start, end):
     :param end: This is the properly formatted end date YYYY-MM-DD
     :return: This returns a USGS rdb file of streamflow in cfs for the selected gauge and time
     """
-    url = ('http://nwis.waterdata.usgs.gov/usa/nwis/dv/?cb_00060=on&format=rdb&site_no={0}'
-           '&period=&begin_date={1}&end_date={2}'.format(gauge_id, start, end))
-    response = urllib2.urlopen(url)
-    data = response.read()
+    url = ('{0}/usa/nwis/dv/?cb_00060=on&format=rdb&site_no={1}'
+           '&period=&begin_date={2}&end_date={3}'.format(upstream_url('nwis'), gauge_id, start, end))
+    data = upstream.get('nwis', url)
     return data
 
 
+def get_usgs_dv_series(gauge_id, start, end):
+    """
+    Read the daily values of a gauge from the local archive, fetching only the days that are not archived yet and the
+    recent provisional values from NWIS. Without GAUGEVIEW_DV_ARCHIVE the whole range is fetched.
+    :param gauge_id: This is the USGS Id of the gauge
+    :param start: This is the properly formatted beginning date YYYY-MM-DD
+    :param end: This is the properly formatted end date YYYY-MM-DD
+    :return: The metadata and Series returned by convert_usgs_dv_to_python, and whether some of the values could not
+    be refreshed because NWIS is failing
+    """
+    if get_setting('GAUGEVIEW_DV_ARCHIVE', True):
+        try:
+            return get_archived_dv_series(gauge_id, datetime.strptime(start, '%Y-%m-%d').date(),
+                                          min(datetime.strptime(end, '%Y-%m-%d').date(), datetime.now().date()))
+        except (IOError, OSError):
+            logger.exception("could not use the daily values archive of %s", gauge_id)
+
+    data = get_usgs_dv_data(gauge_id, start, end)
+    with timing.stage('parse'):
+        metadata, series = convert_usgs_dv_to_python(data)
+    return metadata, series, isinstance(data, StaleData)
+
+
+def get_archived_dv_series(gauge_id, start, end):
+    """
+    :param gauge_id: This is the USGS Id of the gauge
+    :param start: First day (date)
+    :param end: Last day (date), no later than today
+    :return: The same as get_usgs_dv_series
+    """
+    dv_archive = DailyArchive(gauge_id)
+    stale = refresh_dv_archive(dv_archive, gauge_id, start, end)
+    with timing.stage('archive'):
+        archived = dv_archive.read(start, end)
+    if archived is None:
+        raise IOError('the daily values archive of {0} is unreadable'.format(gauge_id))
+    return archived[0], archived[1], stale
+
+
+def refresh_dv_archive(dv_archive, gauge_id, start, end):
+    """
+    Fetch the days of a range that are not archived yet and the recent provisional values into the archive
+    :param dv_archive: The DailyArchive of the gauge
+    :param gauge_id: This is the USGS Id of the gauge
+    :param start: First day (date)
+    :param end: Last day (date), no later than today
+    :return: Whether some of the values could not be refreshed because NWIS is failing
+    """
+    stale = False
+    for window_start, window_end in dv_archive.missing(start, end):
+        try:
+            data = get_usgs_dv_data(gauge_id, window_start.isoformat(), window_end.isoformat())
+        except (HTTPError, upstream.UpstreamError):
+            if dv_archive.state() is None:
+                raise
+            logger.warning("serving the archived daily values of %s, NWIS is failing", gauge_id)
+            stale = True
+            continue
+        with timing.stage('parse'):
+            dv_archive.ingest(data, window_start, window_end, refreshed=not isinstance(data, StaleData))
+        stale = stale or isinstance(data, StaleData)
+    return stale
+
+
+@cached_source('iv')
 def get_usgs_xml(gauge_id, start, end):
     """
     The URL generated here is described at: http://waterservices.usgs.gov/rest/IV-Test-Tool.html and can be edited
@@ -83,33 +157,58 @@ def get_usgs_xml(gauge_id, start, end):
     :param end: This is the properly formatted end date YYYY-MM-DD
     :return: This returns a USGS rdb file of streamflow in cfs for the selected gauge and time
     """
-    url = ('http://nwis.waterservices.usgs.gov/nwis/iv/?format=waterml,1.1&sites={0}&startDT={1}&endDT={2}&'
-           'parameterCd=00060'.format(gauge_id, start, end))
-    response = urllib2.urlopen(url)
-    data = response.read()
+    url = ('{0}/nwis/iv/?format=waterml,1.1&sites={1}&startDT={2}&endDT={3}&'
+           'parameterCd=00060'.format(upstream_url('nwis_services'), gauge_id, start, end))
+    data = upstream.get('nwis_services', url)
     return data
 
 
+@cached_source('ahps')
 def get_ahps_data(gaugeno):
     """
     :param gaugeno: This is the AHPS Gauge Number that was selected
     :return: This returns an .xml file with the required gauge information, streamflow and stage, as applicable
     """
-    url = 'http://water.weather.gov/ahps2/hydrograph_to_xml.php?gage={0}&output=xml'.format(gaugeno.lower())
-    response = urllib2.urlopen(url)
-    data = response.read()
+    url = '{0}/ahps2/hydrograph_to_xml.php?gage={1}&output=xml'.format(upstream_url('ahps'), gaugeno.lower())
+    data = upstream.get('ahps', url)
     return data
 
 
+@cached_source('comid')
 def get_comid(latitude, longitude):
     """
     :param lat: Latitude of point
     :param long: Longitude of point
     :return: Returns the nearest comid from the NHD
     """
-    comid = str(json.loads(urllib2.urlopen('https://ofmpub.epa.gov/waters10/PointIndexing.Service?pGeometry=POINT(' + longitude + '+' + latitude + ')').read())['output']['ary_flowlines'][0]['comid'])
+    data = upstream.get('epa', upstream_url('epa') + '/waters10/PointIndexing.Service?pGeometry=POINT(' + longitude + '+' + latitude + ')')
+    return convert_epa_to_comid(data)
+
+
+@metrics.counted_parser('epa', rows=lambda result: 1)
+def convert_epa_to_comid(data):
+    """
+    :param data: The JSON returned by the EPA PointIndexing service
+    :return: The COMID of the flowline nearest the point
+    """
+    return str(json.loads(data)['output']['ary_flowlines'][0]['comid'])
+
 
-    return comid
+@cached_source('nwm')
+def get_nwm_data(forecast_range, comid, start, end, comid_time):
+    """
+    :param forecast_range: NWM configuration (analysis_assim, short_range or medium_range)
+    :param comid: COMID of the stream reach
+    :param start: This is the properly formatted beginning date YYYY-MM-DD
+    :param end: This is the properly formatted end date YYYY-MM-DD
+    :param comid_time: Forecast cycle hour (i.e. "06")
+    :return: This returns the WaterML document of the NWM streamflow for the reach
+    """
+    url = ('{0}/apps/nwm-forecasts/api/GetWaterML/?config={1}&geom=channel_rt'
+           '&variable=streamflow&COMID={2}&lon=&lat=&startDate={3}&endDate={4}&time={5}&lag='.format(
+               upstream_url('nwm'), forecast_range, comid, start, end, comid_time))
+    data = upstream.get('nwm', url)
+    return data
 
 
 def convert_to_utc(time, tz):
@@ -175,13 +274,15 @@ def comid_set_time(time):
     new_time = time_comid + ':00'
     return new_time
 
+@metrics.counted_parser('usgs_iv', rows=lambda result: len(result[1]))
 def convert_usgs_iv_to_python(data):
     """
     This will convert the entire USGS instantaneous file to a python object
     :param data: USGS rdb data file
-    :return:
+    :return: The metadata, and a Series of the values at their UTC times, with the value code as qualifier and the
+    offset of the local time
     """
-    python_data_list = []
+    series = Series()
     metadata = []
     python_metadata = []
     contact = None
@@ -207,7 +308,7 @@ def convert_usgs_iv_to_python(data):
             hour_int = int(hour)
             minute_int = int(minute)
             time = datetime(year, month, day, hour_int, minute_int)
-            utctime, time_offset = convert_to_utc(time, time_zone)
+            utctime = convert_to_utc(time, time_zone)[0]
 
             if value_str == "Ice":
                 value_str = "0"
@@ -215,7 +316,9 @@ def convert_usgs_iv_to_python(data):
             if value_str == '':
                 continue
 
-            python_data_list.append([agency_code, site_code, time, time_offset, utctime, float(value_str), value_code])
+            if not series.metadata:
+                series.metadata.update(AgencyCode=agency_code, SiteCode=site_code)
+            series.append(utctime, float(value_str), value_code, int((time - utctime).total_seconds() // 60))
 
     for i in metadata:
         i = i[1:].strip()
@@ -227,16 +330,18 @@ def convert_usgs_iv_to_python(data):
             continue
     python_metadata.append({'Contact': contact, 'Retrieved': retrieval_date})
 
-    return python_metadata, python_data_list
+    return python_metadata, series
 
 
+@metrics.counted_parser('usgs_dv', rows=lambda result: len(result[1]))
 def convert_usgs_dv_to_python(data):
     """
-    This will convert the entire USGS instantaneous file to a python object
+    This will convert the entire USGS daily values file to a python object
     :param data: USGS rdb data file
-    :return:
+    :return: The metadata, and a Series of the daily values (-9999 where there is none) with the value code as
+    qualifier
     """
-    python_data_list = []
+    series = Series()
     metadata = []
     data_list = []
     contact = None
@@ -267,7 +372,9 @@ def convert_usgs_dv_to_python(data):
         if value_str == "":
             value_str = "-9999"
 
-        python_data_list.append([agency_code, site_code, date, float(value_str), value_code])
+        if not series.metadata:
+            series.metadata.update(AgencyCode=agency_code, SiteCode=site_code)
+        series.append(date, float(value_str), value_code)
 
     for i in metadata:
         # print i
@@ -285,17 +392,19 @@ def convert_usgs_dv_to_python(data):
 
     python_metadata = {'Contact': contact, 'Retrieved': retrieval_date, 'SiteName': site_name}
 
-    return python_metadata, python_data_list
+    return python_metadata, series
 
 
+@metrics.counted_parser('ahps', rows=lambda result: len(result[0]))
 def convert_ahps_to_python(data):
     """
     :param data: Input the XML file returned from the AHPS website
-    :return: return a Python list object with time-series data from the XML returned. The python list returned will be
-    formatted as: [(observed or forecast), datetime, stage, stage units, flow, flow_units]
+    :return: return the stage and flow Series of the XML returned, in time order. Their qualifier is 'observed' or
+    'forecast', and their units are in the 'units' metadata.
     """
     site = ElTree.fromstring(data)
-    python_data = []
+    stage_series = Series()
+    flow_series = Series()
     # These variables are defined now to account for when one of them is not present in AHPS data.
     stage = 0
     stage_units = ''
@@ -331,517 +440,367 @@ def convert_ahps_to_python(data):
                         else:
                             flow = float(field.text)
                             flow_units = field.get('units')
-                python_data.append([child.tag, datetime(year, month, day, hour, minute), stage, stage_units, flow,
-                                    flow_units])
+                valid = datetime(year, month, day, hour, minute)
+                stage_series.append(valid, stage, child.tag)
+                flow_series.append(valid, flow, child.tag)
 
-        # Input XML requires sorting by date to get in proper order
-        python_data.sort(key=lambda x: x[1])
+    # Input XML requires sorting by date to get in proper order
+    for series in (stage_series, flow_series):
+        series.sort()
+    stage_series.metadata['units'] = stage_units
+    flow_series.metadata['units'] = flow_units
 
-    return python_data
+    return stage_series, flow_series
 
 
-def format_ahps_ts(time_series, time_offset, var_code):
+def format_ahps_ts(series, time_offset):
     """
-    :param time_series: This is a python time series created with convert_ahps_to_python(data) function
+    :param series: The stage or flow Series returned by convert_ahps_to_python(data)
     :param time_offset: This is an integer of the timezone offset
-    :param var_code: this is an integer representing whether Flow or Stage has been requested
-    :return: This returns a list of lists formatted as [localtime, time_offset, UTCtime, (observed or forecast), Value],
-                and units
+    :return: This returns a list of lists formatted as [localtime, time_offset, UTCtime, (observed or forecast), Value,
+                quality code], and units
     """
-
+    quality_codes = {'observed': 1, 'forecast': 3}
+    time_change = timedelta(hours=time_offset)
     formatted_ts = []
-    units = ""
-    for item in time_series:
-        time_change = timedelta(hours=time_offset)
-        localtime = item[1] + time_change
-        localtime = localtime.strftime("%Y-%m-%dT%H:%M")
-        item[1] = item[1].strftime("%Y-%m-%dT%H:%M")
-        if item[0] == 'observed':
-            quality_code = 1
-        elif item[0] == 'forecast':
-            quality_code = 3
-        if var_code == 0:  # FLOW
-            formatted_ts.append([localtime, time_offset, item[1], item[0], item[4], quality_code])
-            units = item[5]
-        elif var_code == 1:  # STAGE
-            formatted_ts.append([localtime, time_offset, item[1], item[0], item[2], quality_code])
-            units = item[3]
-
-    return formatted_ts, units
-
-
-def create_time_series_usgs(data, values='iv'):
-    """
-    :param data: Python Data list of USGS NWIS stream gauge observations
-    :param values: Is
-    :return: Time series list of all datetime and values for highcharts plotting
-    """
-    time_series_list = []
-    if values == 'iv':
-        for i in data:
-            time_series_list.append([i[4], i[5]])
-    elif values == 'dv':
-        for i in data:
-            time_series_list.append([i[2], i[3]])
-    return time_series_list
+    for point in series:
+        localtime = (point.time + time_change).strftime("%Y-%m-%dT%H:%M")
+        formatted_ts.append([localtime, time_offset, point.time.strftime("%Y-%m-%dT%H:%M"), point.qualifier,
+                             point.value, quality_codes.get(point.qualifier)])
+
+    return formatted_ts, series.metadata.get('units', '')
+
+
+@metrics.counted_parser('nwm')
+def convert_nwm_to_python(data):
+    """
+    :param data: The WaterML document returned by the NWM forecasts API
+    :return: A Series of the streamflow for every value in the document
+    """
+    time_series = Series()
+    x = data.split('dateTimeUTC=')
+    x.pop(0)
+
+    for elm in x:
+        info = elm.split(' ')
+        time1 = info[0].replace('T', ' ')
+        time2 = time1.replace('"', '')
+        time3 = time2[:-3]
+        time4 = time3.split(' ')
+        timedate = time4[0].split('-')
+        year = int(timedate[0])
+        month = int(timedate[1])
+        day = int(timedate[2])
+        time_split = time4[1].split(':')
+        hour_int = int(time_split[0])
+        minute_int = int(time_split[1])
+        value = info[7].split('<')
+        value1 = value[0].replace('>', '')
+        time_series.append(datetime(year, month, day, hour_int, minute_int), float(value1))
+
+    return time_series
+
+
+def convert_time_series_timezone(time_series, timezone):
+    """
+    :param time_series: A Series
+    :param timezone: Name of one of the TIMEZONES (i.e. 'Pacific')
+    :return: A list of [local datetime, value] pairs for the plots, and the display name of the timezone
+    """
+    for name, zone_name, display_name in TIMEZONES:
+        if name == timezone:
+            break
+    else:
+        name, zone_name, display_name = TIMEZONES[0]
+
+    if name == 'UTC':
+        return time_series.pairs(), display_name
+
+    from_zone = tz.gettz('UTC')
+    to_zone = tz.gettz(zone_name)
+    converted = []
+    for utc_time, value in zip(time_series.datetimes(), time_series.values):
+        # datetime objects are 'naive' by default, tell them they are in UTC before converting
+        local_time = utc_time.replace(tzinfo=from_zone).astimezone(to_zone)
+        converted.append([local_time.replace(tzinfo=None), value])
+
+    return converted, display_name
 
 
 def format_ts_usgs_dv(data):
     """
     This is to make a format that Django can recognize and use while building the WaterML
-    :param data: This is a list object containing all USGS observation data returned from NWIS
+    :param data: The Series of daily values returned by convert_usgs_dv_to_python
     :return: This returns a list that has been formatted to be used as context when passed to the WaterML doc
     """
+    agency_code = data.metadata.get('AgencyCode')
+    site_code = data.metadata.get('SiteCode')
     good_data = []
-    for val in data:
-        good_data.append({'AgencyCode': val[0], 'SiteCode': val[1], 'Date': val[2].strftime("%Y-%m-%dT%H:%M"),
-                          'TimeOffset': "0", 'UTCTime': val[2].strftime("%Y-%m-%dT%H:%M"), 'Value': val[3],
-                          'ValueCode': val[4]})
+    for point in data:
+        date = point.time.strftime("%Y-%m-%dT%H:%M")
+        good_data.append({'AgencyCode': agency_code, 'SiteCode': site_code, 'Date': date, 'TimeOffset': "0",
+                          'UTCTime': date, 'Value': point.value, 'ValueCode': point.qualifier})
     return good_data
 
 
+AHPS_PAGE_PARAMS = ('gaugeno', 'waterbody', 'lat', 'long', 'initial', 'timezone', 'comid', 'forecast_range',
+                    'forecast_date', 'forecast_date_end', 'comid_time')
+
+USGS_PAGE_PARAMS = ('gaugeid', 'waterbody', 'start', 'end', 'lat', 'long', 'initial', 'timezone', 'comid',
+                    'forecast_range', 'forecast_date', 'forecast_date_end', 'comid_time')
+
+WATERML_PARAMS = ('type', 'gaugeid', 'span', 'start', 'end', 'lat', 'long', 'var')
+
+FORECAST_RANGE_OPTIONS = [('Analysis and Assimilation', 'analysis_assim'), ('Short', 'short_range'),
+                          ('Medium', 'medium_range'), ('Compare', 'compare')]
+
+# Colors of the daily streamflow, then of its historical minimum, percentiles (see flowstats) and maximum
+DV_STATS_COLORS = ['#7cb5ec', '#b2182b', '#ef8a62', '#f4a582', '#434348', '#92c5de', '#67a9cf', '#2166ac']
+
+# Colors of the observed streamflow, then of the forecasts overlaid on it
+FORECAST_COLORS = ['#7cb5ec', '#b880e9', '#f7a35c', '#90ed7d', '#e4d354', '#f15c80', '#2b908f', '#8d4653']
+
+# The forecast options that determine which NWM data is fetched, as opposed to how the gizmos are initialized
+FORECAST_FETCH_PARAMS = ('forecast_range', 'forecast_date', 'forecast_date_end', 'comid_time')
+
+FORECAST_TIME_OPTIONS = [('{0}:00'.format(check_digit(hour)), check_digit(hour)) for hour in range(24)]
+
+
+def latest_short_range_cycle(now=None):
+    """
+    :param now: Datetime to find the cycle for, defaults to datetime.now()
+    :return: The short range forecast cycle hour (i.e. "06") shown when a page is first opened
+    """
+    if now is None:
+        now = datetime.now()
+    if now.hour > 7:
+        return check_digit(now.hour - 7)
+    return '00'
+
+
+def get_forecast_options(request, forecast_date, forecast_date_end, initial_date):
+    """
+    Determine which NWM forecast is requested, mirroring the forecast gizmos of the ahps and usgs pages
+    :param request: URL request for the page, including GET information
+    :param forecast_date: Default forecast start date YYYY-MM-DD
+    :param forecast_date_end: Default forecast end date YYYY-MM-DD
+    :param initial_date: Date YYYY-MM-DD used for the short range forecast shown when the page is first opened
+    :return: A dict with the forecast range, dates and cycle, plus the label of the selected forecast range
+    """
+    options = {'forecast_range': 'analysis_assim', 'forecast_date': forecast_date,
+               'forecast_date_end': forecast_date_end, 'comid_time': "06",
+               'forecast_range_initialize': 'Analysis and Assimilation', 'got_comid': False}
+
+    if request.GET.get("forecast_range", None) is not None:
+        options['forecast_range'] = request.GET['forecast_range']
+        options['forecast_date'] = request.GET['forecast_date']
+
+    if request.GET.get('initial'):
+        options['got_comid'] = True
+        options['forecast_range'] = 'short_range'
+        options['comid_time'] = latest_short_range_cycle()
+        options['forecast_date'] = initial_date
+        options['forecast_date_end'] = initial_date
+        options['forecast_range_initialize'] = 'Short'
+    else:
+        options['forecast_date'] = request.GET['forecast_date']
+        if options['forecast_range'] == "short_range":
+            options['comid_time'] = request.GET['comid_time']
+            options['forecast_range_initialize'] = 'Short'
+        elif options['forecast_range'] == "analysis_assim":
+            options['forecast_date_end'] = request.GET['forecast_date_end']
+            options['forecast_range_initialize'] = 'Analysis and Assimilation'
+        elif options['forecast_range'] == "compare":
+            options['comid_time'] = request.GET['comid_time']
+            options['forecast_date_end'] = request.GET['forecast_date_end']
+            options['forecast_range_initialize'] = 'Compare'
+        else:
+            options['forecast_range_initialize'] = 'Medium'
+
+    return options
+
+
+def get_forecast_series(forecast, comid):
+    """
+    :param forecast: The dict returned by get_forecast_options
+    :param comid: COMID of the stream reach, None if it could not be looked up
+    :return: A Series of the forecast flow, whether the forecast could not be retrieved, and whether it is stale data
+    served because the NWM service is failing
+    """
+    if comid is None:
+        return Series(), True, False
+    try:
+        data = get_nwm_data(forecast['forecast_range'], comid, forecast['forecast_date'],
+                            forecast['forecast_date_end'], forecast['comid_time'])
+    except (HTTPError, upstream.UpstreamError):
+        return Series(), True, False
+    with timing.stage('parse'):
+        return convert_nwm_to_python(data), False, isinstance(data, StaleData)
+
+
+def get_compared_forecasts(forecast):
+    """
+    :param forecast: The dict returned by get_forecast_options for the 'compare' forecast range
+    :return: A list of (name, forecast options) of the forecasts overlaid: the analysis and assimilation of the
+    forecast dates, the medium range of the forecast date, and the short range cycle selected followed by the cycles
+    before it (GAUGEVIEW_COMPARE_SHORT_RANGE_CYCLES in all)
+    """
+    compared = [('Analysis and Assimilation', dict(forecast, forecast_range='analysis_assim')),
+                ('Medium Range', dict(forecast, forecast_range='medium_range', comid_time='06',
+                                      forecast_date_end=forecast['forecast_date']))]
+    cycle = datetime.strptime(forecast['forecast_date'], '%Y-%m-%d') + timedelta(hours=int(forecast['comid_time']))
+    for i in range(get_setting('GAUGEVIEW_COMPARE_SHORT_RANGE_CYCLES', 3)):
+        date = cycle.strftime('%Y-%m-%d')
+        comid_time = check_digit(cycle.hour)
+        compared.append(('Short Range {0} {1}Z'.format(date, comid_time),
+                         dict(forecast, forecast_range='short_range', forecast_date=date, forecast_date_end=date,
+                              comid_time=comid_time)))
+        cycle -= timedelta(hours=1)
+    return compared
+
+
+def get_forecast_fetches(forecast, comid):
+    """
+    :param forecast: The dict returned by get_forecast_options
+    :param comid: COMID of the stream reach, None if it could not be looked up
+    :return: A list of (name, fetch) of the forecasts to plot, fetch taking no arguments and returning what
+    get_forecast_series does. The pages run them in the same fetch_concurrently call as their other sources, so
+    comparing forecasts costs one round of parallel requests; each forecast is cached on its own by get_nwm_data.
+    """
+    if forecast['forecast_range'] != 'compare':
+        return [('Forecasted Streamflow', lambda: get_forecast_series(forecast, comid))]
+    return [(name, lambda options=options: get_forecast_series(options, comid))
+            for name, options in get_compared_forecasts(forecast)]
+
+
+def combine_forecasts(fetches, results):
+    """
+    :param fetches: The list returned by get_forecast_fetches
+    :param results: What each of its fetches returned
+    :return: A list of (name, Series) of the forecasts retrieved, whether none of them could be retrieved, and whether
+    any of them is stale data
+    """
+    forecasts = [(name, series) for (name, fetch), (series, failed, stale) in zip(fetches, results) if not failed]
+    return forecasts, not forecasts, any(stale for series, failed, stale in results)
+
+
+def forecast_plot_series(forecasts, timezone):
+    """
+    :param forecasts: The list of (name, Series) returned by combine_forecasts, all on the UTC time axis
+    :param timezone: Name of one of the TIMEZONES
+    :return: The TimeSeries gizmo series of the forecasts, converted to the timezone like the observations
+    """
+    return [{'name': name, 'data': convert_time_series_timezone(series, timezone)[0]} for name, series in forecasts]
+
+
+def fetch_optional(fetch, *args):
+    """
+    Fetch from a source the page can be shown without
+    :param fetch: One of the get_* functions of an upstream source
+    :param args: Its arguments
+    :return: What fetch returned, or None if the upstream service failed or the page ran out of time
+    """
+    try:
+        return fetch(*args)
+    except Exception as e:
+        if not upstream.is_upstream_failure(e):
+            raise
+        logger.warning("rendering the page without %s: %s", fetch.__name__, e)
+        return None
+
+
+def get_request_timezone(request):
+    """
+    :param request: URL request for the page, including GET information
+    :return: The timezone name to display the page in, and the value shown on the page
+    """
+    timezone = request.GET.get('timezone', None)
+    if timezone is None:
+        timezone = 'Coordinated'
+    if request.GET.get('initial'):
+        return 'UTC', timezone
+    timezone = request.GET['timezone']
+    return timezone, timezone
+
+
 @login_required()
+@timing.timed_view('ahps')
+@metrics.counted_view('ahps')
+@profiling.profiled('ahps')
+@sheds_load
 def ahps(request):
     """
     Controller for the AHPS.html page
     :param request: URL request for the page, including GET information
     :return: Returns a rendering of the page with AHPS data available displayed
     """
-    # REFACTOR TO "This + 2"
+    record_request('ahps', request.GET['gaugeno'], request.GET['lat'], request.GET['long'])
+    # Upstream calls share the page's latency budget, whatever has not answered by then is left off the page
+    with upstream.deadline(get_setting('GAUGEVIEW_PAGE_BUDGET', 20.0)):
+        context = ahps_context(request)
+
+    # Gizmos are rendered by the template
+    with timing.stage('render'):
+        return render(request, 'gaugeview/ahps.html', context)
+
+
+@cached_page_context('ahps', 'gaugeno', AHPS_PAGE_PARAMS, ('ahps', 'comid', 'nwm'))
+@admitted('page')
+def ahps_context(request):
+    """
+    Fetches the AHPS and NWM data for a gauge and builds the plots and gizmos of the AHPS.html page
+    :param request: URL request for the page, including GET information
+    :return: Returns the context for the AHPS.html template
+    """
     t_now = datetime.now()
     now_str = "{0}-{1}-{2}".format(t_now.year, check_digit(t_now.month), check_digit(t_now.day))
-    t_delta = timedelta(days=7)
-    t_before = t_now - t_delta
+    t_before = t_now - timedelta(days=7)
     before_str = "{0}-{1}-{2}".format(t_before.year, check_digit(t_before.month), check_digit(t_before.day))
-    # h_delta = timedelta(hours=8)
-    # h_str = t_now - h_delta
-    # now_hour = h_str.hour
 
     # Get values for gauge_id and waterbody
     gauge_id = request.GET['gaugeno']
     waterbody = request.GET['waterbody']
     latitude = request.GET['lat']
     longitude = request.GET['long']
-    forecast_date = before_str
-    forecast_date_end = now_str
-    forecast_range_initialize = 'Analysis and Assimilation'
-    comid_time = "06"
-    do_forecast = request.GET.get("forecast_range", None)
-    forecast_range = 'analysis_assim'
-    got_comid = False
     comid = None
-    failed = False
-    timezone = request.GET.get('timezone', None)
-    if timezone is None:
-        timezone = 'Coordinated'
+    timezone, timezone_display = get_request_timezone(request)
 
-    # Get AHPS data using a dedicated function
-    data = get_ahps_data(gauge_id)  # data will be in a string, but is an xml document
-
-    # Get Closest COMID to gauge
-    # comid_filler = str(json.loads(urllib2.urlopen('https://ofmpub.epa.gov/waters10/PointIndexing.Service?pGeometry=POINT(' + longitude + '+' + latitude + ')').read())['output']['ary_flowlines'][0]['comid'])
-    comid_filler = get_comid(latitude, longitude)
-
-    # Convert AHPS stage and flow data to a usable string format (NOT INCLUDING METADATA)
-    # print data
-    python_data = convert_ahps_to_python(data)
-
-    flow_data = []
-    flow = float()
-    stage_data = []
-    stage = float()
-
-    for item in python_data:
-        flow_data.append([item[1], item[4]])
-        flow += item[4]
-        stage_data.append([item[1], item[2]])
-        stage += item[2]
-    # print flow_data
-    timezone_list = []
-    if request.GET.get('initial'):
-        flow_data = flow_data
-        timezone_initialize = 'Coordinated Time'
-    else:
-        timezone = request.GET['timezone']
-        if timezone == "UTC":
-            flow_data = flow_data
-            timezone_initialize = 'Coordinated Time'
-        if timezone == "Hawaii":
-            for instant in flow_data:
-                utc_date = instant[0]
-                utc_flow = instant[1]
-                utc_year = utc_date.year
-                utc_month = utc_date.month
-                utc_day = utc_date.day
-                utc_hour = utc_date.hour
-                utc_minute = utc_date.minute
-                utc_second = 00
-                utc_datetime = "{0}-{1}-{2} {3}:{4}:{5}".format(utc_year, check_digit(utc_month), check_digit(utc_day), check_digit(utc_hour), check_digit(utc_minute), utc_second)
-                tz_time = utc2custom(utc_datetime, "US/Hawaii")
-                year = tz_time.year
-                month = tz_time.month
-                day = tz_time.day
-                hour = tz_time.hour
-                minute = tz_time.minute
-                hour_int = int(hour)
-                minute_int = int(minute)
-                timezone_initialize = 'Hawaii'
-                timezone_list.append([datetime(year, month, day, hour_int, minute_int), utc_flow])
-            flow_data = timezone_list
-        if timezone == "Alaska":
-            for instant in flow_data:
-                utc_date = instant[0]
-                utc_flow = instant[1]
-                utc_year = utc_date.year
-                utc_month = utc_date.month
-                utc_day = utc_date.day
-                utc_hour = utc_date.hour
-                utc_minute = utc_date.minute
-                utc_second = 00
-                utc_datetime = "{0}-{1}-{2} {3}:{4}:{5}".format(utc_year, check_digit(utc_month), check_digit(utc_day), check_digit(utc_hour), check_digit(utc_minute), utc_second)
-                tz_time = utc2custom(utc_datetime, "US/Alaska")
-                year = tz_time.year
-                month = tz_time.month
-                day = tz_time.day
-                hour = tz_time.hour
-                minute = tz_time.minute
-                hour_int = int(hour)
-                minute_int = int(minute)
-                timezone_initialize = 'Alaska'
-                timezone_list.append([datetime(year, month, day, hour_int, minute_int), utc_flow])
-            flow_data = timezone_list
-        if timezone == "Pacific":
-            for instant in flow_data:
-                utc_date = instant[0]
-                utc_flow = instant[1]
-                utc_year = utc_date.year
-                utc_month = utc_date.month
-                utc_day = utc_date.day
-                utc_hour = utc_date.hour
-                utc_minute = utc_date.minute
-                utc_second = 00
-                utc_datetime = "{0}-{1}-{2} {3}:{4}:{5}".format(utc_year, check_digit(utc_month), check_digit(utc_day), check_digit(utc_hour), check_digit(utc_minute), utc_second)
-                tz_time = utc2custom(utc_datetime, "US/Pacific")
-                year = tz_time.year
-                month = tz_time.month
-                day = tz_time.day
-                hour = tz_time.hour
-                minute = tz_time.minute
-                hour_int = int(hour)
-                minute_int = int(minute)
-                timezone_initialize = 'Pacific'
-                timezone_list.append([datetime(year, month, day, hour_int, minute_int), utc_flow])
-            flow_data = timezone_list
-        if timezone == "Arizona":
-            for instant in flow_data:
-                utc_date = instant[0]
-                utc_flow = instant[1]
-                utc_year = utc_date.year
-                utc_month = utc_date.month
-                utc_day = utc_date.day
-                utc_hour = utc_date.hour
-                utc_minute = utc_date.minute
-                utc_second = 00
-                utc_datetime = "{0}-{1}-{2} {3}:{4}:{5}".format(utc_year, check_digit(utc_month), check_digit(utc_day), check_digit(utc_hour), check_digit(utc_minute), utc_second)
-                tz_time = utc2custom(utc_datetime, "US/Arizona")
-                year = tz_time.year
-                month = tz_time.month
-                day = tz_time.day
-                hour = tz_time.hour
-                minute = tz_time.minute
-                hour_int = int(hour)
-                minute_int = int(minute)
-                timezone_initialize = 'Arizona'
-                timezone_list.append([datetime(year, month, day, hour_int, minute_int), utc_flow])
-            flow_data = timezone_list
-        if timezone == "Mountain":
-            for instant in flow_data:
-                utc_date = instant[0]
-                utc_flow = instant[1]
-                utc_year = utc_date.year
-                utc_month = utc_date.month
-                utc_day = utc_date.day
-                utc_hour = utc_date.hour
-                utc_minute = utc_date.minute
-                utc_second = 00
-                utc_datetime = "{0}-{1}-{2} {3}:{4}:{5}".format(utc_year, check_digit(utc_month), check_digit(utc_day), check_digit(utc_hour), check_digit(utc_minute), utc_second)
-                tz_time = utc2custom(utc_datetime, "US/Mountain")
-                year = tz_time.year
-                month = tz_time.month
-                day = tz_time.day
-                hour = tz_time.hour
-                minute = tz_time.minute
-                hour_int = int(hour)
-                minute_int = int(minute)
-                timezone_initialize = 'Mountain'
-                timezone_list.append([datetime(year, month, day, hour_int, minute_int), utc_flow])
-            flow_data = timezone_list
-        if timezone == "Central":
-            for instant in flow_data:
-                utc_date = instant[0]
-                utc_flow = instant[1]
-                utc_year = utc_date.year
-                utc_month = utc_date.month
-                utc_day = utc_date.day
-                utc_hour = utc_date.hour
-                utc_minute = utc_date.minute
-                utc_second = 00
-                utc_datetime = "{0}-{1}-{2} {3}:{4}:{5}".format(utc_year, check_digit(utc_month), check_digit(utc_day), check_digit(utc_hour), check_digit(utc_minute), utc_second)
-                tz_time = utc2custom(utc_datetime, "US/Central")
-                year = tz_time.year
-                month = tz_time.month
-                day = tz_time.day
-                hour = tz_time.hour
-                minute = tz_time.minute
-                hour_int = int(hour)
-                minute_int = int(minute)
-                timezone_initialize = 'Central'
-                timezone_list.append([datetime(year, month, day, hour_int, minute_int), utc_flow])
-            flow_data = timezone_list
-        if timezone == "Eastern":
-            for instant in flow_data:
-                utc_date = instant[0]
-                utc_flow = instant[1]
-                utc_year = utc_date.year
-                utc_month = utc_date.month
-                utc_day = utc_date.day
-                utc_hour = utc_date.hour
-                utc_minute = utc_date.minute
-                utc_second = 00
-                utc_datetime = "{0}-{1}-{2} {3}:{4}:{5}".format(utc_year, check_digit(utc_month), check_digit(utc_day), check_digit(utc_hour), check_digit(utc_minute), utc_second)
-                tz_time = utc2custom(utc_datetime, "US/Eastern")
-                year = tz_time.year
-                month = tz_time.month
-                day = tz_time.day
-                hour = tz_time.hour
-                minute = tz_time.minute
-                hour_int = int(hour)
-                minute_int = int(minute)
-                timezone_initialize = 'Eastern'
-                timezone_list.append([datetime(year, month, day, hour_int, minute_int), utc_flow])
-            flow_data = timezone_list
-
-    # Check if AHPS flow data exists
-    gotdata_flow = False
-    if flow > 0:
-        gotdata_flow = True
-
-    time_series_list_api = []
-
-    # REFACTOR TO LINE 'This + 50'
-    # URL for getting forecast data and in a list
-
-    if do_forecast is not None:
+    # Get Closest COMID to gauge, unless the user entered one
+    if request.GET.get("forecast_range", None) is not None:
         comid = request.GET['comid']
         comid_filler = comid
-        forecast_range = request.GET['forecast_range']
-        forecast_date = request.GET['forecast_date']
-
-    time_series_list_api = []
-    comid_initial = comid_filler
-    if comid_initial is not None:
-        if request.GET.get('initial'):
-            got_comid = True
-            forecast_range = 'short_range'
-            t_now = datetime.now()
-            t_hour = t_now.hour
-            if t_hour > 7:
-                t_minus_hour = t_hour - 7
-                comid_time = check_digit(t_minus_hour)
-            else:
-                comid_time = '00'
-            # comid_time = '00'
-            forecast_date = now_str
-            forecast_date_end = now_str
-            forecast_range_initialize = 'Short'
-        else:
-            forecast_date = request.GET['forecast_date']
-            if forecast_range == "short_range":
-                # print 'In Short'
-                comid_time = request.GET['comid_time']
-                forecast_range_initialize = 'Short'
-            elif forecast_range == "analysis_assim":
-                # print 'In analsis and Assim'
-                forecast_date_end = request.GET['forecast_date_end']
-                forecast_range_initialize = 'Analysis and Assimilation'
-            else:
-                # print "In Medium"
-                forecast_range_initialize = 'Medium'
-
-            # print forecast_range
-            # print forecast_date
-            # print forecast_date_end
-
-    url_api = 'https://apps.hydroshare.org/apps/nwm-forecasts/api/GetWaterML/?config={0}&geom=channel_rt&variable=streamflow&COMID={1}&lon=&lat=&startDate={2}&endDate={3}&time={4}&lag='.format(
-        forecast_range, comid_initial, forecast_date, forecast_date_end, comid_time)
-    try:
-        url_api = urllib2.urlopen(url_api)
-        data_api = url_api.read()
-        x = data_api.split('dateTimeUTC=')
-        x.pop(0)
-
-        for elm in x:
-            info = elm.split(' ')
-            time1 = info[0].replace('T', ' ')
-            time2 = time1.replace('"', '')
-            time3 = time2[:-3]
-            time4 = time3.split(' ')
-            time5 = time4[0].split('-')
-            timedate = time5
-            year = int(timedate[0])
-            month = int(timedate[1])
-            day = int(timedate[2])
-            timetime = time4[1]
-            time_split = timetime.split(':')
-            time_minute = time_split[1].replace(':', '')
-            hour = time_split[0]
-            minute = time_minute[1]
-            hour_int = int(hour)
-            minute_int = int(minute)
-            second = 00
-            if request.GET.get('initial'):
-                minute_int = int(time_minute)
-                timezone_initialize = 'Coordinated Time'
-            else:
-                timezone = request.GET['timezone']
-                if timezone == "UTC":
-                    minute_int = int(time_minute)
-                    timezone_initialize = 'Coordinated Time'
-                if timezone == "Hawaii":
-                    utc_datetime = "{0}-{1}-{2} {3}:{4}:{5}".format(year, month, day, hour_int, minute_int, second)
-                    tz_time = utc2custom(utc_datetime, "US/Hawaii")
-                    year = tz_time.year
-                    month = tz_time.month
-                    day = tz_time.day
-                    hour = tz_time.hour
-                    minute = tz_time.minute
-                    hour_int = int(hour)
-                    minute_int = int(minute)
-                    timezone_initialize = 'Hawaii Time'
-                if timezone == "Alaska":
-                    utc_datetime = "{0}-{1}-{2} {3}:{4}:{5}".format(year, month, day, hour_int, minute_int, second)
-                    tz_time = utc2custom(utc_datetime, "US/Alaska")
-                    year = tz_time.year
-                    month = tz_time.month
-                    day = tz_time.day
-                    hour = tz_time.hour
-                    minute = tz_time.minute
-                    hour_int = int(hour)
-                    minute_int = int(minute)
-                    timezone_initialize = 'Alaska Time'
-                if timezone == "Pacific":
-                    utc_datetime = "{0}-{1}-{2} {3}:{4}:{5}".format(year, month, day, hour_int, minute_int, second)
-                    tz_time = utc2custom(utc_datetime, "US/Pacific")
-                    year = tz_time.year
-                    month = tz_time.month
-                    day = tz_time.day
-                    hour = tz_time.hour
-                    minute = tz_time.minute
-                    hour_int = int(hour)
-                    minute_int = int(minute)
-                    timezone_initialize = 'Pacific Time'
-                if timezone == "Arizona":
-                    utc_datetime = "{0}-{1}-{2} {3}:{4}:{5}".format(year, month, day, hour_int, minute_int, second)
-                    tz_time = utc2custom(utc_datetime, "US/Arizona")
-                    year = tz_time.year
-                    month = tz_time.month
-                    day = tz_time.day
-                    hour = tz_time.hour
-                    minute = tz_time.minute
-                    hour_int = int(hour)
-                    minute_int = int(minute)
-                    timezone_initialize = 'Arizona Time'
-                if timezone == "Mountain":
-                    utc_datetime = "{0}-{1}-{2} {3}:{4}:{5}".format(year, month, day, hour_int, minute_int, second)
-                    tz_time = utc2custom(utc_datetime, "US/Mountain")
-                    year = tz_time.year
-                    month = tz_time.month
-                    day = tz_time.day
-                    hour = tz_time.hour
-                    minute = tz_time.minute
-                    hour_int = int(hour)
-                    minute_int = int(minute)
-                    timezone_initialize = 'Mountain Time'
-                if timezone == "Central":
-                    utc_datetime = "{0}-{1}-{2} {3}:{4}:{5}".format(year, month, day, hour_int, minute_int, second)
-                    tz_time = utc2custom(utc_datetime, "US/Central")
-                    year = tz_time.year
-                    month = tz_time.month
-                    day = tz_time.day
-                    hour = tz_time.hour
-                    minute = tz_time.minute
-                    hour_int = int(hour)
-                    minute_int = int(minute)
-                    timezone_initialize = 'Central Time'
-                if timezone == "Eastern":
-                    utc_datetime = "{0}-{1}-{2} {3}:{4}:{5}".format(year, month, day, hour_int, minute_int, second)
-                    tz_time = utc2custom(utc_datetime, "US/Eastern")
-                    year = tz_time.year
-                    month = tz_time.month
-                    day = tz_time.day
-                    hour = tz_time.hour
-                    minute = tz_time.minute
-                    hour_int = int(hour)
-                    minute_int = int(minute)
-                    timezone_initialize = 'Eastern Time'
-            value = info[7].split('<')
-            value1 = value[0].replace('>', '')
-            value2 = float(value1)
-            time_series_list_api.append([datetime(year, month, day, hour_int, minute_int), value2])
-    except HTTPError:
-        failed = True
-
-    # if comid is not None and len(comid) > 0:
-    #     print 'in loop'
-    #     got_comid = True
-    #     if forecast_range == "short_range":
-    #         print 'In Short'
-    #         comid_time = request.GET['comid_time']
-    #         forecast_range_initialize = 'Short'
-    #     elif forecast_range == "analysis_assim":
-    #         print 'In analsis and Assim'
-    #         forecast_date_end = request.GET['forecast_date_end']
-    #         forecast_range_initialize = 'Analysis and Assimilation'
-    #     else:
-    #         print "In Medium"
-    #         forecast_range_initialize = 'Medium'
-    #     print comid_time
-    #
-    #     url = 'https://apps.hydroshare.org/apps/nwm-forecasts/api/GetWaterML/?config={0}&geom=channel_rt&variable=streamflow&COMID={1}&lon=&lat=&startDate={2}&endDate={3}&time={4}&lag='.format(forecast_range, comid, forecast_date, forecast_date_end, comid_time)
-    #
-    #     try:
-    #
-    #         url_api = urllib2.urlopen(url)
-    #         data_api = url_api.read()
-    #         # print data_api
-    #         x = data_api.split('dateTimeUTC=')
-    #         x.pop(0)
-    #
-    #         for elm in x:
-    #             info = elm.split(' ')
-    #             time1 = info[0].replace('T', ' ')
-    #             time2 = time1.replace('"', '')
-    #             time3 = time2[:-3]
-    #             time4 = time3.split(' ')
-    #             time5 = time4[0].split('-')
-    #             timedate = time5
-    #             year = int(timedate[0])
-    #             month = int(timedate[1])
-    #             day = int(timedate[2])
-    #             timetime = time4[1]
-    #             time_split = timetime.split(':')
-    #             time_minute = time_split[1].replace(':', '')
-    #             hour = time_split[0]
-    #             minute = time_minute[1]
-    #             hour_int = int(hour)
-    #             minute_int = int(minute)
-    #             value = info[7].split('<')
-    #             value1 = value[0].replace('>', '')
-    #             value2 = float(value1)
-    #             time_series_list_api.append([datetime(year, month, day, hour_int, minute_int), value2])
-    #     except HTTPError:
-    #         failed = True
-
+    else:
+        comid_filler = fetch_optional(get_comid, latitude, longitude)
+
+    forecast = get_forecast_options(request, before_str, now_str, now_str)
+
+    def fetch_series():
+        forecast_fetches = get_forecast_fetches(forecast, comid_filler)
+        results = fetch_concurrently(lambda: fetch_optional(get_ahps_data, gauge_id),
+                                     *[fetch for name, fetch in forecast_fetches])
+        data = results[0]
+        forecasts, forecast_failed, forecast_stale = combine_forecasts(forecast_fetches, results[1:])
+        # Convert AHPS stage and flow data to a usable format (NOT INCLUDING METADATA)
+        with timing.stage('parse'):
+            stage_series, flow_series = convert_ahps_to_python(data) if data is not None else (Series(), Series())
+        return {'flow': flow_series, 'stage': stage_series,
+                'forecasts': forecasts, 'forecast_failed': forecast_failed,
+                'stale': forecast_stale or isinstance(data, StaleData),
+                'incomplete': data is None or comid_filler is None}
+
+    # The UTC series don't depend on the timezone, so switching it only repeats the conversion below
+    fetch_params = dict((name, forecast[name]) for name in FORECAST_FETCH_PARAMS)
+    fetch_params.update(comid=comid_filler)
+    series = cached_series('ahps', gauge_id, fetch_params, ('ahps', 'nwm'), fetch_series)
+
+    with timing.stage('convert'):
+        flow_data, timezone_initialize = convert_time_series_timezone(series['flow'], timezone)
+        stage_data = convert_time_series_timezone(series['stage'], timezone)[0]
+        forecast_series = forecast_plot_series(series['forecasts'], timezone)
+
+    # Check if AHPS flow and stage data exists
+    gotdata_flow = sum(series['flow'].values) > 0
+    gotdata_stage = sum(series['stage'].values) > 0
 
     # Plot AHPS flow data
     timeseries_plot = TimeSeries(
@@ -854,18 +813,10 @@ def ahps(request):
         series=[{
             'name': 'Streamflow',
             'data': flow_data
-        }, {
-            'name': 'Forecasted Streamflow',
-            'data': time_series_list_api
-        }],
-        colors=['#7cb5ec', '#b880e9']
+        }] + forecast_series,
+        colors=FORECAST_COLORS
     )
 
-    # Check if AHPS stagedata exists
-    gotdata_stage = False
-    if stage > 0:
-        gotdata_stage = True
-
     # Plot AHPS stage data
     timeseries_plot_stage = TimeSeries(
         height='500px',
@@ -897,7 +848,7 @@ def ahps(request):
                                       format='yyyy-mm-dd',
                                       start_view='month',
                                       today_button=True,
-                                      initial=forecast_date)
+                                      initial=forecast['forecast_date'])
 
     forecast_date_end_picker = DatePicker(name='forecast_date_end',
                                           display_text='Forecast Date End',
@@ -906,62 +857,71 @@ def ahps(request):
                                           format='yyyy-mm-dd',
                                           start_view='month',
                                           today_button=True,
-                                          initial=forecast_date_end)
+                                          initial=forecast['forecast_date_end'])
 
     forecast_range_select = SelectInput(display_text='Forecast Size',
                                         name='forecast_range',
                                         multiple=False,
-                                        options=[('Analysis and Assimilation', 'analysis_assim'),
-                                                 ('Short', 'short_range'), ('Medium', 'medium_range')],
-                                        initial=forecast_range_initialize,
+                                        options=FORECAST_RANGE_OPTIONS,
+                                        initial=forecast['forecast_range_initialize'],
                                         original=True)
 
-    comid_time = comid_set_time(comid_time)
-
     forecast_time_select = SelectInput(display_text='Start Time (UTC)',
                                        name='comid_time',
                                        multiple=False,
-                                       options=[('00:00', "00"), ('01:00', "01"), ('02:00', "02"), ('03:00', "03"),
-                                                ('04:00', "04"), ('05:00', "05"), ('06:00', "06"), ('07:00', "07"),
-                                                ('08:00', "08"), ('09:00', "09"), ('10:00', "10"), ('11:00', "11"),
-                                                ('12:00', "12"), ('13:00', "13"), ('14:00', "14"), ('15:00', "15"),
-                                                ('16:00', "16"), ('17:00', "17"), ('18:00', "18"), ('19:00', "19"),
-                                                ('20:00', "20"), ('21:00', "21"), ('22:00', "22"), ('23:00', "23")],
-                                       initial=comid_time,
+                                       options=FORECAST_TIME_OPTIONS,
+                                       initial=comid_set_time(forecast['comid_time']),
                                        original=True)
 
     timezone_select = SelectInput(display_text='Timezone',
                                   name='timezone',
                                   multiple=False,
-                                  options=[('Coordinated Time', 'UTC'),
-                                           ('Hawaii Time', 'Hawaii'),
-                                           ('Alaska Time', 'Alaska'),
-                                           ('Pacific Time', 'Pacific'),
-                                           ('Arizona Time', 'Arizona'),
-                                           ('Mountain Time', 'Mountain'),
-                                           ('Central Time', 'Central'),
-                                           ('Eastern Time', 'Eastern')],
+                                  options=[(label, name) for name, zone, label in TIMEZONES],
                                   initial=timezone_initialize,
                                   original=True)
 
     context = {"gaugeno": gauge_id, "waterbody": waterbody, "timeseries_plot": timeseries_plot,
-                "gotdata_flow": gotdata_flow, "timeseries_plot_stage": timeseries_plot_stage,
-                "gotdata_stage": gotdata_stage, "lat": latitude, "long": longitude,
-                "generate_graphs_button": generate_graphs_button, "comid_input": comid_input,
-                "forecast_date_picker": forecast_date_picker, "forecast_date_end_picker": forecast_date_end_picker,
-                "forecast_range_select": forecast_range_select, "forecast_time_select": forecast_time_select,
-                "comid": comid, "gotComid": got_comid, "forecast_failed": failed, "timezone_select": timezone_select, "timezone": timezone}
+               "gotdata_flow": gotdata_flow, "timeseries_plot_stage": timeseries_plot_stage,
+               "gotdata_stage": gotdata_stage, "lat": latitude, "long": longitude,
+               "generate_graphs_button": generate_graphs_button, "comid_input": comid_input,
+               "forecast_date_picker": forecast_date_picker, "forecast_date_end_picker": forecast_date_end_picker,
+               "forecast_range_select": forecast_range_select, "forecast_time_select": forecast_time_select,
+               "comid": comid, "gotComid": forecast['got_comid'], "forecast_failed": series['forecast_failed'],
+               "stale_data": series['stale'], "incomplete_data": series['incomplete'],
+               "timezone_select": timezone_select, "timezone": timezone_display}
 
-    return render(request, 'gaugeview/ahps.html', context)
+    return context
 
 
 @login_required()
+@timing.timed_view('usgs')
+@metrics.counted_view('usgs')
+@profiling.profiled('usgs')
+@sheds_load
 def usgs(request):
     """
     Controller for the app usgs page.
     :param request: Is the URL request of the page
     :return: renders the page with context available
     """
+    record_request('usgs', request.GET['gaugeid'], request.GET['lat'], request.GET['long'])
+    # Upstream calls share the page's latency budget, whatever has not answered by then is left off the page
+    with upstream.deadline(get_setting('GAUGEVIEW_PAGE_BUDGET', 20.0)):
+        context = usgs_context(request)
+
+    # Gizmos are rendered by the template
+    with timing.stage('render'):
+        return render(request, 'gaugeview/usgs.html', context)
+
+
+@cached_page_context('usgs', 'gaugeid', USGS_PAGE_PARAMS, ('iv', 'dv', 'comid', 'nwm'))
+@admitted('page')
+def usgs_context(request):
+    """
+    Fetches the NWIS and NWM data for a gauge and builds the plots and gizmos of the usgs page
+    :param request: Is the URL request of the page
+    :return: Returns the context for the usgs.html template
+    """
     # DETERMINE WHAT DATA IS NEEDED (GaugeViewer 308)...
     gauge_id = request.GET['gaugeid']
     waterbody = request.GET['waterbody']
@@ -969,410 +929,60 @@ def usgs(request):
     end = request.GET['end']
     lat = request.GET['lat']
     long = request.GET['long']
-    do_forecast = request.GET.get("forecast_range", None)
     comid = None
-    forecast_range = 'analysis_assim'
-    forecast_range_initialize = 'Analysis and Assimilation'
-    forecast_date = start
-    forecast_date_end = end
-    comid_time = "06"
-    got_comid = False
-    failed = False
-    timezone_initialize = 'Coordinated Time'
-    timezone = request.GET.get('timezone', None)
-    if timezone is None:
-        timezone = 'Coordinated'
+    timezone, timezone_display = get_request_timezone(request)
 
-    # Get Closest COMID to gauge
-    # comid_filler = str(json.loads(urllib2.urlopen('https://ofmpub.epa.gov/waters10/PointIndexing.Service?pGeometry=POINT(' + long + '+' + lat + ')').read())['output']['ary_flowlines'][0]['comid'])
-    comid_filler = get_comid(lat, long)
-
-    if do_forecast is not None:
-        forecast_range = request.GET['forecast_range']
+    # Get Closest COMID to gauge, unless the user entered one
+    if request.GET.get("forecast_range", None) is not None:
         comid = request.GET['comid']
         comid_filler = comid
-        forecast_date = request.GET['forecast_date']
-        # comid_time = request.GET['comid_time']
-
-    inst_data = get_usgs_iv_data(gauge_id, start, end)
-    metadata, inst_data = convert_usgs_iv_to_python(inst_data)
-    inst_time_series_list = create_time_series_usgs(inst_data)
-    timezone_list = []
-    if request.GET.get('initial'):
-        inst_time_series_list = inst_time_series_list
-        timezone_initialize = 'Coordinated Time'
     else:
-        timezone = request.GET['timezone']
-        if timezone == "UTC":
-            inst_time_series_list = inst_time_series_list
-            timezone_initialize = 'Coordinated Time'
-        if timezone == "Hawaii":
-            for instant in inst_time_series_list:
-                utc_date = instant[0]
-                utc_flow = instant[1]
-                utc_year = utc_date.year
-                utc_month = utc_date.month
-                utc_day = utc_date.day
-                utc_hour = utc_date.hour
-                utc_minute = utc_date.minute
-                utc_second = 00
-                utc_datetime = "{0}-{1}-{2} {3}:{4}:{5}".format(utc_year, check_digit(utc_month), check_digit(utc_day), check_digit(utc_hour), check_digit(utc_minute), utc_second)
-                tz_time = utc2custom(utc_datetime, "US/Hawaii")
-                year = tz_time.year
-                month = tz_time.month
-                day = tz_time.day
-                hour = tz_time.hour
-                minute = tz_time.minute
-                hour_int = int(hour)
-                minute_int = int(minute)
-                timezone_initialize = 'Hawaii Time'
-                timezone_list.append([datetime(year, month, day, hour_int, minute_int), utc_flow])
-            inst_time_series_list = timezone_list
-        if timezone == "Alaska":
-            for instant in inst_time_series_list:
-                utc_date = instant[0]
-                utc_flow = instant[1]
-                utc_year = utc_date.year
-                utc_month = utc_date.month
-                utc_day = utc_date.day
-                utc_hour = utc_date.hour
-                utc_minute = utc_date.minute
-                utc_second = 00
-                utc_datetime = "{0}-{1}-{2} {3}:{4}:{5}".format(utc_year, check_digit(utc_month), check_digit(utc_day), check_digit(utc_hour), check_digit(utc_minute), utc_second)
-                tz_time = utc2custom(utc_datetime, "US/Alaska")
-                year = tz_time.year
-                month = tz_time.month
-                day = tz_time.day
-                hour = tz_time.hour
-                minute = tz_time.minute
-                hour_int = int(hour)
-                minute_int = int(minute)
-                timezone_initialize = 'Alaska Time'
-                timezone_list.append([datetime(year, month, day, hour_int, minute_int), utc_flow])
-            inst_time_series_list = timezone_list
-        if timezone == "Pacific":
-            for instant in inst_time_series_list:
-                utc_date = instant[0]
-                utc_flow = instant[1]
-                utc_year = utc_date.year
-                utc_month = utc_date.month
-                utc_day = utc_date.day
-                utc_hour = utc_date.hour
-                utc_minute = utc_date.minute
-                utc_second = 00
-                utc_datetime = "{0}-{1}-{2} {3}:{4}:{5}".format(utc_year, check_digit(utc_month), check_digit(utc_day), check_digit(utc_hour), check_digit(utc_minute), utc_second)
-                tz_time = utc2custom(utc_datetime, "US/Pacific")
-                year = tz_time.year
-                month = tz_time.month
-                day = tz_time.day
-                hour = tz_time.hour
-                minute = tz_time.minute
-                hour_int = int(hour)
-                minute_int = int(minute)
-                timezone_initialize = 'Pacific Time'
-                timezone_list.append([datetime(year, month, day, hour_int, minute_int), utc_flow])
-            inst_time_series_list = timezone_list
-        if timezone == "Arizona":
-            for instant in inst_time_series_list:
-                utc_date = instant[0]
-                utc_flow = instant[1]
-                utc_year = utc_date.year
-                utc_month = utc_date.month
-                utc_day = utc_date.day
-                utc_hour = utc_date.hour
-                utc_minute = utc_date.minute
-                utc_second = 00
-                utc_datetime = "{0}-{1}-{2} {3}:{4}:{5}".format(utc_year, check_digit(utc_month), check_digit(utc_day), check_digit(utc_hour), check_digit(utc_minute), utc_second)
-                tz_time = utc2custom(utc_datetime, "US/Arizona")
-                year = tz_time.year
-                month = tz_time.month
-                day = tz_time.day
-                hour = tz_time.hour
-                minute = tz_time.minute
-                hour_int = int(hour)
-                minute_int = int(minute)
-                timezone_initialize = 'Arizona Time'
-                timezone_list.append([datetime(year, month, day, hour_int, minute_int), utc_flow])
-            inst_time_series_list = timezone_list
-        if timezone == "Mountain":
-            for instant in inst_time_series_list:
-                utc_date = instant[0]
-                utc_flow = instant[1]
-                utc_year = utc_date.year
-                utc_month = utc_date.month
-                utc_day = utc_date.day
-                utc_hour = utc_date.hour
-                utc_minute = utc_date.minute
-                utc_second = 00
-                utc_datetime = "{0}-{1}-{2} {3}:{4}:{5}".format(utc_year, check_digit(utc_month), check_digit(utc_day), check_digit(utc_hour), check_digit(utc_minute), utc_second)
-                tz_time = utc2custom(utc_datetime, "US/Mountain")
-                year = tz_time.year
-                month = tz_time.month
-                day = tz_time.day
-                hour = tz_time.hour
-                minute = tz_time.minute
-                hour_int = int(hour)
-                minute_int = int(minute)
-                timezone_initialize = 'Mountain Time'
-                timezone_list.append([datetime(year, month, day, hour_int, minute_int), utc_flow])
-            inst_time_series_list = timezone_list
-        if timezone == "Central":
-            for instant in inst_time_series_list:
-                utc_date = instant[0]
-                utc_flow = instant[1]
-                utc_year = utc_date.year
-                utc_month = utc_date.month
-                utc_day = utc_date.day
-                utc_hour = utc_date.hour
-                utc_minute = utc_date.minute
-                utc_second = 00
-                utc_datetime = "{0}-{1}-{2} {3}:{4}:{5}".format(utc_year, check_digit(utc_month), check_digit(utc_day), check_digit(utc_hour), check_digit(utc_minute), utc_second)
-                tz_time = utc2custom(utc_datetime, "US/Central")
-                year = tz_time.year
-                month = tz_time.month
-                day = tz_time.day
-                hour = tz_time.hour
-                minute = tz_time.minute
-                hour_int = int(hour)
-                minute_int = int(minute)
-                timezone_initialize = 'Central Time'
-                timezone_list.append([datetime(year, month, day, hour_int, minute_int), utc_flow])
-            inst_time_series_list = timezone_list
-        if timezone == "Eastern":
-            for instant in inst_time_series_list:
-                utc_date = instant[0]
-                utc_flow = instant[1]
-                utc_year = utc_date.year
-                utc_month = utc_date.month
-                utc_day = utc_date.day
-                utc_hour = utc_date.hour
-                utc_minute = utc_date.minute
-                utc_second = 00
-                utc_datetime = "{0}-{1}-{2} {3}:{4}:{5}".format(utc_year, check_digit(utc_month), check_digit(utc_day), check_digit(utc_hour), check_digit(utc_minute), utc_second)
-                tz_time = utc2custom(utc_datetime, "US/Eastern")
-                year = tz_time.year
-                month = tz_time.month
-                day = tz_time.day
-                hour = tz_time.hour
-                minute = tz_time.minute
-                hour_int = int(hour)
-                minute_int = int(minute)
-                timezone_initialize = 'Eastern Time'
-                timezone_list.append([datetime(year, month, day, hour_int, minute_int), utc_flow])
-            inst_time_series_list = timezone_list
+        comid_filler = fetch_optional(get_comid, lat, long)
+
+    forecast = get_forecast_options(request, start, end, end)
+
+    def fetch_series():
+        forecast_fetches = get_forecast_fetches(forecast, comid_filler)
+        results = fetch_concurrently(lambda: fetch_optional(get_usgs_iv_data, gauge_id, start, end),
+                                     lambda: fetch_optional(get_usgs_dv_series, gauge_id, start, end),
+                                     *[fetch for name, fetch in forecast_fetches])
+        inst_data, dv_data = results[:2]
+        forecasts, forecast_failed, forecast_stale = combine_forecasts(forecast_fetches, results[2:])
+        # After the daily values, so the days they archived are not fetched again
+        dv_stats = fetch_optional(flowstats.get_flow_stats, gauge_id)
+        stale = forecast_stale or isinstance(inst_data, StaleData) or (dv_data is not None and dv_data[2])
+        incomplete = inst_data is None or dv_data is None or dv_stats is None or comid_filler is None
+        with timing.stage('parse'):
+            inst_data = convert_usgs_iv_to_python(inst_data)[1] if inst_data is not None else Series()
+            dv_data = dv_data[1] if dv_data is not None else Series()
+        return {'inst': inst_data, 'dv': dv_data, 'dv_stats': dv_stats,
+                'forecasts': forecasts, 'forecast_failed': forecast_failed, 'stale': stale,
+                'incomplete': incomplete}
+
+    # The UTC series don't depend on the timezone, so switching it only repeats the conversion below
+    fetch_params = dict((name, forecast[name]) for name in FORECAST_FETCH_PARAMS)
+    fetch_params.update(comid=comid_filler, start=start, end=end)
+    series = cached_series('usgs', gauge_id, fetch_params, ('iv', 'dv', 'nwm'), fetch_series)
+
+    with timing.stage('convert'):
+        inst_time_series_list, timezone_initialize = convert_time_series_timezone(series['inst'], timezone)
+        forecast_series = forecast_plot_series(series['forecasts'], timezone)
+        dv_time_series_list = series['dv'].pairs()
+        if series['dv_stats'] is not None:
+            dv_stats_series = flowstats.daily_stats_series(
+                series['dv_stats'], datetime.strptime(start, '%Y-%m-%d').date(),
+                min(datetime.strptime(end, '%Y-%m-%d').date(), datetime.now().date()))
+            flow_duration_series = flowstats.flow_duration_series(series['dv_stats'])
+        else:
+            dv_stats_series = flow_duration_series = []
+
+    # Skill of the analysis and assimilation at the hours the gauge observed
+    forecast_skill = None
+    if forecast['forecast_range'] == 'analysis_assim' and series['forecasts']:
+        forecast_skill = skill.compare(series['inst'], series['forecasts'][0][1])
 
     # Check if USGS instantaneous data exists for time frame
-    gotinstdata = False
-    if len(inst_time_series_list) > 0:
-        gotinstdata = True
-
-    # REFACTOR TO LINE "This + 40"
-    # URL for getting forecast data and in a list
-
-    time_series_list_api= []
-    comid_initial = comid_filler
-    if comid_initial is not None:
-        if request.GET.get('initial'):
-            got_comid = True
-            forecast_range = 'short_range'
-            t_now = datetime.now()
-            t_hour = t_now.hour
-            if t_hour > 7:
-                t_minus_hour = t_hour - 7
-                comid_time = check_digit(t_minus_hour)
-            else:
-                comid_time = '00'
-            # comid_time = '00'
-            forecast_date= end
-            forecast_date_end = end
-            forecast_range_initialize = 'Short'
-        else:
-            forecast_date = request.GET['forecast_date']
-            if forecast_range == "short_range":
-                # print 'In Short'
-                comid_time = request.GET['comid_time']
-                forecast_range_initialize = 'Short'
-            elif forecast_range == "analysis_assim":
-                # print 'In analsis and Assim'
-                forecast_date_end = request.GET['forecast_date_end']
-                forecast_range_initialize = 'Analysis and Assimilation'
-            else:
-                # print "In Medium"
-                forecast_range_initialize = 'Medium'
-
-            # print forecast_range
-            # print forecast_date
-            # print forecast_date_end
-            
-    url_api = 'https://apps.hydroshare.org/apps/nwm-forecasts/api/GetWaterML/?config={0}&geom=channel_rt&variable=streamflow&COMID={1}&lon=&lat=&startDate={2}&endDate={3}&time={4}&lag='.format(forecast_range, comid_initial, forecast_date, forecast_date_end, comid_time)
-        # print url_api_initial
-    try:
-        url_api = urllib2.urlopen(url_api)
-        data_api = url_api.read()
-        x = data_api.split('dateTimeUTC=')
-        x.pop(0)
-
-        for elm in x:
-            info = elm.split(' ')
-            time1 = info[0].replace('T', ' ')
-            time2 = time1.replace('"', '')
-            time3 = time2[:-3]
-            time4 = time3.split(' ')
-            time5 = time4[0].split('-')
-            timedate = time5
-            year = int(timedate[0])
-            month = int(timedate[1])
-            day = int(timedate[2])
-            timetime = time4[1]
-            time_split = timetime.split(':')
-            time_minute = time_split[1].replace(':', '')
-            hour = time_split[0]
-            second = 0
-            hour_int = int(hour)
-            minute_int = int(time_minute)
-            if request.GET.get('initial'):
-                minute_int = int(time_minute)
-                timezone_initialize = 'Coordinated Time'
-            else:
-                timezone = request.GET['timezone']
-                if timezone == "UTC":
-                    minute_int = int(time_minute)
-                    timezone_initialize = 'Coordinated Time'
-                if timezone == "Hawaii":
-                    utc_datetime = "{0}-{1}-{2} {3}:{4}:{5}".format(year, month, day, hour_int, minute_int, second)
-                    tz_time = utc2custom(utc_datetime, "US/Hawaii")
-                    year = tz_time.year
-                    month = tz_time.month
-                    day = tz_time.day
-                    hour = tz_time.hour
-                    minute = tz_time.minute
-                    hour_int = int(hour)
-                    minute_int = int(minute)
-                    timezone_initialize = 'Hawaii Time'
-                if timezone == "Alaska":
-                    utc_datetime = "{0}-{1}-{2} {3}:{4}:{5}".format(year, month, day, hour_int, minute_int, second)
-                    tz_time = utc2custom(utc_datetime, "US/Alaska")
-                    year = tz_time.year
-                    month = tz_time.month
-                    day = tz_time.day
-                    hour = tz_time.hour
-                    minute = tz_time.minute
-                    hour_int = int(hour)
-                    minute_int = int(minute)
-                    timezone_initialize = 'Alaska Time'
-                if timezone == "Pacific":
-                    utc_datetime = "{0}-{1}-{2} {3}:{4}:{5}".format(year, month, day, hour_int, minute_int, second)
-                    tz_time = utc2custom(utc_datetime, "US/Pacific")
-                    year = tz_time.year
-                    month = tz_time.month
-                    day = tz_time.day
-                    hour = tz_time.hour
-                    minute = tz_time.minute
-                    hour_int = int(hour)
-                    minute_int = int(minute)
-                    timezone_initialize = 'Pacific Time'
-                if timezone == "Arizona":
-                    utc_datetime = "{0}-{1}-{2} {3}:{4}:{5}".format(year, month, day, hour_int, minute_int, second)
-                    tz_time = utc2custom(utc_datetime, "US/Arizona")
-                    year = tz_time.year
-                    month = tz_time.month
-                    day = tz_time.day
-                    hour = tz_time.hour
-                    minute = tz_time.minute
-                    hour_int = int(hour)
-                    minute_int = int(minute)
-                    timezone_initialize = 'Arizona Time'
-                if timezone == "Mountain":
-                    utc_datetime = "{0}-{1}-{2} {3}:{4}:{5}".format(year, month, day, hour_int, minute_int, second)
-                    tz_time = utc2custom(utc_datetime, "US/Mountain")
-                    year = tz_time.year
-                    month = tz_time.month
-                    day = tz_time.day
-                    hour = tz_time.hour
-                    minute = tz_time.minute
-                    hour_int = int(hour)
-                    minute_int = int(minute)
-                    timezone_initialize = 'Mountain Time'
-                if timezone == "Central":
-                    utc_datetime = "{0}-{1}-{2} {3}:{4}:{5}".format(year, month, day, hour_int, minute_int, second)
-                    tz_time = utc2custom(utc_datetime, "US/Central")
-                    year = tz_time.year
-                    month = tz_time.month
-                    day = tz_time.day
-                    hour = tz_time.hour
-                    minute = tz_time.minute
-                    hour_int = int(hour)
-                    minute_int = int(minute)
-                    timezone_initialize = 'Central Time'
-                if timezone == "Eastern":
-                    utc_datetime = "{0}-{1}-{2} {3}:{4}:{5}".format(year, month, day, hour_int, minute_int, second)
-                    tz_time = utc2custom(utc_datetime, "US/Eastern")
-                    year = tz_time.year
-                    month = tz_time.month
-                    day = tz_time.day
-                    hour = tz_time.hour
-                    minute = tz_time.minute
-                    hour_int = int(hour)
-                    minute_int = int(minute)
-                    timezone_initialize = 'Eastern Time'
-            value = info[7].split('<')
-            value1 = value[0].replace('>', '')
-            value2 = float(value1)
-            time_series_list_api.append([datetime(year, month, day, hour_int, minute_int), value2])
-    except HTTPError:
-        failed = True
-
-    # print time_series_list_api
-
-    # time_series_list_api = []
-    # if comid is not None and len(comid) > 0:
-    #     # print 'in loop'
-    #     got_comid = True
-    #     if forecast_range == "short_range":
-    #         # print 'In Short'
-    #         comid_time = request.GET['comid_time']
-    #         forecast_range_initialize = 'Short'
-    #     elif forecast_range == "analysis_assim":
-    #         # print 'In analsis and Assim'
-    #         forecast_date_end = request.GET['forecast_date_end']
-    #         forecast_range_initialize = 'Analysis and Assimilation'
-    #     else:
-    #         # print "In Medium"
-    #         forecast_range_initialize = 'Medium'
-    #     # print comid_time
-    #     url = 'https://apps.hydroshare.org/apps/nwm-forecasts/api/GetWaterML/?config={0}&geom=channel_rt&variable=streamflow&COMID={1}&lon=&lat=&startDate={2}&endDate={3}&time={4}&lag='.format(forecast_range, comid, forecast_date, forecast_date_end, comid_time)
-    #     print url
-    #
-    #     try:
-    #         url_api = urllib2.urlopen(url)
-    #         data_api = url_api.read()
-    #         x = data_api.split('dateTimeUTC=')
-    #         x.pop(0)
-    #
-    #         for elm in x:
-    #             info = elm.split(' ')
-    #             time1 = info[0].replace('T', ' ')
-    #             time2 = time1.replace('"', '')
-    #             time3 = time2[:-3]
-    #             time4 = time3.split(' ')
-    #             time5 = time4[0].split('-')
-    #             timedate = time5
-    #             year = int(timedate[0])
-    #             month = int(timedate[1])
-    #             day = int(timedate[2])
-    #             timetime = time4[1]
-    #             time_split = timetime.split(':')
-    #             time_minute = time_split[1].replace(':', '')
-    #             hour = time_split[0]
-    #             minute = time_minute[1]
-    #             hour_int = int(hour)
-    #             minute_int = int(minute)
-    #             value = info[7].split('<')
-    #             value1 = value[0].replace('>', '')
-    #             value2 = float(value1)
-    #             time_series_list_api.append([datetime(year, month, day, hour_int, minute_int), value2])
-    #     except HTTPError:
-    #         failed = True
+    gotinstdata = len(inst_time_series_list) > 0
 
     # Plot USGS data
     usgs_inst_plot = TimeSeries(
@@ -1385,21 +995,12 @@ def usgs(request):
         series=[{
             'name': 'Streamflow',
             'data': inst_time_series_list,
-        }, {
-            'name': 'Forecasted Streamflow',
-            'data': time_series_list_api
-        }],
-        colors=['#7cb5ec', '#b880e9']
+        }] + forecast_series,
+        colors=FORECAST_COLORS
     )
 
-    dv_data = get_usgs_dv_data(gauge_id, start, end)
-    metadata, dv_data = convert_usgs_dv_to_python(dv_data)
-    dv_time_series_list = create_time_series_usgs(dv_data, 'dv')
-
     # Check if USGS daily data exists for time frame
-    gotdvdata = False
-    if len(dv_time_series_list) > 0:
-        gotdvdata = True
+    gotdvdata = len(dv_time_series_list) > 0
 
     # Plot USGS data
     usgs_dv_plot = TimeSeries(
@@ -1412,7 +1013,25 @@ def usgs(request):
         series=[{
             'name': 'Streamflow',
             'data': dv_time_series_list,
-        }]
+        }] + dv_stats_series,
+        colors=DV_STATS_COLORS
+    )
+
+    # Check if the flow-duration curve of the daily values record could be computed
+    gotflowduration = len(flow_duration_series) > 0
+
+    # Plot the flow-duration curve
+    flow_duration_plot = LinePlot(
+        height='500px',
+        width='500px',
+        engine='highcharts',
+        title='Flow-Duration Curve',
+        subtitle='Daily values of the period of record',
+        x_axis_title='Exceedance Probability',
+        x_axis_units='%',
+        y_axis_title='Flow',
+        y_axis_units='cfs',
+        series=flow_duration_series
     )
 
     # Gizmos
@@ -1449,7 +1068,7 @@ def usgs(request):
                                       format='yyyy-mm-dd',
                                       start_view='month',
                                       today_button=True,
-                                      initial=forecast_date)
+                                      initial=forecast['forecast_date'])
 
     forecast_date_end_picker = DatePicker(name='forecast_date_end',
                                           display_text='Forecast Date End',
@@ -1463,56 +1082,87 @@ def usgs(request):
     forecast_range_select = SelectInput(display_text='Forecast Size',
                                         name='forecast_range',
                                         multiple=False,
-                                        options=[('Analysis and Assimilation', 'analysis_assim'),
-                                                 ('Short', 'short_range'), ('Medium', 'medium_range')],
-                                        initial=forecast_range_initialize,
+                                        options=FORECAST_RANGE_OPTIONS,
+                                        initial=forecast['forecast_range_initialize'],
                                         original=True)
 
-    comid_time = comid_set_time(comid_time)
-
     forecast_time_select = SelectInput(display_text='Start Time (UTC)',
                                        name='comid_time',
                                        multiple=False,
-                                       options=[('00:00', "00"), ('01:00', "01"), ('02:00', "02"), ('03:00', "03"),
-                                                ('04:00', "04"), ('05:00', "05"), ('06:00', "06"), ('07:00', "07"),
-                                                ('08:00', "08"), ('09:00', "09"), ('10:00', "10"), ('11:00', "11"),
-                                                ('12:00', "12"), ('13:00', "13"), ('14:00', "14"), ('15:00', "15"),
-                                                ('16:00', "16"), ('17:00', "17"), ('18:00', "18"), ('19:00', "19"),
-                                                ('20:00', "20"), ('21:00', "21"), ('22:00', "22"), ('23:00', "23")],
-                                       initial=comid_time,
+                                       options=FORECAST_TIME_OPTIONS,
+                                       initial=comid_set_time(forecast['comid_time']),
                                        original=True)
 
     timezone_select = SelectInput(display_text='Timezone',
-                                        name='timezone',
-                                        multiple=False,
-                                        options=[('Coordinated Time', 'UTC'),
-                                                 ('Hawaii Time', 'Hawaii'),
-                                                 ('Alaska Time', 'Alaska'),
-                                                 ('Pacific Time', 'Pacific'),
-                                                 ('Arizona Time', 'Arizona'),
-                                                 ('Mountain Time', 'Mountain'),
-                                                 ('Central Time', 'Central'),
-                                                 ('Eastern Time', 'Eastern')],
-                                        initial=timezone_initialize,
-                                        original=True)
+                                  name='timezone',
+                                  multiple=False,
+                                  options=[(label, name) for name, zone, label in TIMEZONES],
+                                  initial=timezone_initialize,
+                                  original=True)
 
     context = {"gaugeid": gauge_id, "waterbody": waterbody, "generate_graphs_button": generate_graphs_button,
                "usgs_inst_plot": usgs_inst_plot, "got_inst_data": gotinstdata, "usgs_dv_plot": usgs_dv_plot,
-               "got_dv_data": gotdvdata, "usgs_start_date_picker": usgs_start_date_picker,
+               "got_dv_data": gotdvdata, "flow_duration_plot": flow_duration_plot,
+               "got_flow_duration": gotflowduration, "forecast_skill": forecast_skill,
+               "usgs_start_date_picker": usgs_start_date_picker,
                "usgs_end_date_picker": usgs_end_date_picker, "start": start, "end": end, "lat": lat, "long": long,
                "comid_input": comid_input, "forecast_date_picker": forecast_date_picker,
                "forecast_date_end_picker": forecast_date_end_picker, "forecast_range_select": forecast_range_select,
-               "forecast_time_select": forecast_time_select, "forecast_range": forecast_range, "comid": comid,
-               "gotComid": got_comid, "forecast_failed": failed, "timezone_select": timezone_select, "timezone": timezone}
+               "forecast_time_select": forecast_time_select, "forecast_range": forecast['forecast_range'],
+               "comid": comid, "gotComid": forecast['got_comid'], "forecast_failed": series['forecast_failed'],
+               "stale_data": series['stale'], "incomplete_data": series['incomplete'],
+               "timezone_select": timezone_select, "timezone": timezone_display}
 
-    return render(request, 'gaugeview/usgs.html', context)
+    return context
 
 
+def get_export_class(request):
+    """
+    :param request: URL request of a WaterML export
+    :return: 'bulk' for USGS exports spanning more than GAUGEVIEW_BULK_EXPORT_DAYS days, 'export' otherwise
+    """
+    if request.GET.get('type') not in ('usgsiv', 'usgsdv'):
+        return 'export'
+    try:
+        span = request.GET.get('span')
+        if span == 'all':
+            return 'bulk'
+        elif span:
+            period, units = span.split('-')
+            days = int(period) * {'y': 365, 'm': 31}.get(units, 1)
+        else:
+            days = (datetime.strptime(request.GET['end'], '%Y-%m-%d') -
+                    datetime.strptime(request.GET['start'], '%Y-%m-%d')).days
+    except (KeyError, ValueError):
+        # Let the view report the malformed request
+        return 'export'
+    return 'bulk' if days > get_setting('GAUGEVIEW_BULK_EXPORT_DAYS', 366) else 'export'
+
+
+@timing.timed_view('waterml')
+@metrics.counted_view('waterml')
+@profiling.profiled('waterml')
+@sheds_load
 def get_water_ml(request):
     """
     :param request: This URL request for the page includes GET information
     :return: This will return an XML file as a download, including all necessary information
     """
+    export = water_ml_export(request)
+    xml_response = HttpResponse(export['content'], content_type=export['content_type'])
+    xml_response['Content-Disposition'] = "attachment; filename=output-time-series.xml"
+    return xml_response
+
+
+@cached_page_context('waterml', 'gaugeid', WATERML_PARAMS, ('iv', 'dv', 'ahps'))
+@admitted(get_export_class)
+def water_ml_export(request):
+    """
+    Fetches the data of a WaterML export and renders it. Exports served from the cache are not held up by the
+    admission gate.
+    :param request: URL request of the export
+    :return: Dict of the content and content type of the WaterML, and whether stale data is in it
+    """
     gauge_type = request.GET['type']
 
     if gauge_type == 'usgsiv':
@@ -1543,8 +1193,7 @@ def get_water_ml(request):
 
         # Use the USGS IV Web Services Rest endpoint to download the proper xml document
         data = get_usgs_xml(gauge_id, start, end)
-        xml_response = HttpResponse(data, content_type='text/xml')
-        xml_response['Content-Disposition'] = "attachment; filename=output-time-series.xml"
+        content, content_type, stale = str(data), 'text/xml', isinstance(data, StaleData)
 
     elif gauge_type == 'usgsdv':
         gauge_id = request.GET['gaugeid']
@@ -1574,17 +1223,16 @@ def get_water_ml(request):
             start = request.GET['start']
             end = request.GET['end']
 
-        data = get_usgs_dv_data(gauge_id, start, end)
-        metadata, data = convert_usgs_dv_to_python(data)
-        time_series = format_ts_usgs_dv(data)
+        metadata, data, stale = get_usgs_dv_series(gauge_id, start, end)
+        with timing.stage('parse'):
+            time_series = format_ts_usgs_dv(data)
         metadata.update({'GaugeID': gauge_id, "Lat": latitude, "Long": longitude})
 
         context = {"metadata": metadata, "time_series": time_series}
 
-        xml_response = render_to_response('gaugeview/usgsdvwaterml.xml', context)
-        xml_response['Content-Type'] = 'application/xml'
-        # The following line can be uncommented to cause an XML to be downloaded...
-        xml_response['content-disposition'] = "attachment; filename=output-time-series.xml"
+        with timing.stage('render'):
+            content = render_to_response('gaugeview/usgsdvwaterml.xml', context).content
+        content_type = 'application/xml'
 
     elif gauge_type == 'ahps':
         gauge_id = request.GET['gaugeid']
@@ -1593,9 +1241,10 @@ def get_water_ml(request):
         variable = request.GET['var']
 
         data = get_ahps_data(gauge_id)
-        time_series = convert_ahps_to_python(data)
-
-        site = ElTree.fromstring(data)
+        stale = isinstance(data, StaleData)
+        with timing.stage('parse'):
+            stage_series, flow_series = convert_ahps_to_python(data)
+            site = ElTree.fromstring(data)
         name = site.get('name')
         request_time = site.get('generationtime')
         timezone_full = site.get('timezone')
@@ -1612,107 +1261,253 @@ def get_water_ml(request):
         metadata = {"GaugeID": gauge_id, "SiteName": name, "ReqTime": request_time, "Lat": latitude, "Long": longitude}
 
         if variable == 'flow':
-            time_series, units = format_ahps_ts(time_series, time_offset, 0)
+            time_series, units = format_ahps_ts(flow_series, time_offset)
             metadata.update({"VarCode": 0, "VarName": 'Flow', "UnitName": 'Cubic Feet per Second', "UnitAbbv": units})
         elif variable == 'stage':
-            time_series, units = format_ahps_ts(time_series, time_offset, 1)
+            time_series, units = format_ahps_ts(stage_series, time_offset)
             metadata.update({"VarCode": 1, "VarName": 'Stage', "UnitName": 'Feet', "UnitAbbv": units})
 
         context = {"metadata": metadata, "time_series": time_series}
 
-        xml_response = render_to_response('gaugeview/ahpswaterml.xml', context)
-        xml_response['Content-Type'] = 'application/xml'
-        # The following line can be uncommented to cause an XML to be downloaded...
-        xml_response['content-disposition'] = "attachment; filename=output-time-series.xml"
+        with timing.stage('render'):
+            content = render_to_response('gaugeview/ahpswaterml.xml', context).content
+        content_type = 'application/xml'
 
-    return xml_response
+    # Not cached with stale data, the next export should try the upstream service again
+    return {'content': content, 'content_type': content_type, 'stale_data': stale}
+
+
+@login_required()
+@timing.timed_view('nearest_gauges')
+@metrics.counted_view('nearest_gauges')
+def nearest_gauges(request):
+    """
+    Answers map clicks from the gauge catalog
+    :param request: GET lat and long of the click, radius in km (default 10), types (i.e. 'ahps,usgs') and limit
+    :return: JSON of the gauges within the radius, nearest first
+    """
+    try:
+        latitude = float(request.GET['lat'])
+        longitude = float(request.GET['long'])
+        radius = min(float(request.GET.get('radius', 10)), get_setting('GAUGEVIEW_NEAREST_MAX_RADIUS', 100.0))
+        limit = min(int(request.GET.get('limit', 50)), 200)
+    except (KeyError, ValueError):
+        return JsonResponse({'error': 'lat and long are required, radius and limit must be numbers'}, status=400)
+    kinds = [kind for kind in request.GET.get('types', 'ahps,usgs').split(',') if kind in catalog.CATALOG_LAYERS]
 
+    with timing.stage('catalog'):
+        gauges = catalog.nearest_gauges(latitude, longitude, radius, kinds, limit)
+    return JsonResponse({'gauges': gauges})
 
-def getOAuthHS(request):
 
-    client_id = getattr(settings, "SOCIAL_AUTH_HYDROSHARE_KEY", "None")
-    client_secret = getattr(settings, "SOCIAL_AUTH_HYDROSHARE_SECRET", "None")
+@login_required()
+@timing.timed_view('gauges_geojson')
+@metrics.counted_view('gauges_geojson')
+def gauges_geojson(request):
+    """
+    The gauges of the home map, clustered below CLUSTER_MAX_ZOOM. The map asks for the extents of its tiles, so the
+    same URLs come back and the long lived responses are reused.
+    :param request: GET bbox (min longitude, min latitude, max longitude, max latitude), zoom and types (i.e. 'ahps')
+    :return: A GeoJSON FeatureCollection
+    """
+    try:
+        bbox = [float(value) for value in request.GET['bbox'].split(',')]
+        zoom = int(request.GET['zoom'])
+        if len(bbox) != 4 or zoom < 0:
+            raise ValueError(bbox, zoom)
+    except (KeyError, ValueError):
+        return JsonResponse({'error': 'bbox (four numbers) and zoom are required'}, status=400)
+    kinds = [kind for kind in request.GET.get('types', 'ahps,usgs').split(',') if kind in catalog.CATALOG_LAYERS]
+
+    etag = '"{0}"'.format(hashlib.md5(repr((catalog.catalog_version(), bbox, zoom, kinds))).hexdigest())
+    if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+        response = HttpResponse(status=304)
+    else:
+        with timing.stage('catalog'):
+            features = catalog.gauge_features(bbox, zoom, kinds)
+        response = JsonResponse({'type': 'FeatureCollection', 'features': features})
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, max_age=get_setting('GAUGEVIEW_GEOJSON_MAX_AGE', 24 * 60 * 60))
+    return response
+
+
+def metrics_view(request):
+    """
+    Controller for the metrics scraped by Prometheus. When GAUGEVIEW_METRICS_TOKEN is set, requests must carry it as a
+    bearer token. Without it only signed in staff users get the metrics, set it for Prometheus to scrape them.
+    :param request: URL request for the metrics
+    :return: The metrics in the Prometheus text format
+    """
+    token = get_setting('GAUGEVIEW_METRICS_TOKEN', '')
+    if token:
+        authorized = constant_time_compare(request.META.get('HTTP_AUTHORIZATION', ''), 'Bearer ' + token)
+    else:
+        user = getattr(request, 'user', None)
+        authorized = user is not None and user.is_authenticated() and user.is_staff
+    if not authorized:
+        return HttpResponse('Unauthorized', content_type='text/plain', status=401)
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
-    # this line will throw out from django.core.exceptions.ObjectDoesNotExist if current user is not signed in via HydroShare OAuth
-    token = request.user.social_auth.get(provider='hydroshare').extra_data['token_dict']
-    auth = HydroShareAuthOAuth2(client_id, client_secret, token=token)
-    hs = HydroShare(auth=auth, hostname=hs_hostname)
 
-    return hs
+@login_required()
+def download_profile(request, name):
+    """
+    Controller for downloading a profile saved with ?profile=1, staff only
+    :param request: URL request, format=collapsed gets the collapsed stacks instead of the pstats file
+    :param name: Name of the profile, from the X-Profile header of the profiled response
+    :return: The profile as an attachment
+    """
+    if not request.user.is_staff:
+        raise Http404
+    extension = '.collapsed' if request.GET.get('format') == 'collapsed' else '.pstats'
+    path = profiling.profile_path(name, extension)
+    if path is None or not os.path.exists(path):
+        raise Http404
+    with open(path, 'rb') as f:
+        response = HttpResponse(f.read(), content_type='application/octet-stream')
+    response['Content-Disposition'] = 'attachment; filename={0}{1}'.format(name, extension)
+    return response
 
 
 @login_required()
+@timing.timed_view('upload_to_hydroshare')
+@metrics.counted_view('upload_to_hydroshare')
 def upload_to_hydroshare(request):
-
-    logger.debug("running upload_to_hydroshare!")
-    temp_dir = None
+    """
+    Controller queueing the upload of a WaterML link to HydroShare, see uploads.py
+    :param request: POST request with the title, abstract, comma separated keywords, waterml_link and public flag of
+    the resource
+    :return: JSON with the job_id to poll upload_status with, or an error
+    """
+    if request.method != 'POST':
+        return JsonResponse({})
+    post_data = request.POST
     try:
-        return_json = {}
-        if request.method == 'POST':
-            post_data = request.POST
+        # Fail right away rather than in the background when the user did not sign in with HydroShare
+        request.user.social_auth.get(provider='hydroshare')
+    except ObjectDoesNotExist:
+        logger.error("ObjectDoesNotExist")
+        return JsonResponse({'error': uploads.LOGIN_EXPIRED})
+
+    if request.is_secure():
+        front_end = 'https://'
+    else:
+        front_end = 'http://'
+    waterml_url = front_end + request.get_host() + post_data['waterml_link']
+    logger.debug(waterml_url)
 
-            if request.is_secure():
-                front_end = 'https://'
-            else:
-                front_end = 'http://'
-
-            waterml_url = front_end + request.get_host() + post_data['waterml_link']
-            logger.debug(waterml_url)
-
-            r_title = post_data['title']
-            r_abstract = post_data['abstract']
-            r_keywords_raw = post_data['keyword']
-            r_keywords = r_keywords_raw.split(',')
-            r_type = 'RefTimeSeriesResource'
-
-            r_public = post_data['public']
-
-            res_id = None
-            # hs = getOAuthHS(request)
-            hs = get_oauth_hs(request)
-
-            ref_type = "rest"
-            metadata = []
-            metadata.append({"referenceurl": {"value": waterml_url, "type": ref_type}})
-            logger.debug(metadata)
-            res_id = hs.createResource(r_type,
-                                       r_title,
-                                       resource_file=None,
-                                       keywords=r_keywords,
-                                       abstract=r_abstract,
-                                       metadata=json.dumps(metadata))
-
-            if res_id is not None:
-                if r_public.lower() == 'true':
-                    hs.setAccessRules(res_id, public=True)
-                return_json['success'] = 'File uploaded successfully!'
-                return_json['newResource'] = res_id
-                return_json['hs_hostname'] = hs.hostname
-            else:
-                raise
+    job_id = uploads.enqueue(request.user, post_data['title'], post_data['abstract'], post_data['keyword'].split(','),
+                             waterml_url, post_data['public'].lower() == 'true')
+    return JsonResponse({'job_id': job_id, 'status': uploads.QUEUED})
+
+
+@login_required()
+@metrics.counted_view('upload_status')
+def upload_status(request, job_id):
+    """
+    Controller polled for the status of an upload queued by upload_to_hydroshare
+    :param request: URL request
+    :param job_id: Id returned by upload_to_hydroshare
+    :return: JSON with the status of the job, plus success, newResource and hs_hostname once it succeeded or error
+    once it failed
+    """
+    job = uploads.get_job(job_id, request.user)
+    if job is None:
+        raise Http404
+    uploads.start_workers()
+    return JsonResponse(upload_result(job))
+
+
+def upload_result(job):
+    """
+    :param job: Dict of an upload job
+    :return: The dict of its status, plus success, newResource and hs_hostname once it succeeded or error once it
+    failed
+    """
+    return_json = {'job_id': job['job_id'], 'status': job['status'], 'attempts': job['attempts']}
+    if job['status'] == uploads.SUCCEEDED:
+        return_json['success'] = 'File uploaded successfully!'
+        return_json['newResource'] = job['resource_id']
+        return_json['hs_hostname'] = job['hs_hostname']
+    elif job['status'] == uploads.FAILED:
+        return_json['error'] = job['error']
+    return return_json
+
+
+@login_required()
+@timing.timed_view('publish_batch')
+@metrics.counted_view('publish_batch')
+def publish_batch(request):
+    """
+    Controller queueing the uploads of many gauges to HydroShare at once, see uploads.batch_items. The uploads run
+    concurrently in the upload workers, within the rate limit of the 'hydroshare' upstream service.
+    :param request: POST request with a JSON body of the gauges, each with its type, gauge_id, span and variable, the
+    title, abstract and keywords templates and the public flag. With the batch_id of an earlier batch, its failed
+    uploads are queued again and the gauges it doesn't have yet are added.
+    :return: JSON with the batch_id to poll publish_batch_status with and the job_id of each gauge, or its error
+    """
+    if request.method != 'POST':
+        return JsonResponse({})
+    try:
+        # Fail right away rather than in the background when the user did not sign in with HydroShare
+        request.user.social_auth.get(provider='hydroshare')
+    except ObjectDoesNotExist:
+        logger.error("ObjectDoesNotExist")
+        return JsonResponse({'error': uploads.LOGIN_EXPIRED})
 
-    except ObjectDoesNotExist as e:
-        logger.error ("ObjectDoesNotExist")
-        logger.exception(e.message)
-        return_json['error'] = 'Login timed out! Please re-sign in with your HydroShare account.'
-    except TokenExpiredError as e:
-        logger.exception(e.message)
-        return_json['error'] = 'Login timed out! Please re-sign in with your HydroShare account.'
-    except Exception, err:
-        logger.exception(err.message)
-        if "401 Unauthorized" in str(err):
-            return_json['error'] = 'Username or password invalid.'
-        elif "400 Bad Request" in str(err):
-            return_json['error'] = 'File uploaded successfully despite 400 Bad Request Error.'
+    try:
+        post_data = json.loads(request.body)
+        if not isinstance(post_data, dict):
+            raise ValueError('expected a JSON object')
+        batch_id = post_data.get('batch_id')
+        if batch_id is not None and not (isinstance(batch_id, basestring) and uploads.BATCH_ID.match(batch_id)):
+            raise ValueError('unknown batch')
+        if batch_id is None or post_data.get('gauges'):
+            items = uploads.batch_items(post_data.get('gauges'), post_data.get('title'), post_data.get('abstract'),
+                                        post_data.get('keywords'))
+        else:
+            items = []
+        if request.is_secure():
+            front_end = 'https://'
         else:
-            traceback.print_exc()
-            return_json['error'] = 'HydroShare rejected the upload for some reason.'
-    finally:
-        if temp_dir != None:
-            if os.path.exists(temp_dir):
-                shutil.rmtree(temp_dir)
-        return JsonResponse(return_json)
+            front_end = 'http://'
+        for item in items:
+            if 'waterml_query' in item:
+                item['waterml_url'] = '{0}{1}/apps/gaugeview/waterml/?{2}'.format(front_end, request.get_host(),
+                                                                                 item.pop('waterml_query'))
+        batch_id, job_ids = uploads.enqueue_batch(request.user, [item for item in items if 'error' not in item],
+                                                  bool(post_data.get('public')), batch_id)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    gauges = [{'gauge': item['gauge'], 'error': item['error']} for item in items if 'error' in item]
+    gauges += [{'gauge': gauge, 'job_id': job_id} for gauge, job_id in sorted(job_ids.items())]
+    return JsonResponse({'batch_id': batch_id, 'gauges': gauges})
+
 
+@login_required()
+@metrics.counted_view('publish_batch_status')
+def publish_batch_status(request, batch_id):
+    """
+    Controller polled for the status of the uploads of a batch queued by publish_batch
+    :param request: URL request
+    :param batch_id: Id returned by publish_batch
+    :return: JSON with the number of uploads of each status, and the status of the upload of each gauge as
+    upload_status answers it
+    """
+    jobs = uploads.get_batch(batch_id, request.user)
+    if not jobs:
+        raise Http404
+    uploads.start_workers()
+    counts = dict.fromkeys((uploads.QUEUED, uploads.RUNNING, uploads.SUCCEEDED, uploads.FAILED), 0)
+    gauges = []
+    for job in jobs:
+        counts[job['status']] += 1
+        result = upload_result(job)
+        result['gauge'] = job['gauge']
+        gauges.append(result)
+    done = counts[uploads.QUEUED] + counts[uploads.RUNNING] == 0
+    return JsonResponse({'batch_id': batch_id, 'done': done, 'counts': counts, 'gauges': gauges})
 
 
 # # METHOD 1: Hardcode zones:
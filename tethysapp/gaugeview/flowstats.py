@@ -0,0 +1,244 @@
+"""
+Statistics of the full daily values record of a USGS gauge, to show the current flow against its history: the
+percentiles and the minimum, median and maximum of each day of the year, and the flow-duration curve. They are
+computed with NumPy from the archived record and cached until new days are archived. Pages never fetch the record:
+until the archive covers it, a background thread backfills it and the pages show no statistics.
+"""
+import logging
+import os
+import threading
+import time
+import warnings
+from Queue import Queue
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+from . import timing
+from .archive import ABSENT, EPOCH_DAY, DailyArchive, backfill
+from .cache import get_cache
+from .config import get_setting
+
+logger = logging.getLogger(__name__)
+
+# Percentiles of the flows of each day of the year, and their names on the plot
+PERCENTILES = [10, 25, 50, 75, 90]
+PERCENTILE_NAMES = ['10th Percentile', '25th Percentile', 'Median', '75th Percentile', '90th Percentile']
+# Exceedance probabilities (percent) at which the flow-duration curve is sampled
+EXCEEDANCE = np.linspace(0, 100, 201)
+# Day of the year of the first of each month, in a leap year so February 29 is a day of its own
+MONTH_STARTS = np.cumsum([0, 31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30])
+
+_backfill_queue = Queue()
+_backfill_pending = set()
+_backfill_requested = {}
+_backfill_lock = threading.Lock()
+_backfill_pid = None
+
+
+def day_of_year(days):
+    """
+    :param days: Array of proleptic Gregorian ordinals
+    :return: Array of their day of the year from 0 to 365, March 1 being 60 in every year
+    """
+    dates = (np.asarray(days) - EPOCH_DAY).astype('datetime64[D]')
+    months = dates.astype('datetime64[M]')
+    return MONTH_STARTS[months.astype(int) % 12] + (dates - months).astype(int)
+
+
+def stats_start():
+    """
+    :return: The first day (date) of the record the statistics are computed from, GAUGEVIEW_FLOW_STATS_START
+    """
+    return datetime.strptime(get_setting('GAUGEVIEW_FLOW_STATS_START', '1900-01-01'), '%Y-%m-%d').date()
+
+
+def get_daily_record(gauge_id):
+    """
+    Read the daily values record of a gauge from the archive, without fetching anything from NWIS
+    :param gauge_id: USGS gauge id
+    :return: Arrays of the days (ordinals) and the values of the daily values record of the gauge since
+    GAUGEVIEW_FLOW_STATS_START, the days without a value left out, or None if the archive does not cover the days
+    since GAUGEVIEW_FLOW_STATS_START yet
+    """
+    dv_archive = DailyArchive(gauge_id)
+    state = dv_archive.state()
+    if state is None or state.covered_from > stats_start().toordinal():
+        return None
+    columns = dv_archive.columns()
+    if columns is None:
+        return None
+    first_day, values, codes = columns
+    values = np.frombuffer(values, dtype=np.float64)
+    days = first_day + np.arange(len(values))
+    absent = np.frombuffer(codes, dtype=np.uint8) == ABSENT
+    return days[~absent], values[~absent]
+
+
+def backfill_record(gauge_id):
+    """
+    Fetch the days of the record of a gauge the archive does not cover yet, from GAUGEVIEW_FLOW_STATS_START on. Only
+    one process backfills a gauge at a time.
+    :param gauge_id: USGS gauge id
+    """
+    # The prefetcher's file lock keeps the workers from fetching the same record
+    from .prefetch import FileLock
+
+    lock = FileLock('backfill-{0}'.format(''.join(c for c in gauge_id if c.isalnum())), blocking=False)
+    if not lock.acquire():
+        return
+    try:
+        start = stats_start()
+        state = DailyArchive(gauge_id).state()
+        if state is not None and state.covered_from <= start.toordinal():
+            return
+        end = date.fromordinal(state.covered_from - 1) if state is not None else date.today()
+        stored = backfill(gauge_id, start, end)
+        logger.info("backfilled %d daily values of %s from %s to %s", stored, gauge_id, start, end)
+    finally:
+        lock.release()
+
+
+def _backfill_forever():
+    while True:
+        gauge_id = _backfill_queue.get()
+        try:
+            backfill_record(gauge_id)
+        except Exception:
+            logger.exception("could not backfill the daily values record of %s", gauge_id)
+        finally:
+            with _backfill_lock:
+                _backfill_pending.discard(gauge_id)
+
+
+def request_backfill(gauge_id):
+    """
+    Have the backfill thread of this process fetch the record of a gauge, unless GAUGEVIEW_FLOW_STATS_BACKFILL is off
+    (then `python -m tethysapp.gaugeview.archive ingest` fills the archive). A gauge is requested again at most every
+    GAUGEVIEW_FLOW_STATS_BACKFILL_RETRY seconds, so a failing NWIS is not asked for the record on every page view.
+    :param gauge_id: USGS gauge id
+    """
+    global _backfill_pid
+    if not get_setting('GAUGEVIEW_FLOW_STATS_BACKFILL', True):
+        return
+    now = time.time()
+    with _backfill_lock:
+        if _backfill_pid != os.getpid():
+            # Threads don't survive a fork, each worker process starts its own
+            _backfill_pending.clear()
+            _backfill_requested.clear()
+            thread = threading.Thread(target=_backfill_forever, name='gaugeview-backfill')
+            thread.daemon = True
+            thread.start()
+            _backfill_pid = os.getpid()
+        retry = get_setting('GAUGEVIEW_FLOW_STATS_BACKFILL_RETRY', 10 * 60)
+        if gauge_id in _backfill_pending or now - _backfill_requested.get(gauge_id, 0) < retry:
+            return
+        _backfill_pending.add(gauge_id)
+        _backfill_requested[gauge_id] = now
+    _backfill_queue.put(gauge_id)
+
+
+def compute_flow_stats(days, values):
+    """
+    :param days: Array of the days (ordinals) of a daily values record
+    :param values: Array of its values, NWIS placeholders (-9999) included
+    :return: A dict of the statistics of the record, see get_flow_stats
+    """
+    valid = np.isfinite(values) & (values >= 0)
+    days = days[valid]
+    values = values[valid]
+    if not len(values):
+        return {'count': 0}
+
+    # One row of the table per day of the year holding the flows of that day sorted, padded with NaN
+    slots = day_of_year(days)
+    order = np.lexsort((values, slots))
+    slots = slots[order]
+    years = np.bincount(slots, minlength=366)
+    starts = np.cumsum(years) - years
+    table = np.full((366, years.max()), np.nan)
+    table[slots, np.arange(len(slots)) - starts[slots]] = values[order]
+
+    with warnings.catch_warnings():
+        # Days of the year without any flow (i.e. February 29 of short records) are all NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        daily = np.vstack([np.nanmin(table, axis=1), np.nanpercentile(table, PERCENTILES, axis=1),
+                           np.nanmax(table, axis=1)])
+    # Too few years make for meaningless percentiles
+    daily[:, years < get_setting('GAUGEVIEW_FLOW_STATS_MIN_YEARS', 10)] = np.nan
+
+    latest = values[np.argmax(days)]
+    return {'count': len(values), 'first_day': int(days.min()), 'last_day': int(days.max()),
+            'years': years, 'daily': daily,
+            'flow_duration': np.percentile(values, 100 - EXCEEDANCE),
+            'latest': (int(days.max()), float(latest),
+                       100.0 * np.count_nonzero(values >= latest) / (len(values) + 1))}
+
+
+def get_flow_stats(gauge_id):
+    """
+    :param gauge_id: USGS gauge id
+    :return: A dict with the number of values of the daily values record, and if there are any the first and last
+    days (ordinals), the number of values of each day of the year ('years'), a (7, 366) array of the minimum,
+    PERCENTILES and maximum flows of each day of the year ('daily', NaN for the days with too few years), the flows
+    exceeded EXCEEDANCE percent of the time ('flow_duration') and the day, value and exceedance probability of the
+    latest value ('latest'); or None until the archive covers the days since GAUGEVIEW_FLOW_STATS_START, the record
+    is then backfilled in the background (see request_backfill). Without GAUGEVIEW_DV_ARCHIVE there are no statistics.
+    """
+    if not get_setting('GAUGEVIEW_DV_ARCHIVE', True):
+        # The statistics are only computed from the archive
+        return {'count': 0}
+    try:
+        record = get_daily_record(gauge_id)
+    except (IOError, OSError):
+        logger.exception("could not use the daily values archive of %s", gauge_id)
+        return None
+    if record is None:
+        # Statistics of part of the record would be wrong, and cached for GAUGEVIEW_FLOW_STATS_TTL
+        request_backfill(gauge_id)
+        return None
+    days, values = record
+    # The statistics change only when days are added to the record
+    key = 'gaugeview:flowstats:{0}:{1}:{2}:{3}'.format(gauge_id.strip().upper(), len(days),
+                                                      days.min() if len(days) else 0, days.max() if len(days) else 0)
+    cache = get_cache()
+    stats = cache.get(key, 'flowstats')
+    if stats is None:
+        with timing.stage('stats'):
+            stats = compute_flow_stats(days, values)
+        cache.set(key, stats, get_setting('GAUGEVIEW_FLOW_STATS_TTL', 30 * 24 * 60 * 60), 'flowstats')
+    return stats
+
+
+def daily_stats_series(stats, start, end):
+    """
+    :param stats: The dict returned by get_flow_stats
+    :param start: First day (date) of the plot
+    :param end: Last day (date) of the plot
+    :return: The TimeSeries gizmo series of the daily statistics over the days of the plot
+    """
+    if not stats['count'] or end < start:
+        return []
+    days = np.arange(start.toordinal(), end.toordinal() + 1)
+    times = [datetime.combine(start + timedelta(days=offset), datetime.min.time()) for offset in range(len(days))]
+    names = ['Historical Minimum'] + PERCENTILE_NAMES + ['Historical Maximum']
+    series = []
+    for name, row in zip(names, stats['daily'][:, day_of_year(days)]):
+        data = [[time, value] for time, value in zip(times, row.tolist()) if value == value]
+        if data:
+            series.append({'name': name, 'data': data})
+    return series
+
+
+def flow_duration_series(stats):
+    """
+    :param stats: The dict returned by get_flow_stats
+    :return: The LinePlot gizmo series of the flow-duration curve and of the latest value
+    """
+    if not stats['count']:
+        return []
+    latest_day, latest_value, latest_exceedance = stats['latest']
+    return [{'name': 'Flow Duration', 'data': zip(EXCEEDANCE.tolist(), stats['flow_duration'].tolist())},
+            {'name': 'Latest Daily Flow ({0})'.format(date.fromordinal(latest_day).isoformat()),
+             'data': [[latest_exceedance, latest_value]]}]
@@ -0,0 +1,257 @@
+"""
+Authenticated HydroShare clients kept per user, so uploads in a row reuse the OAuth session, its HTTP connections
+and the resource types the client looked up. Tokens are refreshed shortly before they expire, and the refreshed token
+is saved to the user's social auth record so the other processes pick it up instead of refreshing it again. A user's
+client is dropped when the user logs out, in every process.
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from urlparse import urlparse
+
+from django.conf import settings
+from django.contrib.auth.signals import user_logged_out
+from django.dispatch import receiver
+from hs_restclient import HydroShare, HydroShareAuthOAuth2
+from oauthlib.oauth2 import OAuth2Error, TokenExpiredError
+
+from .cache import get_cache
+from .config import get_setting, upstream_url
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for the token refreshed by another process to be saved when its refresh used up the refresh token
+REFRESH_RACE_SECONDS = 2
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def _logout_key(user_id):
+    return 'gaugeview:hs-logout:{0}'.format(user_id)
+
+
+def load_token(user):
+    """
+    :param user: Django user signed in with HydroShare
+    :return: The OAuth token dict of the user
+    :raise ObjectDoesNotExist: If the user did not sign in with HydroShare
+    """
+    return user.social_auth.get(provider='hydroshare').extra_data['token_dict']
+
+
+def save_token(user, token):
+    """
+    Store a refreshed OAuth token in the user's social auth record
+    """
+    social = user.social_auth.get(provider='hydroshare')
+    social.extra_data['token_dict'] = token
+    if 'access_token' in social.extra_data:
+        social.extra_data['access_token'] = token['access_token']
+    social.save()
+
+
+def create_client(token):
+    """
+    :param token: OAuth token dict of a user
+    :return: A HydroShare client of the 'hydroshare' upstream URL authenticated with the token
+    """
+    url = urlparse(upstream_url('hydroshare'))
+    use_https = url.scheme == 'https'
+    auth = HydroShareAuthOAuth2(getattr(settings, 'SOCIAL_AUTH_HYDROSHARE_KEY', 'None'),
+                                getattr(settings, 'SOCIAL_AUTH_HYDROSHARE_SECRET', 'None'), hostname=url.hostname,
+                                use_https=use_https, port=url.port, token=dict(token))
+    return HydroShare(auth=auth, hostname=url.hostname, port=url.port, use_https=use_https)
+
+
+class PooledClient(object):
+    """
+    A HydroShare client of the pool, with the time it was created and last used
+    """
+    def __init__(self, hs, now):
+        self.hs = hs
+        self.created_at = now
+        self.last_used = now
+        self.lock = threading.Lock()
+
+    def close(self):
+        if self.hs.session is not None:
+            self.hs.session.close()
+
+    def use_token(self, token):
+        self.hs.auth.token = token
+        self.hs.session.token = token
+
+    def ensure_fresh(self, user, margin):
+        """
+        Refresh the token of the client if it expires within margin seconds
+        :param user: Django user of the client
+        :raise TokenExpiredError: If the token can't be refreshed, the user has to sign in again
+        """
+        with self.lock:
+            token = self.hs.auth.token
+            if token.get('expires_at', float('inf')) - time.time() > margin:
+                return
+            # Another process may have refreshed it already, refresh tokens can only be used once
+            stored = load_token(user)
+            if stored.get('expires_at', 0) > token.get('expires_at', 0):
+                self.use_token(dict(stored))
+                if stored['expires_at'] - time.time() > margin:
+                    return
+                token = self.hs.auth.token
+            if not token.get('refresh_token'):
+                raise TokenExpiredError()
+            try:
+                token = self.hs.session.refresh_token(self.hs.auth.token_url, refresh_token=token['refresh_token'],
+                                                      auth=(self.hs.auth.client_id, self.hs.auth.client_secret))
+            except OAuth2Error as e:
+                # Another process refreshing at the same time used up the refresh token (invalid_grant), use the
+                # token it refreshed once it is saved
+                deadline = time.time() + REFRESH_RACE_SECONDS
+                while True:
+                    stored = load_token(user)
+                    if stored.get('expires_at', 0) > token.get('expires_at', 0) and \
+                            stored['expires_at'] - time.time() > margin:
+                        self.use_token(dict(stored))
+                        logger.debug("using the HydroShare token of user %s refreshed by another process", user.pk)
+                        return
+                    if time.time() >= deadline:
+                        break
+                    time.sleep(0.2)
+                logger.warning("could not refresh the HydroShare token of user %s: %s", user.pk, e)
+                raise TokenExpiredError()
+            if 'expires_at' not in token and 'expires_in' in token:
+                token['expires_at'] = time.time() + int(token['expires_in'])
+            self.use_token(token)
+            save_token(user, token)
+            logger.debug("refreshed the HydroShare token of user %s", user.pk)
+
+
+class ClientPool(object):
+    """
+    HydroShare clients of the users of this process, least recently used first
+    :param max_clients: Most clients kept, the least recently used are closed beyond it
+    :param idle_seconds: Clients unused for this long are closed
+    :param refresh_margin: Tokens expiring within this many seconds are refreshed before a client is handed out
+    """
+    def __init__(self, max_clients, idle_seconds, refresh_margin):
+        self.max_clients = max_clients
+        self.idle_seconds = idle_seconds
+        self.refresh_margin = refresh_margin
+        self.created = 0
+        self.reused = 0
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remove(self, user_id, entry=None):
+        """
+        Close the client of a user, or only that entry if given and still pooled. Called with the lock held.
+        """
+        current = self._clients.get(user_id)
+        if current is not None and (entry is None or current is entry):
+            del self._clients[user_id]
+            current.close()
+
+    def prune(self, now=None):
+        """
+        Close the clients unused for idle_seconds, and the least recently used beyond max_clients
+        """
+        now = now if now is not None else time.time()
+        with self._lock:
+            for user_id, entry in self._clients.items():
+                if now - entry.last_used >= self.idle_seconds:
+                    self._remove(user_id)
+            while len(self._clients) > self.max_clients:
+                self._remove(next(iter(self._clients)))
+
+    def get(self, user):
+        """
+        :param user: Django user signed in with HydroShare
+        :return: The user's HydroShare client, with a token that won't expire within refresh_margin seconds
+        :raise ObjectDoesNotExist: If the user did not sign in with HydroShare
+        :raise TokenExpiredError: If the token expired and could not be refreshed
+        """
+        now = time.time()
+        self.prune(now)
+        logged_out_at = get_cache().get(_logout_key(user.pk), 'hs-clients', shared=True)
+        with self._lock:
+            entry = self._clients.pop(user.pk, None)
+            if entry is not None and logged_out_at is not None and logged_out_at >= entry.created_at:
+                # The user logged out in another process since the client was created
+                entry.close()
+                entry = None
+            if entry is not None:
+                self._clients[user.pk] = entry
+                entry.last_used = now
+                self.reused += 1
+        if entry is None:
+            created = PooledClient(create_client(load_token(user)), now)
+            with self._lock:
+                # Another thread may have created one meanwhile
+                entry = self._clients.get(user.pk)
+                if entry is None:
+                    entry = self._clients[user.pk] = created
+                    self.created += 1
+                else:
+                    created.close()
+            self.prune(now)
+        try:
+            entry.ensure_fresh(user, self.refresh_margin)
+        except TokenExpiredError:
+            with self._lock:
+                self._remove(user.pk, entry)
+            raise
+        return entry.hs
+
+    def discard(self, user_id):
+        """
+        Close the client of a user
+        """
+        with self._lock:
+            self._remove(user_id)
+
+    def stats(self):
+        """
+        :return: A dict of the number of clients pooled, created and reused
+        """
+        with self._lock:
+            return {'clients': len(self._clients), 'created': self.created, 'reused': self.reused}
+
+
+def get_pool():
+    """
+    :return: The client pool of this process, created from the GAUGEVIEW_HS_CLIENTS_* settings on first use
+    """
+    global _pool, _pool_pid
+    # Sessions don't survive a fork, each worker process creates its own pool
+    if _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool_pid != os.getpid():
+                _pool = ClientPool(get_setting('GAUGEVIEW_HS_CLIENTS_MAX', 100),
+                                   get_setting('GAUGEVIEW_HS_CLIENTS_IDLE_SECONDS', 15 * 60),
+                                   get_setting('GAUGEVIEW_HS_TOKEN_REFRESH_MARGIN', 5 * 60))
+                _pool_pid = os.getpid()
+    return _pool
+
+
+def get_client(user):
+    """
+    :param user: Django user signed in with HydroShare
+    :return: The user's pooled HydroShare client, see ClientPool.get
+    """
+    return get_pool().get(user)
+
+
+@receiver(user_logged_out)
+def discard_on_logout(sender, request, user, **kwargs):
+    if user is None:
+        return
+    pool = get_pool()
+    pool.discard(user.pk)
+    # The other processes drop their client of the user on its next use. Clients unused for idle_seconds are closed
+    # before that check, so the marker has to outlive them at least that long.
+    ttl = max(get_setting('GAUGEVIEW_HS_LOGOUT_TTL', 24 * 60 * 60), pool.idle_seconds)
+    get_cache().set(_logout_key(user.pk), time.time(), ttl, 'hs-clients', shared=True)
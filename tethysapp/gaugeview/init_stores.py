@@ -1 +1,20 @@
-# Put your persistent store initializer functions in here
\ No newline at end of file
+import logging
+
+from .model import Base, engine
+
+logger = logging.getLogger(__name__)
+
+
+def init_gaugeview_db(first_time):
+    """
+    Create the tables of the gauge catalog, and load the gauges the first time
+    :param first_time: Whether the persistent store was just created
+    """
+    Base.metadata.create_all(engine)
+    if first_time:
+        from .catalog import refresh_catalog
+        try:
+            refresh_catalog()
+        except Exception:
+            # syncstores should not fail when the gauge layers can't be reached, the catalog can be loaded later
+            logger.exception("could not load the gauge catalog, run python -m tethysapp.gaugeview.catalog refresh")
@@ -0,0 +1,289 @@
+"""
+Process-wide metrics in the Prometheus text format, served by the metrics view. Every worker keeps its own registry;
+when GAUGEVIEW_METRICS_DIR is set, workers also write their samples there so any of them can answer a scrape with
+the totals of the host.
+"""
+import json
+import os
+import resource
+import tempfile
+import threading
+import time
+from functools import wraps
+
+from .config import get_setting
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Name: (type, help) of every metric family
+METRICS = {
+    'gaugeview_upstream_request_seconds': ('histogram', 'Time spent on upstream requests, by outcome'),
+    'gaugeview_upstream_errors_total': ('counter', 'Failed upstream requests by kind of error'),
+    'gaugeview_upstream_response_bytes_total': ('counter', 'Bytes read from upstream services'),
+    'gaugeview_parse_rows_total': ('counter', 'Rows produced by the parsers'),
+    'gaugeview_parse_seconds_total': ('counter', 'Time spent in the parsers'),
+    'gaugeview_request_seconds': ('histogram', 'Time spent handling requests, by view'),
+    'gaugeview_in_flight_requests': ('gauge', 'Requests being handled, by view'),
+    'gaugeview_cache_requests_total': ('counter', 'Cache lookups by region and result'),
+    'gaugeview_cache_hit_ratio': ('gauge', 'Fraction of cache lookups that were hits, by region'),
+    'gaugeview_process_resident_memory_bytes': ('gauge', 'Resident memory of each worker process'),
+    'gaugeview_process_max_resident_memory_bytes': ('gauge', 'Peak resident memory of each worker process'),
+}
+
+SUFFIXES = ('_bucket', '_sum', '_count')
+
+
+class Registry(object):
+    """
+    Thread-safe store of samples, keyed by metric name and a tuple of (label, value) pairs
+    """
+    def __init__(self):
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, tuple(sorted(labels)))
+        with self._lock:
+            self._samples[key] = self._samples.get(key, 0) + value
+
+    def set(self, name, labels, value):
+        with self._lock:
+            self._samples[(name, tuple(sorted(labels)))] = value
+
+    def observe(self, name, labels, value, buckets=LATENCY_BUCKETS):
+        """
+        Add an observation to a histogram, incrementing every bucket whose bound it is under
+        """
+        labels = tuple(sorted(labels))
+        with self._lock:
+            for bound in buckets + (float('inf'),):
+                if value <= bound:
+                    key = (name + '_bucket', tuple(sorted(labels + (('le', format_bound(bound)),))))
+                    self._samples[key] = self._samples.get(key, 0) + 1
+            self._samples[(name + '_sum', labels)] = self._samples.get((name + '_sum', labels), 0) + value
+            self._samples[(name + '_count', labels)] = self._samples.get((name + '_count', labels), 0) + 1
+
+    def samples(self):
+        with self._lock:
+            return dict(self._samples)
+
+
+REGISTRY = Registry()
+
+_writer_pid = None
+_writer_lock = threading.Lock()
+
+
+def format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(float(bound))
+
+
+def observe_upstream(name, seconds, num_bytes=0, error=None):
+    """
+    :param name: One of the keys of config.UPSTREAM_URLS
+    :param seconds: How long the request took
+    :param num_bytes: Size of the response
+    :param error: Kind of error (i.e. 'http_503', 'network'), None if the request succeeded
+    """
+    labels = (('upstream', name),)
+    REGISTRY.observe('gaugeview_upstream_request_seconds', labels + (('outcome', 'error' if error else 'ok'),),
+                     seconds)
+    if error:
+        REGISTRY.inc('gaugeview_upstream_errors_total', labels + (('error', error),))
+    if num_bytes:
+        REGISTRY.inc('gaugeview_upstream_response_bytes_total', labels, num_bytes)
+
+
+def counted_parser(parser, rows=len):
+    """
+    Decorator counting the rows a parser produces and the time it takes
+    :param parser: Name of the parser in the metrics
+    :param rows: Function returning the number of rows from what the parser returned
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.time()
+            result = func(*args, **kwargs)
+            REGISTRY.inc('gaugeview_parse_seconds_total', (('parser', parser),), time.time() - started)
+            REGISTRY.inc('gaugeview_parse_rows_total', (('parser', parser),), rows(result))
+            return result
+        return wrapper
+    return decorator
+
+
+def counted_view(view_name):
+    """
+    Decorator tracking the requests of a view in flight and how long they take
+    :param view_name: Name of the view in the metrics
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            start_metrics_writer()
+            labels = (('view', view_name),)
+            REGISTRY.inc('gaugeview_in_flight_requests', labels)
+            started = time.time()
+            try:
+                return view(request, *args, **kwargs)
+            finally:
+                REGISTRY.inc('gaugeview_in_flight_requests', labels, -1)
+                REGISTRY.observe('gaugeview_request_seconds', labels, time.time() - started)
+        return wrapper
+    return decorator
+
+
+def resident_memory():
+    """
+    :return: The current resident memory of this process in bytes, or None where /proc is not available
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+
+
+def collect():
+    """
+    :return: The samples of this process, including the cache statistics and memory use read at this moment
+    """
+    # The cache module imports upstream, which records its metrics here
+    from .cache import get_cache
+
+    samples = REGISTRY.samples()
+    for region, counts in get_cache().get_stats()['regions'].items():
+        for result in ('hits', 'misses'):
+            key = ('gaugeview_cache_requests_total', (('region', region), ('result', result)))
+            samples[key] = counts.get(result, 0)
+
+    pid = (('pid', str(os.getpid())),)
+    memory = resident_memory()
+    if memory is not None:
+        samples[('gaugeview_process_resident_memory_bytes', pid)] = memory
+    # ru_maxrss is in kilobytes on Linux
+    samples[('gaugeview_process_max_resident_memory_bytes', pid)] = \
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return samples
+
+
+def write_samples(directory):
+    """
+    Write the samples of this process to GAUGEVIEW_METRICS_DIR, replacing what it wrote before
+    :param directory: The metrics directory
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    data = [[name, list(labels), value] for (name, labels), value in collect().items()]
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.metrics')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp_path, os.path.join(directory, '{0}.json'.format(os.getpid())))
+
+
+def read_samples(directory, max_age):
+    """
+    :param directory: The metrics directory
+    :param max_age: Files not updated for this many seconds (of workers that went away) are left out and removed
+    :return: The sum of the samples written by the workers of the host
+    """
+    samples = {}
+    now = time.time()
+    for filename in os.listdir(directory):
+        if not filename.endswith('.json'):
+            continue
+        path = os.path.join(directory, filename)
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                os.remove(path)
+                continue
+            with open(path) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            continue
+        for name, labels, value in data:
+            key = (name, tuple(tuple(label) for label in labels))
+            samples[key] = samples.get(key, 0) + value
+    return samples
+
+
+def _write_periodically(directory, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            write_samples(directory)
+        except (IOError, OSError):
+            pass
+
+
+def start_metrics_writer():
+    """
+    Start the thread writing this process's samples to GAUGEVIEW_METRICS_DIR every GAUGEVIEW_METRICS_INTERVAL
+    seconds. Does nothing when the directory isn't set; safe to call on every request.
+    """
+    global _writer_pid
+    directory = get_setting('GAUGEVIEW_METRICS_DIR', '')
+    if not directory or _writer_pid == os.getpid():
+        return
+    with _writer_lock:
+        if _writer_pid == os.getpid():
+            return
+        _writer_pid = os.getpid()
+    thread = threading.Thread(target=_write_periodically, name='gaugeview-metrics',
+                              args=(directory, get_setting('GAUGEVIEW_METRICS_INTERVAL', 15)))
+    thread.daemon = True
+    thread.start()
+
+
+def render():
+    """
+    :return: The samples of this process, or of all the workers of the host if GAUGEVIEW_METRICS_DIR is set, in the
+    Prometheus text format
+    """
+    directory = get_setting('GAUGEVIEW_METRICS_DIR', '')
+    if directory:
+        write_samples(directory)
+        samples = read_samples(directory, get_setting('GAUGEVIEW_METRICS_MAX_AGE', 300))
+    else:
+        samples = collect()
+
+    # Hit ratios are derived from the summed counts, a ratio can't be summed across workers
+    lookups = {}
+    for (name, labels), value in samples.items():
+        if name == 'gaugeview_cache_requests_total':
+            region = dict(labels)['region']
+            hits, total = lookups.get(region, (0, 0))
+            lookups[region] = (hits + (value if dict(labels)['result'] == 'hits' else 0), total + value)
+    for region, (hits, total) in lookups.items():
+        if total:
+            samples[('gaugeview_cache_hit_ratio', (('region', region),))] = float(hits) / total
+
+    families = {}
+    for (name, labels), value in samples.items():
+        family = name
+        for suffix in SUFFIXES:
+            if name.endswith(suffix) and name[:-len(suffix)] in METRICS:
+                family = name[:-len(suffix)]
+        families.setdefault(family, []).append((name, labels, value))
+
+    lines = []
+    for family in sorted(families):
+        kind, description = METRICS.get(family, ('untyped', ''))
+        lines.append('# HELP {0} {1}'.format(family, description))
+        lines.append('# TYPE {0} {1}'.format(family, kind))
+        for name, labels, value in sorted(families[family], key=sort_key):
+            label_text = ','.join('{0}="{1}"'.format(label, escape(label_value)) for label, label_value in labels)
+            lines.append('{0}{1} {2}'.format(name, '{' + label_text + '}' if label_text else '', repr(float(value))))
+    return '\n'.join(lines) + '\n'
+
+
+def sort_key(sample):
+    # Buckets are listed by increasing bound, after the other labels
+    name, labels, value = sample
+    bound = dict(labels).get('le')
+    return name, tuple(label for label in labels if label[0] != 'le'), float(bound) if bound else 0
+
+
+def escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
@@ -1 +1,98 @@
-# Put your persistent store models in this file
\ No newline at end of file
+from sqlalchemy import Boolean, Column, Float, Index, Integer, String, Text
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+from .app import GaugeviewerWml
+
+# DB engine, session maker and base of the gaugeview persistent store
+engine = GaugeviewerWml.get_persistent_store_engine('gaugeview_db')
+SessionMaker = sessionmaker(bind=engine)
+Base = declarative_base()
+
+
+class Gauge(Base):
+    """
+    An AHPS or USGS gauge of the catalog. cell_x and cell_y are the grid cell of its location (see catalog.grid_cell),
+    indexed so the gauges near a point are found without scanning the table.
+    """
+    __tablename__ = 'gauges'
+    __table_args__ = (Index('ix_gauges_cell', 'kind', 'cell_y', 'cell_x'),
+                      Index('ix_gauges_kind_gauge_id', 'kind', 'gauge_id', unique=True))
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(8), nullable=False)  # 'ahps' or 'usgs'
+    gauge_id = Column(String(32), nullable=False)  # AHPS GaugeLID or USGS STAID
+    waterbody = Column(String(255))
+    latitude = Column(Float, nullable=False)
+    longitude = Column(Float, nullable=False)
+    url = Column(String(255))
+    comid = Column(String(16))
+    cell_x = Column(Integer, nullable=False)
+    cell_y = Column(Integer, nullable=False)
+
+    def as_dict(self):
+        return {'type': self.kind, 'gauge_id': self.gauge_id, 'waterbody': self.waterbody,
+                'latitude': self.latitude, 'longitude': self.longitude, 'url': self.url, 'comid': self.comid}
+
+
+class SkillScore(Base):
+    """
+    Skill of the NWM analysis and assimilation at the reach of a USGS gauge over a window, against the observed
+    instantaneous flow (see skill.py). NSE, KGE, bias and RMSE are None when there were too few hours to compare,
+    error holds why a gauge could not be scored.
+    """
+    __tablename__ = 'skill_scores'
+    __table_args__ = (Index('ix_skill_scores_window', 'start', 'end', 'gauge_id', unique=True),)
+
+    id = Column(Integer, primary_key=True)
+    gauge_id = Column(String(32), nullable=False)
+    comid = Column(String(16))
+    start = Column(String(10), nullable=False)  # YYYY-MM-DD
+    end = Column(String(10), nullable=False)
+    hours = Column(Integer, nullable=False, default=0)  # Hours with both an observed and a simulated flow
+    nse = Column(Float)
+    kge = Column(Float)
+    bias = Column(Float)  # Percent
+    rmse = Column(Float)  # cfs
+    error = Column(String(255))
+    computed_at = Column(Float, nullable=False)  # Unix time
+
+    def as_dict(self):
+        return {'gauge_id': self.gauge_id, 'comid': self.comid, 'start': self.start, 'end': self.end,
+                'hours': self.hours, 'nse': self.nse, 'kge': self.kge, 'bias': self.bias, 'rmse': self.rmse,
+                'error': self.error, 'computed_at': self.computed_at}
+
+
+class UploadJob(Base):
+    """
+    A HydroShare upload queued by upload_to_hydroshare or publish_batch and run in the background (see uploads.py).
+    resource_id is stored as soon as the resource is created, so a retry of the remaining steps doesn't create it
+    again. The uploads of a batch share its batch_id, and a gauge has one job per batch.
+    """
+    __tablename__ = 'upload_jobs'
+    __table_args__ = (Index('ix_upload_jobs_status', 'status', 'next_attempt_at'),
+                      Index('ix_upload_jobs_batch_gauge', 'batch_id', 'gauge', unique=True))
+
+    id = Column(String(32), primary_key=True)
+    user_id = Column(Integer, nullable=False, index=True)  # Django user
+    status = Column(String(16), nullable=False)  # 'queued', 'running', 'succeeded' or 'failed'
+    title = Column(String(255), nullable=False)
+    abstract = Column(Text, nullable=False)
+    keywords = Column(Text, nullable=False)  # JSON list
+    waterml_url = Column(Text, nullable=False)
+    public = Column(Boolean, nullable=False, default=False)
+    resource_id = Column(String(32))
+    hs_hostname = Column(String(255))
+    attempts = Column(Integer, nullable=False, default=0)
+    error = Column(String(255))  # Message shown to the user
+    created_at = Column(Float, nullable=False)  # Unix times
+    updated_at = Column(Float, nullable=False)
+    next_attempt_at = Column(Float, nullable=False)
+    batch_id = Column(String(32))  # None for the uploads of upload_to_hydroshare
+    gauge = Column(String(64))  # Key of the gauge in its batch, see uploads.batch_items
+
+    def as_dict(self):
+        return {'job_id': self.id, 'status': self.status, 'title': self.title, 'resource_id': self.resource_id,
+                'hs_hostname': self.hs_hostname, 'attempts': self.attempts, 'error': self.error,
+                'created_at': self.created_at, 'updated_at': self.updated_at, 'batch_id': self.batch_id,
+                'gauge': self.gauge}
@@ -0,0 +1,266 @@
+"""
+Keeps the cache warm for the gauges users watch most. The ahps and usgs views count requests per gauge; the counts
+of all workers are merged in the shared cache tier. One prefetcher per host (a thread in whichever worker gets the
+lock first, or a sidecar started with `python -m tethysapp.gaugeview.prefetch`) refreshes the IV, AHPS and latest NWM
+data of the top gauges shortly before it would expire.
+"""
+import argparse
+import fcntl
+import logging
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+
+from .cache import get_cache, invalidate_gauge, source_ttl
+from .config import get_setting
+
+logger = logging.getLogger(__name__)
+
+POPULARITY_KEY = 'gaugeview:popularity'
+# Requests counted in a worker are merged into the shared counts at most this often (seconds)
+FLUSH_INTERVAL = 30
+# Counts halve every HALF_LIFE seconds, so the gauges of yesterday's event give way to today's
+HALF_LIFE = 6 * 60 * 60
+# Sources refreshed for each kind of gauge
+PREFETCH_SOURCES = {'usgs': ('iv', 'nwm'), 'ahps': ('ahps', 'nwm')}
+# Sources are refreshed once this fraction of their TTL has passed, so they never expire for popular gauges
+REFRESH_FRACTION = 0.8
+
+_local_counts = {}
+_local_lock = threading.Lock()
+_last_flush = [time.time()]
+_prefetcher_pid = None
+
+
+class FileLock(object):
+    """
+    Inter-process lock on a file next to the disk cache directory
+    :param name: Suffix of the lock file
+    :param blocking: If False, acquire() returns False instead of waiting when another process holds the lock
+    """
+    def __init__(self, name, blocking=True):
+        self.path = get_cache().disk.directory.rstrip(os.sep) + '.' + name + '.lock'
+        self.blocking = blocking
+        self._file = None
+
+    def acquire(self):
+        self._file = open(self.path, 'a')
+        flags = fcntl.LOCK_EX if self.blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(self._file, flags)
+        except IOError:
+            self._file.close()
+            self._file = None
+            return False
+        return True
+
+    def release(self):
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def record_request(kind, gauge_id, latitude, longitude):
+    """
+    Count a page request for a gauge
+    :param kind: 'usgs' or 'ahps'
+    :param gauge_id: USGS gauge id or AHPS gauge number, as the page was requested with
+    :param latitude: Latitude of the gauge, used to look up its COMID
+    :param longitude: Longitude of the gauge
+    """
+    key = (kind, gauge_id.strip())
+    with _local_lock:
+        count = _local_counts.get(key, (0,))[0]
+        _local_counts[key] = (count + 1, latitude, longitude)
+        flush = time.time() - _last_flush[0] >= FLUSH_INTERVAL
+    if flush:
+        flush_popularity()
+    start_prefetcher()
+
+
+def flush_popularity():
+    """
+    Merge the requests counted in this process into the shared counts
+    """
+    with _local_lock:
+        counts = dict(_local_counts)
+        _local_counts.clear()
+        _last_flush[0] = time.time()
+    if not counts:
+        return
+
+    cache = get_cache()
+    with FileLock('popularity'):
+        shared = cache.get(POPULARITY_KEY, 'popularity', shared=True) or {'updated': time.time(), 'gauges': {}}
+        now = time.time()
+        decay = 0.5 ** ((now - shared['updated']) / HALF_LIFE)
+        gauges = dict((key, (value[0] * decay,) + tuple(value[1:])) for key, value in shared['gauges'].items())
+        for key, (count, latitude, longitude) in counts.items():
+            gauges[key] = (gauges.get(key, (0,))[0] + count, latitude, longitude)
+        cache.set(POPULARITY_KEY, {'updated': now, 'gauges': gauges}, 7 * 24 * 60 * 60, 'popularity', shared=True)
+
+
+def popular_gauges(top_n):
+    """
+    :param top_n: Number of gauges to return
+    :return: A list of ((kind, gauge_id), (count, latitude, longitude)), most requested first
+    """
+    shared = get_cache().get(POPULARITY_KEY, 'popularity', shared=True)
+    if shared is None:
+        return []
+    gauges = sorted(shared['gauges'].items(), key=lambda item: item[1][0], reverse=True)
+    return gauges[:top_n]
+
+
+def refresh_source(kind, gauge_id, latitude, longitude, source):
+    """
+    Fetch the data an initial ahps or usgs page of the gauge shows from one source, replacing what is cached
+    :param kind: 'usgs' or 'ahps'
+    :param gauge_id: USGS gauge id or AHPS gauge number
+    :param latitude: Latitude of the gauge
+    :param longitude: Longitude of the gauge
+    :param source: 'iv', 'ahps' or 'nwm'
+    """
+    # The controllers use this module to count requests
+    from . import controllers
+
+    now = datetime.now()
+    today = now.strftime('%Y-%m-%d')
+    if source == 'iv':
+        # The map links USGS gauges to their last two weeks in local time, see main.js, so both days come from now
+        two_weeks_ago = (now - timedelta(days=14)).strftime('%Y-%m-%d')
+        controllers.get_usgs_iv_data.refresh(gauge_id, two_weeks_ago, today)
+    elif source == 'ahps':
+        controllers.get_ahps_data.refresh(gauge_id)
+    elif source == 'nwm':
+        comid = controllers.get_comid(latitude, longitude)
+        controllers.get_nwm_data.refresh('short_range', comid, today, today, controllers.latest_short_range_cycle(now))
+
+
+class PrefetchScheduler(object):
+    """
+    Refreshes the sources of the most requested gauges on the cadence of each source
+    :param top_n: Number of gauges kept warm (GAUGEVIEW_PREFETCH_TOP_N)
+    :param concurrency: Most upstream requests in flight at once (GAUGEVIEW_PREFETCH_CONCURRENCY)
+    :param jitter: Each refresh waits a random time up to this many seconds, so they don't hit upstreams in bursts
+    (GAUGEVIEW_PREFETCH_JITTER)
+    :param interval: Seconds between two rounds (GAUGEVIEW_PREFETCH_INTERVAL)
+    :param refresh: Function called as refresh(kind, gauge_id, latitude, longitude, source)
+    """
+    def __init__(self, top_n=None, concurrency=None, jitter=None, interval=None, refresh=refresh_source):
+        self.top_n = top_n if top_n is not None else get_setting('GAUGEVIEW_PREFETCH_TOP_N', 50)
+        self.concurrency = concurrency or get_setting('GAUGEVIEW_PREFETCH_CONCURRENCY', 4)
+        self.jitter = jitter if jitter is not None else get_setting('GAUGEVIEW_PREFETCH_JITTER', 5.0)
+        self.interval = interval or get_setting('GAUGEVIEW_PREFETCH_INTERVAL', 60)
+        self.refresh = refresh
+        self.last_refreshed = {}
+
+    def due_jobs(self, now=None):
+        """
+        :param now: Unix time, defaults to time.time()
+        :return: A list of (kind, gauge_id, latitude, longitude, source) whose cached data is about to expire
+        """
+        if now is None:
+            now = time.time()
+        jobs = []
+        for (kind, gauge_id), (count, latitude, longitude) in popular_gauges(self.top_n):
+            for source in PREFETCH_SOURCES[kind]:
+                last = self.last_refreshed.get((kind, gauge_id, source))
+                if last is None or now - last >= source_ttl(source) * REFRESH_FRACTION:
+                    jobs.append((kind, gauge_id, latitude, longitude, source))
+        return jobs
+
+    def _run_job(self, job):
+        time.sleep(random.uniform(0, self.jitter))
+        kind, gauge_id, latitude, longitude, source = job
+        try:
+            self.refresh(*job)
+        except Exception:
+            logger.warning("could not prefetch %s data of %s gauge %s", source, kind, gauge_id, exc_info=True)
+            return False
+        self.last_refreshed[(kind, gauge_id, source)] = time.time()
+        invalidate_gauge(gauge_id)
+        return True
+
+    def run_once(self):
+        """
+        Refresh everything that is due, at most `concurrency` at a time
+        :return: The number of jobs that succeeded, and the number of jobs that were due
+        """
+        jobs = self.due_jobs()
+        if not jobs:
+            return 0, 0
+        pool = ThreadPool(min(self.concurrency, len(jobs)))
+        try:
+            results = pool.map(self._run_job, jobs)
+        finally:
+            pool.close()
+            pool.join()
+        logger.info("prefetched %d of %d sources", sum(results), len(jobs))
+        return sum(results), len(jobs)
+
+    def run_forever(self):
+        """
+        Run rounds for as long as this process is the host's prefetcher. Other processes wait for the lock, so one
+        takes over if the prefetcher goes away.
+        """
+        lock = FileLock('prefetch', blocking=False)
+        while not lock.acquire():
+            time.sleep(self.interval)
+        logger.info("process %d is prefetching the top %d gauges", os.getpid(), self.top_n)
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("prefetch round failed")
+            time.sleep(self.interval)
+
+
+def start_prefetcher():
+    """
+    Start the in-process prefetcher thread if GAUGEVIEW_PREFETCH_ENABLED is set. Safe to call on every request, one
+    thread is started per process.
+    """
+    global _prefetcher_pid
+    if _prefetcher_pid == os.getpid() or not get_setting('GAUGEVIEW_PREFETCH_ENABLED', False):
+        return
+    with _local_lock:
+        if _prefetcher_pid == os.getpid():
+            return
+        _prefetcher_pid = os.getpid()
+    thread = threading.Thread(target=PrefetchScheduler().run_forever, name='gaugeview-prefetch')
+    thread.daemon = True
+    thread.start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Keep the gaugeview cache warm for the most requested gauges.')
+    parser.add_argument('--once', action='store_true', help='run a single round and exit')
+    parser.add_argument('--top-n', type=int, help='number of gauges to keep warm')
+    parser.add_argument('--concurrency', type=int, help='most upstream requests in flight at once')
+    parser.add_argument('--jitter', type=float, help='most seconds a refresh is delayed by')
+    parser.add_argument('--interval', type=int, help='seconds between rounds')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    scheduler = PrefetchScheduler(args.top_n, args.concurrency, args.jitter, args.interval)
+    if args.once:
+        succeeded, due = scheduler.run_once()
+        print('prefetched {0} of {1} sources'.format(succeeded, due))
+    else:
+        scheduler.run_forever()
+
+
+if __name__ == '__main__':
+    main()
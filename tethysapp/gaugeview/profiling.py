@@ -0,0 +1,143 @@
+import cProfile
+import logging
+import os
+import pstats
+import re
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from StringIO import StringIO
+from functools import wraps
+
+from .config import get_setting
+
+logger = logging.getLogger(__name__)
+
+# Query parameter that turns the profiler on for one request
+PROFILE_PARAM = 'profile'
+# Names of the saved profiles, without their extension
+PROFILE_NAME = re.compile(r'^[a-z_]+-\d{8}T\d{6}-[0-9a-f]{8}$')
+EXTENSIONS = ('.pstats', '.collapsed')
+
+
+class StackSampler(object):
+    """
+    Samples the stack of one thread at a fixed interval, counting identical stacks for flame graphs
+    :param thread_id: Ident of the thread to sample
+    :param interval: Seconds between two samples
+    """
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='gaugeview-sampler')
+        self._thread.daemon = True
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{0}:{1}'.format(os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            if stack:
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def collapsed(self):
+        """
+        :return: The stacks in the collapsed format of flamegraph.pl and speedscope, one 'frame;frame;frame count' per
+        line
+        """
+        return ''.join('{0} {1}\n'.format(stack, count) for stack, count in sorted(self.stacks.items()))
+
+
+def profile_dir():
+    """
+    :return: The directory profiles are saved in, GAUGEVIEW_PROFILE_DIR
+    """
+    return get_setting('GAUGEVIEW_PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'gaugeview-profiles'))
+
+
+def profile_path(name, extension):
+    """
+    :param name: Name of a saved profile
+    :param extension: One of EXTENSIONS
+    :return: Path of the file, or None if the name or extension is not valid
+    """
+    if not PROFILE_NAME.match(name) or extension not in EXTENSIONS:
+        return None
+    return os.path.join(profile_dir(), name + extension)
+
+
+def may_profile(request):
+    """
+    :param request: URL request
+    :return: True if the request asks to be profiled and comes from a staff user
+    """
+    if not request.GET.get(PROFILE_PARAM):
+        return False
+    user = getattr(request, 'user', None)
+    return user is not None and user.is_authenticated() and user.is_staff
+
+
+def profiled(view_name):
+    """
+    Decorator running a view under cProfile, and a stack sampler for flame graphs, when a staff user adds ?profile=1
+    to its URL. Both are saved to GAUGEVIEW_PROFILE_DIR, the slowest functions are logged, and the name of the
+    profile is returned in the X-Profile header. Only the view's thread is profiled: upstream calls made with
+    fetch_concurrently show up as the time spent waiting on the pool.
+    :param view_name: Name of the view, used to name the profile
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if not may_profile(request):
+                return view(request, *args, **kwargs)
+
+            name = '{0}-{1}-{2}'.format(view_name, time.strftime('%Y%m%dT%H%M%S'), uuid.uuid4().hex[:8])
+            sampler = StackSampler(threading.current_thread().ident,
+                                   get_setting('GAUGEVIEW_PROFILE_SAMPLE_INTERVAL', 0.005))
+            profiler = cProfile.Profile()
+            sampler.start()
+            try:
+                response = profiler.runcall(view, request, *args, **kwargs)
+            finally:
+                sampler.stop()
+                save_profile(name, profiler, sampler, request)
+            response['X-Profile'] = name
+            return response
+        return wrapper
+    return decorator
+
+
+def save_profile(name, profiler, sampler, request):
+    """
+    Write the pstats and collapsed stacks of a profiled request, and log its slowest functions
+    """
+    directory = profile_dir()
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        profiler.dump_stats(os.path.join(directory, name + '.pstats'))
+        with open(os.path.join(directory, name + '.collapsed'), 'w') as f:
+            f.write(sampler.collapsed())
+    except (IOError, OSError):
+        logger.exception("could not save profile %s", name)
+        return
+
+    summary = StringIO()
+    stats = pstats.Stats(profiler, stream=summary)
+    stats.sort_stats('cumulative').print_stats(get_setting('GAUGEVIEW_PROFILE_TOP_N', 20))
+    logger.info("profile %s of %s:\n%s", name, request.get_full_path(), summary.getvalue())
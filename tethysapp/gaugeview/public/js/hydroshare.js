@@ -158,29 +158,58 @@ $('#hydroshare-proceed').on('click', function ()  {
         data: {'title':resourceTitle, 'abstract': resourceAbstract,
             'keyword': resourceKeywords, 'waterml_link': waterml_link, 'public': resourcePublic},
         success: function (data) {
-            $('#hydroshare-proceed').prop('disabled', false);
             if ('error' in data) {
-                displayStatus.removeClass('uploading');
-                displayStatus.addClass('error');
-                displayStatus.html('<em>' + data.error + '</em>');
+                showUploadResult(data);
             }
             else
             {
-                displayStatus.removeClass('uploading');
-                displayStatus.addClass('success');
-                displayStatus.html('<em>' + data.success + ' View in HydroShare <a href="https://' + data.hs_hostname + '/resource/' + data.newResource +
-                    '" target="_blank">HERE</a></em>');
+                //the upload runs in the background, poll until it is done
+                pollUpload(upload_link + data.job_id + '/');
             }
         },
         error: function (jqXHR, textStatus, errorThrown) {
-            $('#hydroshare-proceed').prop('disabled', false);
-            displayStatus.removeClass('uploading');
-            displayStatus.addClass('error');
-            displayStatus.html('<em>' + errorThrown + '</em>');
+            showUploadResult({'error': errorThrown});
         }
     });
 });
 
+function pollUpload(status_link) {
+    $.ajax({
+        type: 'GET',
+        url: status_link,
+        dataType: 'json',
+        success: function (data) {
+            if (data.status === 'queued' || data.status === 'running') {
+                if (data.attempts > 1) {
+                    displayStatus.html('<em>Uploading... HydroShare is busy, retrying.</em>');
+                }
+                setTimeout(function () { pollUpload(status_link); }, 2000);
+            }
+            else {
+                showUploadResult(data);
+            }
+        },
+        error: function (jqXHR, textStatus, errorThrown) {
+            showUploadResult({'error': errorThrown});
+        }
+    });
+}
+
+function showUploadResult(data) {
+    $('#hydroshare-proceed').prop('disabled', false);
+    displayStatus.removeClass('uploading');
+    if ('error' in data) {
+        displayStatus.addClass('error');
+        displayStatus.html('<em>' + data.error + '</em>');
+    }
+    else
+    {
+        displayStatus.addClass('success');
+        displayStatus.html('<em>' + data.success + ' View in HydroShare <a href="https://' + data.hs_hostname + '/resource/' + data.newResource +
+            '" target="_blank">HERE</a></em>');
+    }
+}
+
 function getCookie(name) {
     var cookieValue = null;
     if (document.cookie && document.cookie != '') {
@@ -4,16 +4,6 @@ $(document).ready(function () {
 });
 
 var comid;
-function dataCall(inputURL) {
-    var result = null;
-        $.ajax({
-        url: inputURL,
-        async: false,
-        }).then(function(response) {
-            result = response;
-        });
-        return result;
-}
 
 //Map variables
 var selected_streams_layer;
@@ -120,51 +110,66 @@ all_streams_layer = new ol.layer.Vector({
     });
 
 ////map.addLayer(all_streams_layer);
-//var AHPS_Source =  new ol.source.TileWMS({
-//        url:'http://tethys.byu.edu:8181/geoserver/wms',
-//        params:{
-//            LAYERS:"gaugeviewwml:AHPS_Gauges",
-////            FORMAT:"image/png", //Not a necessary line, but maybe useful if needed later
-//        },
-//        crossOrigin: 'Anonymous' //This is necessary for CORS security in the browser
-//        });
-//
-//var USGS_Source =  new ol.source.TileWMS({
-//        url:'http://tethys.byu.edu:8181/geoserver/wms',
-//        params:{
-//            LAYERS:"gaugeviewwml:Export_USGS0",
-////            FORMAT:"image/png", //Not a necessary line, but maybe useful if needed later
-//        },
-//        crossOrigin: 'Anonymous'
-//        });
-
-var AHPS_Source =  new ol.source.TileWMS({
-        url:'https://geoserver.byu.edu/arcgis/services/gaugeviewer/AHPS_gauges/MapServer/WmsServer?',
-        params:{
-            LAYERS:"0",
-//            FORMAT:"image/png", //Not a necessary line, but maybe useful if needed later
-        },
-        crossOrigin: 'Anonymous' //This is necessary for CORS security in the browser
-        });
+//The gauge layers are GeoJSON points of the app's gauge catalog: clusters when zoomed out, gauges when zoomed in.
+//They are loaded a tile extent at a time, so the same URLs are requested again and answered from the browser cache.
+var geojsonFormat = new ol.format.GeoJSON();
+var gaugeTileGrid = ol.tilegrid.createXYZ({tileSize: 512});
+
+function mapZoom(resolution) {
+    return Math.round(Math.log(156543.03392804097 / resolution) / Math.LN2);
+}
 
-var USGS_Source =  new ol.source.TileWMS({
-        url:'https://geoserver.byu.edu/arcgis/services/gaugeviewer/USGS_gauges/MapServer/WmsServer?',
-        params:{
-            LAYERS:"0",
-//            FORMAT:"image/png", //Not a necessary line, but maybe useful if needed later
+function createGaugeSource(type) {
+    var source = new ol.source.Vector({
+        loader: function(extent, resolution, projection) {
+            var bbox = ol.proj.transformExtent(extent, projection, 'EPSG:4326');
+            $.getJSON('/apps/gaugeview/gauges/geojson/', {
+                'bbox': bbox.join(','),
+                'zoom': mapZoom(resolution),
+                'types': type
+            }).done(function(response) {
+                source.addFeatures(geojsonFormat.readFeatures(response, {featureProjection: projection}));
+            });
         },
-        crossOrigin: 'Anonymous'
-        });
+        strategy: ol.loadingstrategy.tile(gaugeTileGrid)
+    });
+    return source;
+}
+
+function createGaugeStyleFunction(color) {
+    var styles = {};
+    return function(feature, resolution) {
+        var count = feature.get('count') || 1;
+        if (!styles[count]) {
+            styles[count] = [new ol.style.Style({
+                image: new ol.style.Circle({
+                    radius: count == 1 ? 5 : Math.min(20, 8 + 2 * Math.log(count)),
+                    fill: new ol.style.Fill({color: color}),
+                    stroke: new ol.style.Stroke({color: '#ffffff', width: 1})
+                }),
+                text: count == 1 ? undefined : new ol.style.Text({
+                    text: count.toString(),
+                    font: 'bold 11px Verdana',
+                    fill: new ol.style.Fill({color: '#ffffff'})
+                })
+            })];
+        }
+        return styles[count];
+    };
+}
+
+var AHPS_Source = createGaugeSource('ahps');
+var USGS_Source = createGaugeSource('usgs');
 
-//Define all WMS layers
-//The gauge layers can be changed to layer.Image instead of layer.Tile (and .ImageWMS instead of .TileWMS) for a single tile
-var AHPS_Gauges = new ol.layer.Tile({
-    source:AHPS_Source
-    }); //Thanks to http://jsfiddle.net/GFarkas/tr0s6uno/ for getting the layer working
+var AHPS_Gauges = new ol.layer.Vector({
+    source: AHPS_Source,
+    style: createGaugeStyleFunction('#e74c3c')
+    });
 
-var USGS_Gauges = new ol.layer.Tile({
-    source:USGS_Source
-    }); //Thanks to http://jsfiddle.net/GFarkas/tr0s6uno/ for getting the layer working
+var USGS_Gauges = new ol.layer.Vector({
+    source: USGS_Source,
+    style: createGaugeStyleFunction('#27ae60')
+    });
 
 //Set opacity of layers
 //AHPS_Gauges.setOpacity(0.7);
@@ -190,6 +195,17 @@ var map = new ol.Map({
 //Zoom slider
 map.addControl(new ol.control.ZoomSlider());
 
+//Clusters are made for one zoom level, so load the gauges again when it changes
+var gaugeZoom = mapZoom(view.getResolution());
+view.on('change:resolution', function() {
+    var zoom = mapZoom(view.getResolution());
+    if (zoom != gaugeZoom) {
+        gaugeZoom = zoom;
+        AHPS_Source.clear();
+        USGS_Source.clear();
+    }
+});
+
 var element = document.getElementById('popup');
 
 var popup = new ol.Overlay({
@@ -359,95 +375,74 @@ $(function () {
     $('#gaugeid').val(window.location.search.split('&')[0].split('=')[1])
 });
 
+//Gauges within this many pixels of a click are listed, like the WMS GetFeatureInfo tolerance
+var clickTolerancePixels = 10;
+
+//find two weeks ago date
+function twoWeeksAgo() {
+    var date_old = new Date();
+    date_old.setDate(date_old.getDate() - 14);
+    return date_old.toISOString().split('T')[0];
+}
+
 //Click funtion to choose gauge on map
 map.on('singleclick', function(evt) {
     $(element).popover('destroy');
         if (map.getTargetElement().style.cursor == "pointer"){
 
+            //Clicking a cluster zooms into it
+            var cluster = map.forEachFeatureAtPixel(evt.pixel, function(feature) {
+                if (feature.get('count') > 1) {
+                    return feature;
+                }
+            });
+            if (cluster) {
+                map.getView().setCenter(cluster.getGeometry().getCoordinates());
+                map.getView().setZoom(Math.min(mapZoom(map.getView().getResolution()) + 2, 20));
+                return;
+            }
+
             var clickCoord = evt.coordinate;
             popup.setPosition(clickCoord);
             lonlat = ol.proj.transform(clickCoord, 'EPSG:3857', 'EPSG:4326');
             run_point_indexing_service(lonlat);
-            var view = map.getView();
-            var viewResolution = view.getResolution();
+            var viewResolution = map.getView().getResolution();
 
-// NEED TO MAKE THIS ONLY CREATE URL IF NECESSARY!!!
+            var types = [];
             if (document.getElementById("ch_AHPS_Gauges").checked){
-                var AHPS_url = AHPS_Source.getGetFeatureInfoUrl(evt.coordinate, viewResolution, view.getProjection(),
-                  {'INFO_FORMAT': 'text/xml', 'FEATURE_COUNT': 50});
+                types.push('ahps');
             };
-
             if (document.getElementById("ch_USGS_Gauges").checked){
-                var USGS_url = USGS_Source.getGetFeatureInfoUrl(evt.coordinate, viewResolution, view.getProjection(),
-                  {'INFO_FORMAT': 'text/xml', 'FEATURE_COUNT': 50});
-              };
-
-            //var displayContent = '<table border="1"><tbody><tr><th>Gauge Type & ID</th><th>Waterbody</th><th>Info</th><th>Link</th></tr>';
-            var displayContent = "COMID: " + comid;
-            if (AHPS_url) {
-                var AHPS_Data = dataCall(AHPS_url);
-                var AHPS_Count = AHPS_Data.documentElement.childElementCount;
-
-                //This is for AHPS Gauges (set i=0 if using geoserver.byu.edu, set i=1 if using tethys.byu.edu's geoserver)
-                for (i = 0; i < AHPS_Count; i++) {
-                    var gaugeID = AHPS_Data.documentElement.children[i].attributes['GaugeLID'].value;
-                    var waterbody = AHPS_Data.documentElement.children[i].attributes['Waterbody'].value;
-                    var urlLink = AHPS_Data.documentElement.children[i].attributes['URL'].value;
-                    var lat = AHPS_Data.documentElement.children[i].attributes['Latitude'].value;
-                    var long = AHPS_Data.documentElement.children[i].attributes['Longitude'].value;
-
-//                    var gaugeID = AHPS_Data.documentElement.children[i].children[0].children[1].innerHTML;
-//                    var waterbody = AHPS_Data.documentElement.children[i].children[0].children[5].innerHTML;
-//                    var urlLink = AHPS_Data.documentElement.children[i].children[0].children[8].innerHTML;
-//                    var lat = AHPS_Data.documentElement.children[i].children[0].children[3].innerHTML;
-//                    var long = AHPS_Data.documentElement.children[i].children[0].children[4].innerHTML;
-
-                    var ahpshtml = "/apps/gaugeview/ahps/?gaugeno=" + gaugeID + "&waterbody=" + waterbody + "&lat=" + lat + "&long=" + long + "&initial=True";
-                    displayContent += '<tr><td>AHPS:\n' + gaugeID + '</td><td>' + waterbody + '</td><td><a href="'+ahpshtml+'" target="_blank">View Data</a></td><td><a href="'+urlLink+'" target="_blank">Go to Website</a></td></tr>';
-                    }
-                };
-
-            if (USGS_url) {
-                var USGS_Data = dataCall(USGS_url);
-                var USGS_Count = USGS_Data.documentElement.childElementCount;
-
-                //find two weeks ago date
-                var date_old = new Date();
-
-                //document.write(date_old.toLocaleString());
-                date_old.setDate(date_old.getDate() - 14);
-
-                //document.write(date_old.toLocaleString());
-                date_str = date_old.toISOString();
-                var two_weeks_ago_str = date_str.split('T')[0]
-
-                //console.log(date_old)
-
-                //This is for USGS Gauges (set i=0 if using geoserver.byu.edu, set i=1 if using tethys.byu.edu's geoserver)
-                for (i = 0; i < USGS_Count; i++) {
-                    var gaugeID = USGS_Data.documentElement.children[i].attributes['STAID'].value;
-                    var waterbody = USGS_Data.documentElement.children[i].attributes['STANAME'].value;
-                    var urlLink = USGS_Data.documentElement.children[i].attributes['NWISWEB'].value;
-                    var lat = USGS_Data.documentElement.children[i].attributes['LAT_GAGE'].value;
-                    var long = USGS_Data.documentElement.children[i].attributes['LNG_GAGE'].value;
-
-//                    var gaugeID = USGS_Data.documentElement.children[i].attributes['SITE_NO'].value;
-//                    var waterbody = USGS_Data.documentElement.children[i].attributes['STATION_NM'].value;
-//                    var urlLink = USGS_Data.documentElement.children[i].attributes['NWISWEB'].value;
-//                    var lat = USGS_Data.documentElement.children[i].attributes['LAT_SITE'].value;
-//                    var long = USGS_Data.documentElement.children[i].attributes['LON_SITE'].value;
-
-//                    var gaugeID = USGS_Data.documentElement.children[i].children[0].children[2].innerHTML;
-//                    var waterbody = USGS_Data.documentElement.children[i].children[0].children[3].innerHTML;
-//                    var urlLink = USGS_Data.documentElement.children[i].children[0].children[16].innerHTML;
-//                    var lat = USGS_Data.documentElement.children[i].children[0].children[8].innerHTML;
-//                    var long = USGS_Data.documentElement.children[i].children[0].children[9].innerHTML;
+                types.push('usgs');
+            };
+            if (types.length == 0) {
+                return;
+            };
 
-                    var usgshtml = "/apps/gaugeview/usgs/?gaugeid=" + gaugeID + "&waterbody=" + waterbody + "&start=" + two_weeks_ago_str + "&end=" + datestringnow + "&lat=" + lat + "&long=" + long + "&initial=True";
-                    displayContent += '<tr><td>USGS:\n' + gaugeID +'</td><td>'+ waterbody + '</td><td><a href="'+usgshtml+'" target="_blank">View Data</a></td><td><a href="'+urlLink+'" target="_blank">Go to Website</a></td></tr>';
+            //Web Mercator meters per pixel shrink with the cosine of the latitude
+            var radius = viewResolution * clickTolerancePixels * Math.cos(lonlat[1] * Math.PI / 180) / 1000;
+
+            //The gauges come from the app's catalog, so the map stays responsive while they load
+            $.getJSON('/apps/gaugeview/gauges/nearest/', {
+                'lat': lonlat[1],
+                'long': lonlat[0],
+                'radius': radius,
+                'types': types.join(',')
+            }).done(function(response) {
+                var displayContent = "COMID: " + comid;
+                var two_weeks_ago_str = twoWeeksAgo();
+
+                for (var i = 0; i < response.gauges.length; i++) {
+                    var gauge = response.gauges[i];
+                    if (gauge.type == 'ahps') {
+                        var ahpshtml = "/apps/gaugeview/ahps/?gaugeno=" + gauge.gauge_id + "&waterbody=" + gauge.waterbody + "&lat=" + gauge.latitude + "&long=" + gauge.longitude + "&initial=True";
+                        displayContent += '<tr><td>AHPS:\n' + gauge.gauge_id + '</td><td>' + gauge.waterbody + '</td><td><a href="'+ahpshtml+'" target="_blank">View Data</a></td><td><a href="'+gauge.url+'" target="_blank">Go to Website</a></td></tr>';
+                    } else {
+                        var usgshtml = "/apps/gaugeview/usgs/?gaugeid=" + gauge.gauge_id + "&waterbody=" + gauge.waterbody + "&start=" + two_weeks_ago_str + "&end=" + datestringnow + "&lat=" + gauge.latitude + "&long=" + gauge.longitude + "&initial=True";
+                        displayContent += '<tr><td>USGS:\n' + gauge.gauge_id +'</td><td>'+ gauge.waterbody + '</td><td><a href="'+usgshtml+'" target="_blank">View Data</a></td><td><a href="'+gauge.url+'" target="_blank">Go to Website</a></td></tr>';
                     }
                 };
-                    displayContent += '</table>';
+                displayContent += '</table>';
 
                 $(element).popover({
                 'placement': 'top',
@@ -457,7 +452,14 @@ map.on('singleclick', function(evt) {
 
                 $(element).popover('show');
                 $(element).next().css('cursor','text');
-//                console.log(displayContent);
+            }).fail(function() {
+                $(element).popover({
+                'placement': 'top',
+                'html': true,
+                'content': 'The gauges could not be loaded, please try again.'
+                  });
+                $(element).popover('show');
+            });
             }
         });
 
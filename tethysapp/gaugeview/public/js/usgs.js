@@ -27,6 +27,9 @@ $(function() { //wait for page to load
     } else if ($('#forecast_range').val() === 'analysis_assim'){
         $('#comid_time').parent().addClass('hidden');
         $('#forecast_date_end').parent().removeClass('hidden');
+    } else if ($('#forecast_range').val() === 'compare'){
+        $('#comid_time').parent().removeClass('hidden');
+        $('#forecast_date_end').parent().removeClass('hidden');
     }
 
 //inputs on usgs menu appear/disappear for analysis & assimilation, short, and medium
@@ -40,6 +43,9 @@ $(function() { //wait for page to load
         } else if ($('#forecast_range').val() === 'analysis_assim'){
             $('#comid_time').parent().addClass('hidden');
             $('#forecast_date_end').parent().removeClass('hidden');
+        } else if ($('#forecast_range').val() === 'compare'){
+            $('#comid_time').parent().removeClass('hidden');
+            $('#forecast_date_end').parent().removeClass('hidden');
         }
     });
 });
@@ -0,0 +1,223 @@
+"""
+Skill of the NWM analysis and assimilation against the observed instantaneous flow of USGS gauges, to tell which
+reaches the model gets right during events. Both series are averaged to hourly steps and compared on the hours they
+share. Score gauges of the catalog into the skill_scores table, a process per CPU, and list the results with
+
+    python -m tethysapp.gaugeview.skill score 10109000 10105900 --start 2016-05-01 --end 2016-05-31
+    python -m tethysapp.gaugeview.skill score --all --start 2016-05-01 --end 2016-05-31 --processes 8
+    python -m tethysapp.gaugeview.skill show --start 2016-05-01 --end 2016-05-31
+"""
+import argparse
+import logging
+import time
+from datetime import date, timedelta
+from multiprocessing import Pool
+
+import numpy as np
+
+from .config import get_setting
+
+logger = logging.getLogger(__name__)
+
+METRICS = ('nse', 'kge', 'bias', 'rmse')
+
+
+def hourly(series):
+    """
+    :param series: A Series of flows
+    :return: Arrays of the hours (since the epoch) with a flow and of the mean flow of each, NWIS placeholders
+    (negative flows) left out
+    """
+    times = np.frombuffer(series.times, dtype=np.float64)
+    values = np.frombuffer(series.values, dtype=np.float64)
+    valid = np.isfinite(values) & (values >= 0)
+    hours, index = np.unique((times[valid] // 3600).astype(np.int64), return_inverse=True)
+    return hours, np.bincount(index, weights=values[valid]) / np.bincount(index)
+
+
+def align(observed, simulated):
+    """
+    :param observed: A Series of the observed flows
+    :param simulated: A Series of the simulated flows
+    :return: Arrays of the hours both have a flow for, and of the observed and simulated flows of those hours
+    """
+    observed_hours, observed_values = hourly(observed)
+    simulated_hours, simulated_values = hourly(simulated)
+    hours, observed_index, simulated_index = np.intersect1d(observed_hours, simulated_hours, assume_unique=True,
+                                                            return_indices=True)
+    return hours, observed_values[observed_index], simulated_values[simulated_index]
+
+
+def skill_metrics(observed, simulated):
+    """
+    :param observed: Array of observed flows
+    :param simulated: Array of the simulated flows of the same times
+    :return: A dict of the Nash-Sutcliffe efficiency, the Kling-Gupta efficiency, the percent bias and the root mean
+    square error. Metrics that are undefined (i.e. NSE of a constant observed flow) are None.
+    """
+    observed = np.asarray(observed, dtype=np.float64)
+    simulated = np.asarray(simulated, dtype=np.float64)
+    error = simulated - observed
+    observed_mean = observed.mean()
+    observed_std = observed.std()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        nse = 1 - np.sum(error ** 2) / np.sum((observed - observed_mean) ** 2)
+        r = np.corrcoef(observed, simulated)[0, 1]
+        kge = 1 - np.sqrt((r - 1) ** 2 + (simulated.std() / observed_std - 1) ** 2 +
+                          (simulated.mean() / observed_mean - 1) ** 2)
+        bias = 100 * error.sum() / observed.sum()
+    metrics = {'nse': nse, 'kge': kge, 'bias': bias, 'rmse': np.sqrt(np.mean(error ** 2))}
+    return dict((name, float(value) if np.isfinite(value) else None) for name, value in metrics.items())
+
+
+def compare(observed, simulated, min_hours=None):
+    """
+    :param observed: A Series of the observed flows
+    :param simulated: A Series of the simulated flows
+    :param min_hours: Fewest hours in common to score, defaults to GAUGEVIEW_SKILL_MIN_HOURS
+    :return: A dict of the number of hours compared and the skill_metrics, which are None with too few hours
+    """
+    if min_hours is None:
+        min_hours = get_setting('GAUGEVIEW_SKILL_MIN_HOURS', 24)
+    hours, observed_values, simulated_values = align(observed, simulated)
+    if len(hours) < max(min_hours, 2):
+        scores = dict.fromkeys(METRICS)
+    else:
+        scores = skill_metrics(observed_values, simulated_values)
+    scores['hours'] = len(hours)
+    return scores
+
+
+def score_gauge(task):
+    """
+    Runs in the processes of the pool
+    :param task: The USGS gauge id, the COMID of its reach (None to look it up from its latitude and longitude), its
+    latitude and longitude, and the first and last days (YYYY-MM-DD) of the window
+    :return: A dict of the columns of the SkillScore of the gauge
+    """
+    # The controllers use this module to score the forecasts shown on the usgs page
+    from .controllers import convert_nwm_to_python, convert_usgs_iv_to_python, get_comid, get_nwm_data, \
+        get_usgs_iv_data
+
+    gauge_id, comid, latitude, longitude, start, end = task
+    row = {'gauge_id': gauge_id, 'comid': comid, 'start': start, 'end': end, 'hours': 0, 'error': None}
+    row.update(dict.fromkeys(METRICS))
+    try:
+        if comid is None:
+            comid = row['comid'] = get_comid(str(latitude), str(longitude))
+        observed = convert_usgs_iv_to_python(get_usgs_iv_data(gauge_id, start, end))[1]
+        # The same arguments as the analysis and assimilation of the usgs page, so they share the cache
+        simulated = convert_nwm_to_python(get_nwm_data('analysis_assim', comid, start, end, '06'))
+        row.update(compare(observed, simulated))
+    except Exception as e:
+        logger.warning("could not score gauge %s: %s", gauge_id, e)
+        row['error'] = '{0}: {1}'.format(type(e).__name__, e)[:255]
+    return row
+
+
+def score_gauges(gauge_ids, start, end, processes=None):
+    """
+    Score gauges of the catalog over a window and store the results in the skill_scores table, replacing the earlier
+    scores of that window
+    :param gauge_ids: USGS gauge ids, all the USGS gauges of the catalog if None
+    :param start: First day (YYYY-MM-DD)
+    :param end: Last day (YYYY-MM-DD)
+    :param processes: Size of the process pool, defaults to GAUGEVIEW_SKILL_PROCESSES or the number of CPUs
+    :return: The number of gauges scored, and of those that could not be
+    """
+    from .model import Gauge, SessionMaker, SkillScore
+
+    session = SessionMaker()
+    try:
+        query = session.query(Gauge).filter(Gauge.kind == 'usgs')
+        if gauge_ids is not None:
+            query = query.filter(Gauge.gauge_id.in_(gauge_ids))
+        tasks = [(gauge.gauge_id, gauge.comid, gauge.latitude, gauge.longitude, start, end) for gauge in query]
+    finally:
+        session.close()
+    if gauge_ids is not None:
+        missing = set(gauge_ids) - set(task[0] for task in tasks)
+        if missing:
+            logger.warning("not in the catalog: %s", ', '.join(sorted(missing)))
+
+    # The workers only fetch and compute, the rows are written here so no connection crosses a fork
+    pool = Pool(processes or get_setting('GAUGEVIEW_SKILL_PROCESSES', None))
+    scored = failed = 0
+    session = SessionMaker()
+    try:
+        for row in pool.imap_unordered(score_gauge, tasks):
+            score = session.query(SkillScore).filter_by(gauge_id=row['gauge_id'], start=start, end=end).first()
+            if score is None:
+                score = SkillScore()
+                session.add(score)
+            for name, value in row.items():
+                setattr(score, name, value)
+            score.computed_at = time.time()
+            session.commit()
+            if row['error']:
+                failed += 1
+            else:
+                scored += 1
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+        pool.close()
+        pool.join()
+    logger.info("scored %d gauges from %s to %s, %d failed", scored, start, end, failed)
+    return scored, failed
+
+
+def get_scores(start, end, gauge_ids=None):
+    """
+    :param start: First day (YYYY-MM-DD) of the window
+    :param end: Last day (YYYY-MM-DD) of the window
+    :param gauge_ids: Only these USGS gauge ids
+    :return: A list of the dicts of the skill scores of the window, best NSE first
+    """
+    from .model import SessionMaker, SkillScore
+
+    session = SessionMaker()
+    try:
+        query = session.query(SkillScore).filter(SkillScore.start == start, SkillScore.end == end)
+        if gauge_ids is not None:
+            query = query.filter(SkillScore.gauge_id.in_(gauge_ids))
+        scores = [score.as_dict() for score in query]
+    finally:
+        session.close()
+    scores.sort(key=lambda score: (score['nse'] is None, -(score['nse'] or 0), score['gauge_id']))
+    return scores
+
+
+def main():
+    yesterday = date.today() - timedelta(days=1)
+    parser = argparse.ArgumentParser(description='Score the NWM analysis and assimilation against USGS gauges.')
+    commands = parser.add_subparsers(dest='command')
+    score = commands.add_parser('score', help='score gauges of the catalog into the skill_scores table')
+    score.add_argument('gauge_ids', nargs='*')
+    score.add_argument('--all', action='store_true', help='score every USGS gauge of the catalog')
+    score.add_argument('--processes', type=int, help='size of the process pool, defaults to the number of CPUs')
+    show = commands.add_parser('show', help='print the scores of a window, best NSE first')
+    show.add_argument('gauge_ids', nargs='*')
+    for command in (score, show):
+        command.add_argument('--start', default=(yesterday - timedelta(days=6)).isoformat(), help='YYYY-MM-DD')
+        command.add_argument('--end', default=yesterday.isoformat(), help='YYYY-MM-DD')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'score':
+        if not args.gauge_ids and not args.all:
+            parser.error('give gauge ids or --all')
+        scored, failed = score_gauges(args.gauge_ids or None, args.start, args.end, args.processes)
+        print('scored {0} gauges, {1} failed'.format(scored, failed))
+    else:
+        for score in get_scores(args.start, args.end, args.gauge_ids or None):
+            values = ['{0:>8.3f}'.format(score[name]) if score[name] is not None else '{0:>8}'.format('-')
+                      for name in METRICS]
+            print('{0:<16} {1:<10} {2:>5} h {3}  {4}'.format(score['gauge_id'], score['comid'] or '-', score['hours'],
+                                                             ' '.join(values), score['error'] or ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+from .cache import get_cache
+from .config import get_setting
+
+logger = logging.getLogger(__name__)
+
+# Snapshot layout: MAGIC, the number of entries, one INDEX_ENTRY per entry, then the keys, regions and payloads. The
+# payloads are the pickles held by the memory tier, so restoring is slicing the mapped file, nothing is unpickled.
+MAGIC = 'GVSNAP01'
+HEADER = struct.Struct('<8sI')
+INDEX_ENTRY = struct.Struct('<dQIQIQI')  # expires, key offset and length, region offset and length, payload offset
+                                         # and length
+
+# Regions that are not worth keeping across restarts
+SKIPPED_REGIONS = ('generation',)
+
+_writer_pid = None
+_writer_lock = threading.Lock()
+_restored_pid = None
+
+
+def snapshot_path():
+    """
+    :return: Path of the snapshot file, GAUGEVIEW_SNAPSHOT_PATH or next to the disk cache directory
+    """
+    return get_setting('GAUGEVIEW_SNAPSHOT_PATH', get_cache().disk.directory.rstrip(os.sep) + '.snapshot')
+
+
+def live_bytes(path, now=None):
+    """
+    :param path: Snapshot file
+    :param now: Unix time, defaults to time.time()
+    :return: The payload bytes of the unexpired entries of the snapshot, 0 if there is none
+    """
+    now = now if now is not None else time.time()
+    if not os.path.exists(path) or os.path.getsize(path) < HEADER.size:
+        return 0
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, count = HEADER.unpack_from(data, 0)
+            if magic != MAGIC:
+                return 0
+            total = 0
+            for i in range(count):
+                entry = INDEX_ENTRY.unpack_from(data, HEADER.size + i * INDEX_ENTRY.size)
+                if entry[0] >= now:
+                    total += entry[6]
+            return total
+        finally:
+            data.close()
+
+
+def write_snapshot(path=None, max_bytes=None):
+    """
+    Write the hottest values of the memory tier (series, COMIDs, gauge metadata and pages) to the snapshot file. All
+    the workers write to the same file, so a worker whose memory tier holds fewer live bytes than the snapshot (i.e.
+    one recycled recently) leaves it as it is, and a worker skips its turn while another one is writing.
+    :param path: Snapshot file, defaults to snapshot_path()
+    :param max_bytes: Most payload bytes to write, defaults to GAUGEVIEW_SNAPSHOT_BYTES
+    :return: The number of entries written, 0 if the snapshot was left as it is
+    """
+    # The prefetcher's file lock serializes the writers of all the workers
+    from .prefetch import FileLock
+
+    if path is None:
+        path = snapshot_path()
+    if max_bytes is None:
+        max_bytes = get_setting('GAUGEVIEW_SNAPSHOT_BYTES', 32 * 1024 * 1024)
+
+    entries = []
+    total = 0
+    for key, expires, region, payload in get_cache().memory.hottest():
+        if region in SKIPPED_REGIONS:
+            continue
+        if total + len(payload) > max_bytes:
+            continue
+        entries.append((key.encode('utf-8'), expires, region.encode('utf-8'), payload))
+        total += len(payload)
+
+    lock = FileLock('snapshot', blocking=False)
+    if not lock.acquire():
+        return 0
+    try:
+        existing = live_bytes(path)
+        if total < existing:
+            logger.debug("kept the snapshot %s, %d live bytes against %d in memory", path, existing, total)
+            return 0
+        _write(path, entries)
+    finally:
+        lock.release()
+    logger.info("wrote %d cache entries (%d bytes) to %s", len(entries), total, path)
+    return len(entries)
+
+
+def _write(path, entries):
+    offset = HEADER.size + INDEX_ENTRY.size * len(entries)
+    index = []
+    for key, expires, region, payload in entries:
+        index.append(INDEX_ENTRY.pack(expires, offset, len(key), offset + len(key), len(region),
+                                      offset + len(key) + len(region), len(payload)))
+        offset += len(key) + len(region) + len(payload)
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.snapshot')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(entries)))
+        f.write(''.join(index))
+        for key, expires, region, payload in entries:
+            f.write(key)
+            f.write(region)
+            f.write(payload)
+    os.rename(tmp_path, path)
+
+
+def restore_snapshot(path=None):
+    """
+    Load the unexpired entries of the snapshot file into the memory tier
+    :param path: Snapshot file, defaults to snapshot_path()
+    :return: The number of entries restored
+    """
+    if path is None:
+        path = snapshot_path()
+    if not os.path.exists(path) or os.path.getsize(path) < HEADER.size:
+        return 0
+
+    started = time.time()
+    memory = get_cache().memory
+    restored = 0
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, count = HEADER.unpack_from(data, 0)
+            if magic != MAGIC:
+                logger.warning("%s is not a gaugeview cache snapshot", path)
+                return 0
+            now = time.time()
+            for i in range(count):
+                expires, key_offset, key_length, region_offset, region_length, payload_offset, payload_length = \
+                    INDEX_ENTRY.unpack_from(data, HEADER.size + i * INDEX_ENTRY.size)
+                if expires < now:
+                    continue
+                key = data[key_offset:key_offset + key_length].decode('utf-8')
+                region = data[region_offset:region_offset + region_length].decode('utf-8')
+                memory.set(key, data[payload_offset:payload_offset + payload_length], expires, region)
+                restored += 1
+        finally:
+            data.close()
+
+    logger.info("restored %d cache entries from %s in %.3f s", restored, path, time.time() - started)
+    return restored
+
+
+def _write_periodically(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            write_snapshot()
+        except Exception:
+            logger.exception("could not write the cache snapshot")
+
+
+def start_snapshot_writer():
+    """
+    Start the thread writing the snapshot every GAUGEVIEW_SNAPSHOT_INTERVAL seconds (0 disables it). Safe to call
+    more than once, only one writer runs per process.
+    """
+    global _writer_pid
+    interval = get_setting('GAUGEVIEW_SNAPSHOT_INTERVAL', 300)
+    if not interval:
+        return
+    with _writer_lock:
+        # Threads don't survive a fork, so a worker forked from a process that had a writer needs its own
+        if _writer_pid == os.getpid():
+            return
+        _writer_pid = os.getpid()
+        thread = threading.Thread(target=_write_periodically, args=(interval,), name='gaugeview-snapshot')
+        thread.daemon = True
+        thread.start()
+
+
+def warm_start():
+    """
+    Restore the last snapshot and keep writing new ones. Called when the app is initialized, which happens more than
+    once per process; the snapshot is restored once.
+    """
+    global _restored_pid
+    with _writer_lock:
+        if _restored_pid == os.getpid():
+            return
+        _restored_pid = os.getpid()
+    try:
+        restore_snapshot()
+    except Exception:
+        logger.exception("could not restore the cache snapshot")
+    start_snapshot_writer()
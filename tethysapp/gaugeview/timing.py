@@ -0,0 +1,141 @@
+import json
+import logging
+import threading
+import time
+from functools import wraps
+
+from .config import get_setting
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class RequestTimer(object):
+    """
+    Time spent in each stage of one request, and the calls, bytes and time spent on each upstream service. Stages
+    run by fetch_concurrently are recorded from the pool threads, so their times overlap.
+    """
+    def __init__(self, view_name):
+        self.view_name = view_name
+        self.started = time.time()
+        self.stages = []  # stage names in the order they were first entered
+        self.durations = {}
+        self.upstream_bytes = {}
+        self.upstream_calls = {}
+        self.upstream_seconds = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            if name not in self.durations:
+                self.stages.append(name)
+                self.durations[name] = 0.0
+            self.durations[name] += seconds
+
+    def add_upstream(self, name, num_bytes, seconds):
+        with self._lock:
+            self.upstream_bytes[name] = self.upstream_bytes.get(name, 0) + num_bytes
+            self.upstream_calls[name] = self.upstream_calls.get(name, 0) + 1
+            self.upstream_seconds[name] = self.upstream_seconds.get(name, 0.0) + seconds
+
+    def server_timing(self):
+        """
+        :return: The value of the Server-Timing header, i.e. 'epa;dur=412.1, parse;dur=35.0, total;dur=610.4'
+        """
+        with self._lock:
+            metrics = ['{0};dur={1:.1f}'.format(name, self.durations[name] * 1000) for name in self.stages]
+        metrics.append('total;dur={0:.1f}'.format((time.time() - self.started) * 1000))
+        return ', '.join(metrics)
+
+    def as_dict(self):
+        with self._lock:
+            return {'view': self.view_name, 'total_ms': round((time.time() - self.started) * 1000, 1),
+                    'stages_ms': dict((name, round(seconds * 1000, 1)) for name, seconds in self.durations.items()),
+                    'upstream_bytes': dict(self.upstream_bytes), 'upstream_calls': dict(self.upstream_calls),
+                    'upstream_ms': dict((name, round(seconds * 1000, 1))
+                                        for name, seconds in self.upstream_seconds.items())}
+
+
+def current():
+    """
+    :return: The timer of the request handled by this thread, or None
+    """
+    return getattr(_local, 'timer', None)
+
+
+def activate(timer):
+    """
+    Record the stages run by this thread in a timer, i.e. in the pool threads of fetch_concurrently
+    :param timer: A RequestTimer, or None to stop recording
+    """
+    _local.timer = timer
+
+
+class stage(object):
+    """
+    Context manager timing a stage of the current request. Does nothing outside of a timed view.
+    :param name: Name of the stage in the Server-Timing header (i.e. 'parse')
+    """
+    def __init__(self, name):
+        self.name = name
+        self.timer = None
+        self.started = None
+
+    def __enter__(self):
+        self.timer = current()
+        if self.timer is not None:
+            self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.timer is not None:
+            self.timer.add(self.name, time.time() - self.started)
+
+
+def record_stage(name, seconds):
+    """
+    Add time to a stage of the current request, for stages that can't be wrapped in stage()
+    :param name: Name of the stage
+    :param seconds: Time spent in it
+    """
+    timer = current()
+    if timer is not None:
+        timer.add(name, seconds)
+
+
+def record_upstream(name, num_bytes, seconds):
+    """
+    Record a call to an upstream service in the timer of the current request
+    :param name: One of the keys of config.UPSTREAM_URLS, or 'hydroshare'
+    :param num_bytes: Bytes sent or received
+    :param seconds: How long the call took
+    """
+    timer = current()
+    if timer is not None:
+        timer.add_upstream(name, num_bytes, seconds)
+
+
+def timed_view(view_name):
+    """
+    Decorator adding a Server-Timing header with the time of each stage to the responses of a view, and logging them
+    with the bytes read from each upstream service as a JSON line. Disabled with GAUGEVIEW_SERVER_TIMING.
+    :param view_name: Name of the view in the log lines
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if not get_setting('GAUGEVIEW_SERVER_TIMING', True):
+                return view(request, *args, **kwargs)
+            timer = RequestTimer(view_name)
+            previous = current()
+            activate(timer)
+            try:
+                response = view(request, *args, **kwargs)
+            finally:
+                activate(previous)
+            response['Server-Timing'] = timer.server_timing()
+            logger.info(json.dumps(timer.as_dict(), sort_keys=True))
+            return response
+        return wrapper
+    return decorator
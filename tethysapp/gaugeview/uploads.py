@@ -0,0 +1,515 @@
+"""
+Background queue of the HydroShare uploads. upload_to_hydroshare stores a job in the upload_jobs table and answers
+with its id right away, worker threads (GAUGEVIEW_UPLOAD_WORKERS per process) create the resources, retrying when
+HydroShare fails or throttles, and hydroshare.js polls upload_status until the job is done. Jobs outlive the process
+that queued them: queued jobs, and running jobs whose worker went away, are picked up by any process working the
+queue. publish_batch queues the uploads of many gauges at once as a batch, whose failed uploads can be queued again
+without creating the resources that were created already. Work the queue without the web server, or list the jobs,
+with
+
+    python -m tethysapp.gaugeview.uploads run
+    python -m tethysapp.gaugeview.uploads list --status failed
+    python -m tethysapp.gaugeview.uploads list --batch 0123456789abcdef0123456789abcdef
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime
+from urllib import urlencode
+
+import requests
+from django.core.exceptions import ObjectDoesNotExist
+from oauthlib.oauth2 import TokenExpiredError
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import IntegrityError
+
+from . import catalog, hsclients, metrics, upstream
+from .config import get_setting
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+RESOURCE_TYPE = 'RefTimeSeriesResource'
+# Keyword tagging the resource of a job, so a retry finds the resource of an attempt whose answer was lost
+JOB_KEYWORD = 'gaugeview-job-{0}'
+
+# Messages of the failed jobs, the ones upload_to_hydroshare answered with when it uploaded in the request
+LOGIN_EXPIRED = 'Login timed out! Please re-sign in with your HydroShare account.'
+UNAUTHORIZED = 'Username or password invalid.'
+BAD_REQUEST = 'File uploaded successfully despite 400 Bad Request Error.'
+REJECTED = 'HydroShare rejected the upload for some reason.'
+UNAVAILABLE = 'HydroShare is not responding, please try again later.'
+
+# WaterML types of the gauges of a batch, and the kind of their gauges in the catalog
+BATCH_TYPES = {'usgsiv': 'usgs', 'usgsdv': 'usgs', 'ahps': 'ahps'}
+BATCH_SPAN = re.compile(r'^(all|[1-9][0-9]*-[dmy])$')
+BATCH_ID = re.compile(r'^[0-9a-f]{32}$')
+
+_workers_pid = None
+_workers_lock = threading.Lock()
+# Set when a job is queued in this process, so an idle worker picks it up without waiting for its next poll
+_wakeup = threading.Event()
+
+
+def call_hydroshare(func, *args, **kwargs):
+    """
+    Call a method of a HydroShare client within the rate limit of the 'hydroshare' upstream service
+    :param func: The method, i.e. hs.createResource
+    :return: What it returned
+    :raise UpstreamError: If no request slot was free within the 'hydroshare' timeout
+    """
+    limiter = upstream.get_limiter('hydroshare')
+    limiter.acquire(upstream.get_timeout('hydroshare'))
+    started = time.time()
+    try:
+        result = func(*args, **kwargs)
+    except Exception as e:
+        status = getattr(e, 'status_code', None)
+        limiter.release(status in upstream.THROTTLED_CODES)
+        metrics.observe_upstream('hydroshare', time.time() - started,
+                                 error='http_{0}'.format(status) if status else 'other')
+        raise
+    limiter.release()
+    metrics.observe_upstream('hydroshare', time.time() - started)
+    return result
+
+
+def find_job_resource(hs, job_id):
+    """
+    :param hs: HydroShare client of the user of the job
+    :param job_id: Id of the job
+    :return: The id of the resource an earlier attempt of the job created, or None if there is none
+    """
+    resources = call_hydroshare(lambda: list(hs.resources(subject=JOB_KEYWORD.format(job_id), edit_permission=True)))
+    return resources[0]['resource_id'] if resources else None
+
+
+def is_transient(error):
+    """
+    :param error: An exception raised by a HydroShare call
+    :return: True if the call may succeed when tried again later
+    """
+    status = getattr(error, 'status_code', None)
+    if status is not None:
+        return status in upstream.THROTTLED_CODES or status >= 500
+    return isinstance(error, (upstream.UpstreamError, socket.error, requests.ConnectionError, requests.Timeout))
+
+
+def failure_message(error):
+    """
+    :param error: An exception raised while running a job that won't be retried
+    :return: The message shown to the user
+    """
+    if isinstance(error, (ObjectDoesNotExist, TokenExpiredError)):
+        return LOGIN_EXPIRED
+    if getattr(error, 'status_code', None) == 401 or '401 Unauthorized' in str(error):
+        return UNAUTHORIZED
+    if '400 Bad Request' in str(error):
+        return BAD_REQUEST
+    if is_transient(error):
+        return UNAVAILABLE
+    return REJECTED
+
+
+def retry_delay(attempts):
+    """
+    :param attempts: Attempts made so far
+    :return: Seconds to wait before the next attempt, doubling from GAUGEVIEW_UPLOAD_RETRY_DELAY up to
+    GAUGEVIEW_UPLOAD_RETRY_MAX_DELAY, with jitter so jobs that failed together don't retry together
+    """
+    delay = min(get_setting('GAUGEVIEW_UPLOAD_RETRY_DELAY', 5.0) * 2 ** (attempts - 1),
+                get_setting('GAUGEVIEW_UPLOAD_RETRY_MAX_DELAY', 300.0))
+    return delay * random.uniform(0.5, 1.5)
+
+
+def enqueue(user, title, abstract, keywords, waterml_url, public):
+    """
+    Queue the upload of a WaterML link to HydroShare as a referenced time series resource
+    :param user: Django user signed in with HydroShare
+    :param title: Title of the resource
+    :param abstract: Abstract of the resource
+    :param keywords: List of keywords of the resource
+    :param waterml_url: Absolute URL of the WaterML the resource refers to
+    :param public: Whether to make the resource public
+    :return: The id of the job
+    """
+    from .model import SessionMaker, UploadJob
+
+    now = time.time()
+    job = UploadJob(id=uuid.uuid4().hex, user_id=user.pk, status=QUEUED, title=title, abstract=abstract,
+                    keywords=json.dumps(keywords), waterml_url=waterml_url, public=public, attempts=0,
+                    created_at=now, updated_at=now, next_attempt_at=now)
+    session = SessionMaker()
+    try:
+        session.add(job)
+        session.commit()
+        job_id = job.id
+    finally:
+        session.close()
+    start_workers()
+    _wakeup.set()
+    return job_id
+
+
+def batch_items(gauges, title, abstract, keywords):
+    """
+    :param gauges: List of dicts of the gauges to upload, with their type ('usgsiv', 'usgsdv' or 'ahps'), gauge_id,
+    span of the USGS series ('all', or days, months or years before now, i.e. '7-d', '6-m' or '2-y') and variable of
+    the AHPS series ('flow', the default, or 'stage')
+    :param title: Template of the titles, formatted (str.format) with the type, gauge_id, span, variable, waterbody,
+    latitude and longitude of each gauge
+    :param abstract: Template of the abstracts
+    :param keywords: Template of the comma separated keywords
+    :return: A list of a dict per gauge, with its key ('type:gauge_id:span' or 'ahps:gauge_id:variable') and either
+    its title, abstract, keywords and waterml_query, or the error that keeps it from being uploaded
+    :raise ValueError: If the batch can't be uploaded at all
+    """
+    if not title or not abstract or not keywords:
+        raise ValueError('title, abstract and keywords are required')
+    if not all(isinstance(template, basestring) for template in (title, abstract, keywords)):
+        raise ValueError('title, abstract and keywords must be strings')
+    if not isinstance(gauges, list) or not all(isinstance(gauge, dict) for gauge in gauges):
+        raise ValueError('gauges must be a list of objects')
+    if len(gauges) > get_setting('GAUGEVIEW_PUBLISH_BATCH_MAX', 200):
+        raise ValueError('at most {0} gauges per batch'.format(get_setting('GAUGEVIEW_PUBLISH_BATCH_MAX', 200)))
+
+    specs = []
+    for gauge in gauges:
+        gauge_type = u'{0}'.format(gauge.get('type') or '')
+        gauge_id = u'{0}'.format(gauge.get('gauge_id') or '').strip()
+        span = u'{0}'.format(gauge.get('span') or '') if gauge_type != 'ahps' else ''
+        variable = u'{0}'.format(gauge.get('variable') or 'flow')
+        specs.append((gauge_type, gauge_id, span, variable))
+    found = {}
+    for kind in set(BATCH_TYPES.values()):
+        found[kind] = catalog.get_gauges(kind, [spec[1] for spec in specs if BATCH_TYPES.get(spec[0]) == kind])
+
+    items = []
+    seen = set()
+    for gauge_type, gauge_id, span, variable in specs:
+        key = u':'.join((gauge_type, gauge_id, variable if gauge_type == 'ahps' else span))[:64]
+        item = {'gauge': key}
+        items.append(item)
+        gauge = found.get(BATCH_TYPES.get(gauge_type), {}).get(gauge_id)
+        if gauge_type not in BATCH_TYPES:
+            item['error'] = 'type must be one of {0}'.format(', '.join(sorted(BATCH_TYPES)))
+        elif gauge is None:
+            item['error'] = 'not in the gauge catalog'
+        elif gauge_type == 'ahps' and variable not in ('flow', 'stage'):
+            item['error'] = "variable must be 'flow' or 'stage'"
+        elif gauge_type != 'ahps' and (variable != 'flow' or not BATCH_SPAN.match(span)):
+            item['error'] = "span must be 'all' or like '7-d', '6-m' or '2-y', USGS gauges only have flow"
+        elif key in seen:
+            item['error'] = 'listed twice'
+        if 'error' in item:
+            continue
+        seen.add(key)
+
+        fields = {'type': gauge_type, 'gauge_id': gauge_id, 'span': span, 'variable': variable,
+                  'waterbody': gauge['waterbody'] or '', 'latitude': gauge['latitude'],
+                  'longitude': gauge['longitude']}
+        try:
+            item.update(title=title.format(**fields), abstract=abstract.format(**fields),
+                        keywords=[keyword.strip() for keyword in keywords.format(**fields).split(',')
+                                  if keyword.strip()])
+        except (KeyError, IndexError, ValueError) as e:
+            raise ValueError('the templates can only use the fields {0} ({1})'.format(', '.join(sorted(fields)), e))
+        if len(item['title']) > 255:
+            del item['title'], item['abstract'], item['keywords']
+            item['error'] = 'title longer than 255 characters'
+            continue
+        query = [('type', gauge_type), ('gaugeid', gauge_id)]
+        if gauge_type == 'ahps':
+            query.insert(1, ('var', variable))
+        else:
+            query.append(('span', span))
+        if gauge_type != 'usgsiv':
+            query += [('lat', gauge['latitude']), ('long', gauge['longitude'])]
+        item['waterml_query'] = urlencode([(name, u'{0}'.format(value).encode('utf-8')) for name, value in query])
+    return items
+
+
+def enqueue_batch(user, items, public, batch_id=None):
+    """
+    Queue the uploads of a batch of gauges
+    :param user: Django user signed in with HydroShare
+    :param items: Dicts of the gauge key, title, abstract, keywords and waterml_url of each upload
+    :param public: Whether to make the resources public
+    :param batch_id: Id returned for an earlier batch of the user, to queue its failed uploads again and add the
+    gauges it doesn't have. Its uploads keep the resource they created, so no resource is created twice.
+    :return: The id of the batch, and a dict of the job id of each gauge
+    :raise ValueError: If batch_id is not a batch of the user
+    """
+    from .model import SessionMaker, UploadJob
+
+    session = SessionMaker()
+    try:
+        # Twice, in case the same batch was changed at the same time and a gauge got its job meanwhile
+        for attempt in range(2):
+            now = time.time()
+            jobs = {}
+            if batch_id is not None:
+                jobs = dict((job.gauge, job) for job in session.query(UploadJob).filter(
+                    UploadJob.batch_id == batch_id, UploadJob.user_id == user.pk))
+                if not jobs:
+                    raise ValueError('unknown batch {0}'.format(batch_id))
+            else:
+                batch_id = uuid.uuid4().hex
+            for job in jobs.values():
+                if job.status == FAILED:
+                    # The error is kept until the job is done, so run_job looks for a resource the failed run created
+                    job.status = QUEUED
+                    job.attempts = 0
+                    job.updated_at = job.next_attempt_at = now
+            for item in items:
+                if item['gauge'] not in jobs:
+                    jobs[item['gauge']] = UploadJob(
+                        id=uuid.uuid4().hex, user_id=user.pk, status=QUEUED, title=item['title'],
+                        abstract=item['abstract'], keywords=json.dumps(item['keywords']),
+                        waterml_url=item['waterml_url'], public=public, attempts=0, created_at=now, updated_at=now,
+                        next_attempt_at=now, batch_id=batch_id, gauge=item['gauge'])
+                    session.add(jobs[item['gauge']])
+            try:
+                session.commit()
+                break
+            except IntegrityError:
+                session.rollback()
+                if attempt:
+                    raise
+        job_ids = dict((gauge, job.id) for gauge, job in jobs.items())
+    finally:
+        session.close()
+    start_workers()
+    _wakeup.set()
+    return batch_id, job_ids
+
+
+def get_batch(batch_id, user=None):
+    """
+    :param batch_id: Id returned by enqueue_batch
+    :param user: Only return the jobs if this Django user queued them
+    :return: A list of the dicts of the jobs of the batch, by gauge
+    """
+    from .model import SessionMaker, UploadJob
+
+    session = SessionMaker()
+    try:
+        query = session.query(UploadJob).filter(UploadJob.batch_id == batch_id)
+        if user is not None:
+            query = query.filter(UploadJob.user_id == user.pk)
+        return [job.as_dict() for job in query.order_by(UploadJob.gauge)]
+    finally:
+        session.close()
+
+
+def get_job(job_id, user=None):
+    """
+    :param job_id: Id returned by enqueue
+    :param user: Only return the job if this Django user queued it
+    :return: The dict of the job, or None if there is none
+    """
+    from .model import SessionMaker, UploadJob
+
+    session = SessionMaker()
+    try:
+        query = session.query(UploadJob).filter(UploadJob.id == job_id)
+        if user is not None:
+            query = query.filter(UploadJob.user_id == user.pk)
+        job = query.first()
+        return job.as_dict() if job is not None else None
+    finally:
+        session.close()
+
+
+def claim_job(now=None):
+    """
+    :param now: Unix time, defaults to time.time()
+    :return: The id of a job due to run, marked running by this worker, or None if no job is due. Running jobs not
+    updated for GAUGEVIEW_UPLOAD_LEASE seconds lost their worker and are due again.
+    """
+    from .model import SessionMaker, UploadJob
+
+    now = now if now is not None else time.time()
+    due = or_(and_(UploadJob.status == QUEUED, UploadJob.next_attempt_at <= now),
+              and_(UploadJob.status == RUNNING,
+                   UploadJob.updated_at < now - get_setting('GAUGEVIEW_UPLOAD_LEASE', 600)))
+    session = SessionMaker()
+    try:
+        candidates = [job_id for job_id, in session.query(UploadJob.id).filter(due)
+                      .order_by(UploadJob.next_attempt_at).limit(10)]
+        for job_id in candidates:
+            # Workers of other processes may be claiming the same jobs, the update only succeeds for one of them
+            claimed = session.query(UploadJob).filter(UploadJob.id == job_id, due).update(
+                {'status': RUNNING, 'updated_at': now}, synchronize_session=False)
+            session.commit()
+            if claimed:
+                return job_id
+        return None
+    finally:
+        session.close()
+
+
+def run_job(job_id, client=hsclients.get_client):
+    """
+    Create the resource of a claimed job and set its access rules. Transient failures queue the job again until
+    GAUGEVIEW_UPLOAD_ATTEMPTS attempts were made.
+    :param job_id: Id returned by claim_job
+    :param client: Function returning the HydroShare client of a Django user, the pooled client by default
+    :return: The status of the job
+    """
+    from django.contrib.auth import get_user_model
+    from .model import SessionMaker, UploadJob
+
+    session = SessionMaker()
+    try:
+        job = session.query(UploadJob).get(job_id)
+        job.attempts += 1
+        session.commit()
+        try:
+            hs = client(get_user_model().objects.get(pk=job.user_id))
+            if job.resource_id is None:
+                # A timeout or a 5xx may have come after HydroShare created the resource of an earlier attempt
+                resource_id = find_job_resource(hs, job.id) if job.attempts > 1 or job.error is not None else None
+                if resource_id is None:
+                    metadata = json.dumps([{'referenceurl': {'value': job.waterml_url, 'type': 'rest'}}])
+                    resource_id = call_hydroshare(hs.createResource, RESOURCE_TYPE, job.title, resource_file=None,
+                                                  keywords=json.loads(job.keywords) + [JOB_KEYWORD.format(job.id)],
+                                                  abstract=job.abstract, metadata=metadata)
+                if resource_id is None:
+                    raise ValueError('HydroShare created no resource')
+                # Before anything else can fail, so retries don't create a second resource
+                job.resource_id = resource_id
+                job.hs_hostname = hs.hostname
+                job.updated_at = time.time()
+                session.commit()
+            if job.public:
+                call_hydroshare(hs.setAccessRules, job.resource_id, public=True)
+        except Exception as e:
+            if is_transient(e) and job.attempts < get_setting('GAUGEVIEW_UPLOAD_ATTEMPTS', 5):
+                logger.warning("upload job %s failed, retrying: %s", job.id, e)
+                job.status = QUEUED
+                job.next_attempt_at = time.time() + retry_delay(job.attempts)
+            else:
+                logger.exception("upload job %s failed", job.id)
+                job.status = FAILED
+                job.error = failure_message(e)
+        else:
+            job.status = SUCCEEDED
+            job.error = None
+        job.updated_at = time.time()
+        session.commit()
+        return job.status
+    finally:
+        session.close()
+
+
+def work(stop=None):
+    """
+    Run jobs as they come due
+    :param stop: threading.Event ending the loop when set, the loop runs forever without it
+    """
+    poll_interval = get_setting('GAUGEVIEW_UPLOAD_POLL_INTERVAL', 2.0)
+    while stop is None or not stop.is_set():
+        try:
+            job_id = claim_job()
+        except Exception:
+            logger.exception("could not claim an upload job")
+            job_id = None
+        if job_id is None:
+            _wakeup.wait(poll_interval)
+            _wakeup.clear()
+            continue
+        try:
+            run_job(job_id)
+        except Exception:
+            # The job stays running, and is claimed again once its lease ran out
+            logger.exception("could not run upload job %s", job_id)
+
+
+def start_workers(count=None):
+    """
+    Start the upload worker threads of this process. Safe to call on every request, they are started once per
+    process.
+    :param count: Number of threads, defaults to GAUGEVIEW_UPLOAD_WORKERS. With 0 the jobs are only run by
+    `python -m tethysapp.gaugeview.uploads run`.
+    """
+    global _workers_pid
+    if count is None:
+        count = get_setting('GAUGEVIEW_UPLOAD_WORKERS', 2)
+    if _workers_pid == os.getpid() or count < 1:
+        return []
+    with _workers_lock:
+        if _workers_pid == os.getpid():
+            return []
+        _workers_pid = os.getpid()
+    threads = []
+    for index in range(count):
+        thread = threading.Thread(target=work, name='gaugeview-upload-{0}'.format(index))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    return threads
+
+
+def list_jobs(status=None, limit=50, batch_id=None):
+    """
+    :param status: Only the jobs with this status
+    :param batch_id: Only the jobs of this batch
+    :param limit: Most jobs returned
+    :return: A list of the dicts of the latest jobs, newest first
+    """
+    from .model import SessionMaker, UploadJob
+
+    session = SessionMaker()
+    try:
+        query = session.query(UploadJob)
+        if status is not None:
+            query = query.filter(UploadJob.status == status)
+        if batch_id is not None:
+            query = query.filter(UploadJob.batch_id == batch_id)
+        return [job.as_dict() for job in query.order_by(UploadJob.created_at.desc()).limit(limit)]
+    finally:
+        session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Work or inspect the queue of the gaugeview HydroShare uploads.')
+    commands = parser.add_subparsers(dest='command')
+    run = commands.add_parser('run', help='run the queued uploads until interrupted')
+    run.add_argument('--workers', type=int, default=get_setting('GAUGEVIEW_UPLOAD_WORKERS', 2),
+                     help='uploads run at once')
+    jobs = commands.add_parser('list', help='print the latest jobs')
+    jobs.add_argument('--status', choices=(QUEUED, RUNNING, SUCCEEDED, FAILED))
+    jobs.add_argument('--batch', help='only the jobs of this batch')
+    jobs.add_argument('--limit', type=int, default=50)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'run':
+        threads = start_workers(max(1, args.workers))
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+        print('stopped {0} workers'.format(len(threads)))
+    else:
+        for job in list_jobs(args.status, args.limit, args.batch):
+            print('{0}  {1}  {2:<9} {3} attempts  {4:<32}  {5}'.format(
+                job['job_id'], datetime.fromtimestamp(job['created_at']).strftime('%Y-%m-%d %H:%M:%S'),
+                job['status'], job['attempts'], job['resource_id'] or '-', job['error'] or job['title']))
+
+
+if __name__ == '__main__':
+    main()
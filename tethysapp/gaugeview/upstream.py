@@ -0,0 +1,633 @@
+import Queue
+import email.utils
+import httplib
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+import urllib2
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+from . import metrics, timing
+from .config import get_setting
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait on each upstream service before giving up, overridable with GAUGEVIEW_UPSTREAM_TIMEOUTS
+UPSTREAM_TIMEOUTS = {
+    'nwis': 15,
+    'nwis_services': 60,  # WaterML exports of long periods
+    'ahps': 10,
+    'epa': 5,
+    'nwm': 15,
+    'gaugeviewer': 60,  # pages of the gauge layers loaded into the catalog
+    'hydroshare': 120,  # uploads, waited on by background jobs only
+}
+
+# Calls slower than this many seconds count as failures for the circuit breaker of each service, overridable with
+# GAUGEVIEW_SLOW_CALL_SECONDS. Services exporting long periods are slow when healthy.
+SLOW_CALL_SECONDS = {
+    'nwis': 5,
+    'nwis_services': 30,
+    'ahps': 5,
+    'epa': 5,
+    'nwm': 5,
+    'gaugeviewer': 30,
+    'hydroshare': 60,
+}
+
+# Circuit breaker defaults, overridable with GAUGEVIEW_CIRCUIT_BREAKER
+CIRCUIT_BREAKER = {
+    'window': 60,            # seconds of calls the error rate is computed over
+    'min_calls': 5,          # calls needed in the window before the breaker may trip
+    'error_rate': 0.5,       # fraction of failed or slow calls that trips the breaker (see SLOW_CALL_SECONDS)
+    'reset_timeout': 30,     # seconds the breaker stays open before letting a probe through
+}
+
+# Requests per second, burst and most requests in flight allowed to each upstream host, overridable per service with
+# GAUGEVIEW_RATE_LIMITS. The rate is halved when a service answers 429 or 503 and grows back as calls succeed.
+RATE_LIMITS = {
+    'nwis': {'rate': 10, 'burst': 20, 'max_in_flight': 8},
+    'nwis_services': {'rate': 5, 'burst': 10, 'max_in_flight': 4},
+    'ahps': {'rate': 5, 'burst': 10, 'max_in_flight': 4},
+    'epa': {'rate': 5, 'burst': 10, 'max_in_flight': 4},
+    'nwm': {'rate': 5, 'burst': 10, 'max_in_flight': 4},
+    'gaugeviewer': {'rate': 2, 'burst': 2, 'max_in_flight': 2},
+    'hydroshare': {'rate': 1, 'burst': 4, 'max_in_flight': 4},
+}
+
+# Status codes by which a service says it is being sent too many requests
+THROTTLED_CODES = (429, 503)
+
+
+class UpstreamError(Exception):
+    """
+    An upstream service could not be reached, timed out or failed
+    """
+    pass
+
+
+class CircuitOpenError(UpstreamError):
+    """
+    The circuit breaker of an upstream service is open, so the call was not attempted
+    """
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Stops calling an upstream service once too many recent calls failed or were slow. After reset_timeout a single
+    probe call is let through (half-open); it closes the breaker if it succeeds and re-opens it if it fails.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, window, min_calls, error_rate, slow_call_seconds, reset_timeout):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.opened_at = None
+        self._calls = deque()  # (time, failed)
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """
+        :raise CircuitOpenError: If the call should not be attempted
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+        raise CircuitOpenError('{0} circuit breaker is {1}'.format(self.name, self.state))
+
+    def record(self, succeeded, seconds):
+        """
+        :param succeeded: False if the call failed
+        :param seconds: How long the call took
+        """
+        failed = not succeeded or seconds > self.slow_call_seconds
+        now = time.time()
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probing = False
+                if failed:
+                    self._open(now)
+                else:
+                    logger.info("%s circuit breaker closed", self.name)
+                    self.state = self.CLOSED
+                    self._calls.clear()
+                return
+
+            self._calls.append((now, failed))
+            while self._calls and self._calls[0][0] < now - self.window:
+                self._calls.popleft()
+            failures = sum(1 for call in self._calls if call[1])
+            if (self.state == self.CLOSED and len(self._calls) >= self.min_calls and
+                    failures >= self.error_rate * len(self._calls)):
+                self._open(now)
+
+    def _open(self, now):
+        logger.warning("%s circuit breaker opened", self.name)
+        self.state = self.OPEN
+        self.opened_at = now
+        self._calls.clear()
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name):
+    """
+    :param name: One of the keys of config.UPSTREAM_URLS
+    :return: The circuit breaker of that upstream service in this process
+    """
+    with _breakers_lock:
+        if name not in _breakers:
+            options = dict(CIRCUIT_BREAKER, slow_call_seconds=SLOW_CALL_SECONDS[name])
+            options.update(get_setting('GAUGEVIEW_CIRCUIT_BREAKER', {}))
+            slow_call_seconds = get_setting('GAUGEVIEW_SLOW_CALL_SECONDS', {})
+            if name in slow_call_seconds:
+                options['slow_call_seconds'] = slow_call_seconds[name]
+            _breakers[name] = CircuitBreaker(name, **options)
+        return _breakers[name]
+
+
+class RateLimiter(object):
+    """
+    Token bucket plus a cap on the requests in flight to one upstream service. The rate backs off when the service
+    throttles (halving, and pausing for its Retry-After) and climbs back by a fiftieth of max_rate per success.
+    """
+    def __init__(self, name, rate, burst, max_in_flight, min_rate=0.1):
+        self.name = name
+        self.max_rate = float(rate)
+        self.min_rate = min_rate
+        self.rate = float(rate)
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.tokens = float(burst)
+        self.in_flight = 0
+        self.paused_until = 0
+        # Queue wait statistics
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait = 0.0
+        self.throttled = 0
+        self._updated = time.time()
+        self._condition = threading.Condition()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _record_wait(self, waited):
+        self.waits += 1
+        self.wait_seconds += waited
+        self.max_wait = max(self.max_wait, waited)
+
+    def acquire(self, timeout):
+        """
+        Wait for a token and a free slot, call release() when the request is done
+        :param timeout: Most seconds to wait
+        :return: Seconds waited in the queue
+        :raise UpstreamError: If no slot was free in time
+        """
+        started = time.time()
+        with self._condition:
+            while True:
+                now = time.time()
+                self._refill(now)
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.in_flight >= self.max_in_flight:
+                    wait = None  # until a request is released
+                elif self.tokens < 1:
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    waited = now - started
+                    self._record_wait(waited)
+                    return waited
+                left = started + timeout - now
+                if left <= 0:
+                    self._record_wait(now - started)
+                    raise UpstreamError('{0} rate limit: no request slot within {1:.1f} s'.format(self.name, timeout))
+                self._condition.wait(left if wait is None else min(wait, left))
+
+    def release(self, throttled=False, retry_after=None):
+        """
+        :param throttled: True if the service answered 429 or 503
+        :param retry_after: Seconds the service asked to wait, from its Retry-After header
+        """
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                self.throttled += 1
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.tokens = min(self.tokens, 0)
+                self.paused_until = max(self.paused_until, time.time() + (retry_after or 1 / self.rate))
+                logger.warning("%s is throttling, rate lowered to %.2f/s", self.name, self.rate)
+            else:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 50)
+            self._condition.notify_all()
+
+    def stats(self):
+        """
+        :return: A dict of the current rate, requests in flight, and queue wait statistics
+        """
+        with self._condition:
+            return {'rate': self.rate, 'in_flight': self.in_flight, 'waits': self.waits,
+                    'wait_seconds': self.wait_seconds, 'max_wait': self.max_wait, 'throttled': self.throttled,
+                    'mean_wait': self.wait_seconds / self.waits if self.waits else 0.0}
+
+
+_limiters = {}
+
+
+def get_limiter(name):
+    """
+    :param name: One of the keys of config.UPSTREAM_URLS
+    :return: The rate limiter of that upstream service in this process
+    """
+    with _breakers_lock:
+        if name not in _limiters:
+            options = dict(RATE_LIMITS[name])
+            options.update(get_setting('GAUGEVIEW_RATE_LIMITS', {}).get(name, {}))
+            _limiters[name] = RateLimiter(name, **options)
+        return _limiters[name]
+
+
+def limiter_stats():
+    """
+    :return: A dict of the rate limiter statistics of each upstream service called by this process
+    """
+    with _breakers_lock:
+        limiters = dict(_limiters)
+    return dict((name, limiter.stats()) for name, limiter in limiters.items())
+
+
+def parse_retry_after(value):
+    """
+    :param value: A Retry-After header, seconds or an HTTP date
+    :return: Seconds to wait, or None if the header is missing or malformed
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        parsed = email.utils.parsedate_tz(value)
+        if parsed is None:
+            return None
+        return max(0.0, email.utils.mktime_tz(parsed) - time.time())
+
+
+def get_timeout(name):
+    """
+    :param name: One of the keys of config.UPSTREAM_URLS
+    :return: Seconds to wait on that upstream service
+    """
+    timeouts = dict(UPSTREAM_TIMEOUTS)
+    timeouts.update(get_setting('GAUGEVIEW_UPSTREAM_TIMEOUTS', {}))
+    return timeouts[name]
+
+
+class DeadlineExceeded(UpstreamError):
+    """
+    The latency budget of the request ran out before the upstream service answered
+    """
+    pass
+
+
+class LatencyHistogram(object):
+    """
+    Response times of an upstream service in fixed buckets. Counts are halved every DECAY_EVERY observations so the
+    percentiles follow how the service behaves lately.
+    """
+    BUCKETS = (0.025, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.4, 0.5, 0.75, 1, 1.5, 2, 3, 4, 5, 7.5, 10, 15, 20, 30, 60,
+               float('inf'))
+    DECAY_EVERY = 1000
+
+    def __init__(self):
+        self.counts = [0] * len(self.BUCKETS)
+        self.count = 0
+        self._observed = 0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    self.counts[i] += 1
+                    break
+            self.count += 1
+            self._observed += 1
+            if self._observed % self.DECAY_EVERY == 0:
+                self.counts = [count // 2 for count in self.counts]
+                self.count = sum(self.counts)
+
+    def percentile(self, fraction):
+        """
+        :param fraction: i.e. 0.95
+        :return: The upper bound of the bucket holding that percentile, or None if nothing was observed
+        """
+        with self._lock:
+            if not self.count:
+                return None
+            target = fraction * self.count
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS, self.counts):
+                cumulative += count
+                if cumulative >= target:
+                    return bound
+        return None
+
+
+_histograms = {}
+_local = threading.local()
+
+
+def get_histogram(name):
+    """
+    :param name: One of the keys of config.UPSTREAM_URLS
+    :return: The latency histogram of that upstream service in this process
+    """
+    with _breakers_lock:
+        if name not in _histograms:
+            _histograms[name] = LatencyHistogram()
+        return _histograms[name]
+
+
+class deadline(object):
+    """
+    Context manager giving the upstream calls made inside it (including those run by fetch_concurrently) a shared
+    latency budget
+    :param seconds: The budget
+    """
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self._previous = None
+
+    def __enter__(self):
+        self._previous = getattr(_local, 'deadline', None)
+        _local.deadline = time.time() + self.seconds
+        return self
+
+    def __exit__(self, *exc_info):
+        _local.deadline = self._previous
+
+
+def time_remaining():
+    """
+    :return: Seconds left in the budget of the current request, or None if it has none
+    """
+    current = getattr(_local, 'deadline', None)
+    if current is None:
+        return None
+    return current - time.time()
+
+
+def hedge_delay(name):
+    """
+    :param name: One of the keys of config.UPSTREAM_URLS
+    :return: Seconds after which a duplicate request is sent, the service's p95 latency; None if hedging is disabled
+    or the service has too few observations
+    """
+    histogram = get_histogram(name)
+    if not get_setting('GAUGEVIEW_HEDGING', True) or histogram.count < get_setting('GAUGEVIEW_HEDGE_MIN_SAMPLES', 20):
+        return None
+    return max(histogram.percentile(0.95), get_setting('GAUGEVIEW_HEDGE_MIN_DELAY', 0.05))
+
+
+def _attempt(name, url, timeout):
+    breaker = get_breaker(name)
+    limiter = get_limiter(name)
+    waited = limiter.acquire(timeout)
+    if waited > 0.1:
+        logger.debug("waited %.3f s for a %s request slot", waited, name)
+    if waited > 0:
+        timing.record_stage(name + '-queue', waited)
+    started = time.time()
+    try:
+        response = urllib2.urlopen(url, timeout=max(timeout - waited, 0.1))
+        data = response.read()
+    except urllib2.HTTPError as e:
+        throttled = e.code in THROTTLED_CODES
+        limiter.release(throttled, parse_retry_after(e.hdrs.get('Retry-After')) if throttled and e.hdrs else None)
+        # Client errors (i.e. a forecast that doesn't exist) say nothing about the health of the service
+        breaker.record(e.code < 500, time.time() - started)
+        metrics.observe_upstream(name, time.time() - started, error='http_{0}'.format(e.code))
+        raise
+    except (urllib2.URLError, socket.error, httplib.HTTPException) as e:
+        limiter.release()
+        breaker.record(False, time.time() - started)
+        metrics.observe_upstream(name, time.time() - started, error='network')
+        raise UpstreamError('{0} request failed: {1}'.format(name, e))
+    except Exception:
+        limiter.release()
+        breaker.record(False, time.time() - started)
+        metrics.observe_upstream(name, time.time() - started, error='other')
+        raise
+    limiter.release()
+    elapsed = time.time() - started
+    breaker.record(True, elapsed)
+    get_histogram(name).observe(elapsed)
+    timing.record_upstream(name, len(data), elapsed)
+    metrics.observe_upstream(name, elapsed, len(data))
+    return data
+
+
+def _race(name, url, timeout, hedge_after):
+    """
+    Send the request in a thread of the hedge pool, and a duplicate if it hasn't answered after hedge_after seconds.
+    The first successful answer wins; the caller stops waiting after timeout seconds. Without a free thread the
+    request is sent from the caller's thread, or not duplicated.
+    """
+    results = Queue.Queue()
+    request_deadline = getattr(_local, 'deadline', None)
+    timer = timing.current()
+    pool = get_hedge_pool()
+
+    def run():
+        results.put(_call(lambda: _attempt(name, url, timeout), request_deadline, timer))
+
+    if not pool.submit(run):
+        return _attempt(name, url, timeout)
+    started = time.time()
+    attempts = 1
+    failures = []
+    while len(failures) < attempts:
+        wait = timeout - (time.time() - started)
+        if hedge_after is not None and attempts == 1:
+            wait = min(wait, hedge_after)
+        try:
+            succeeded, value = results.get(timeout=max(wait, 0))
+        except Queue.Empty:
+            if hedge_after is not None and attempts == 1 and time.time() - started < timeout:
+                if pool.submit(run):
+                    logger.debug("hedging %s request after %.3f s", name, hedge_after)
+                    attempts += 1
+                hedge_after = None
+                continue
+            raise DeadlineExceeded('{0} did not answer within {1:.1f} s'.format(name, timeout))
+        if succeeded:
+            return value
+        failures.append(value)
+    raise failures[0][0], failures[0][1], failures[0][2]
+
+
+def get(name, url):
+    """
+    Read a URL of an upstream service through its circuit breaker. The call is bounded by the service's timeout and
+    by what is left of the current request's deadline. When the service is slower than its usual p95, a duplicate
+    request is sent and the first answer is used.
+    :param name: One of the keys of config.UPSTREAM_URLS
+    :param url: The URL to read
+    :return: The body of the response
+    :raise HTTPError: If the service answered with an error status
+    :raise UpstreamError: If the service could not be reached in time, or its circuit breaker is open
+    """
+    timeout = get_timeout(name)
+    remaining = time_remaining()
+    if remaining is not None:
+        if remaining <= 0:
+            raise DeadlineExceeded('no time left to call {0}'.format(name))
+        timeout = min(timeout, remaining)
+
+    breaker = get_breaker(name)
+    breaker.before_call()
+    # A half-open breaker lets a single probe through
+    hedge_after = hedge_delay(name) if breaker.state == CircuitBreaker.CLOSED else None
+    if hedge_after is None or hedge_after >= timeout:
+        # The timeout is already clamped to the budget of the request
+        return _attempt(name, url, timeout)
+    return _race(name, url, timeout, hedge_after)
+
+
+def is_upstream_failure(error):
+    """
+    :param error: An exception raised while fetching from an upstream service
+    :return: True if it means the service is unhealthy, rather than that the request was wrong
+    """
+    if isinstance(error, urllib2.HTTPError):
+        return error.code >= 500
+    return isinstance(error, UpstreamError)
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    :return: The thread pool of this process used to wait on upstream services in parallel (GAUGEVIEW_FETCH_THREADS
+    threads), or None if concurrent fetching is disabled
+    """
+    global _pool, _pool_pid
+    size = get_setting('GAUGEVIEW_FETCH_THREADS', 16)
+    if size < 2:
+        return None
+    # Pools don't survive a fork, each worker process creates its own
+    if _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool_pid != os.getpid():
+                _pool = ThreadPool(size)
+                _pool_pid = os.getpid()
+    return _pool
+
+
+class HedgePool(object):
+    """
+    Threads of this process running the requests that may be hedged, at most size at once. Requests are refused rather
+    than queued when every thread is busy, so a request abandoned at its deadline holds a thread (and its rate limiter
+    slot) only until its own timeout, and never delays the others.
+    :param size: Number of threads
+    """
+    def __init__(self, size):
+        self._pool = ThreadPool(size)
+        self._slots = threading.BoundedSemaphore(size)
+
+    def submit(self, func):
+        """
+        :param func: Function of no arguments
+        :return: True if a thread runs func, False if every thread is busy
+        """
+        if not self._slots.acquire(False):
+            return False
+
+        def run():
+            try:
+                func()
+            finally:
+                self._slots.release()
+        self._pool.apply_async(run)
+        return True
+
+
+_hedge_pool = None
+_hedge_pool_pid = None
+
+
+def get_hedge_pool():
+    """
+    :return: The HedgePool of this process, of GAUGEVIEW_HEDGE_THREADS threads
+    """
+    global _hedge_pool, _hedge_pool_pid
+    # Pools don't survive a fork, each worker process creates its own
+    if _hedge_pool_pid != os.getpid():
+        with _pool_lock:
+            if _hedge_pool_pid != os.getpid():
+                _hedge_pool = HedgePool(get_setting('GAUGEVIEW_HEDGE_THREADS', 16))
+                _hedge_pool_pid = os.getpid()
+    return _hedge_pool
+
+
+def _call(func, request_deadline=None, timer=None):
+    # Pool threads run the calls of many requests, so the caller's deadline and timer are set for the duration of the
+    # call
+    _local.deadline = request_deadline
+    timing.activate(timer)
+    try:
+        return True, func()
+    except Exception:
+        return False, sys.exc_info()
+    finally:
+        _local.deadline = None
+        timing.activate(None)
+
+
+def fetch_concurrently(*calls):
+    """
+    Run functions that mostly wait on upstream services at the same time, so a page waits as long as its slowest
+    source instead of the sum of all of them. Runs them one after the other when GAUGEVIEW_FETCH_THREADS is below 2.
+    :param calls: Functions without arguments
+    :return: A list of what each function returned, in order. If any raised, the first exception is re-raised once
+    all of them are done.
+    """
+    pool = get_pool()
+    if pool is None or len(calls) < 2:
+        return [func() for func in calls]
+
+    args = (getattr(_local, 'deadline', None), timing.current())
+    results = [result.get() for result in [pool.apply_async(_call, (func,) + args) for func in calls]]
+    values = []
+    for succeeded, value in results:
+        if not succeeded:
+            raise value[0], value[1], value[2]
+        values.append(value)
+    return values